@@ -1,6 +1,6 @@
 # Add this to EACH of your 5 AI apps
-import requests
 from itsdangerous import URLSafeTimedSerializer
+from shared.bank_client import BankClient, BankError
 
 serializer = URLSafeTimedSerializer('your-secret-key-here')
 
@@ -8,6 +8,8 @@ class TokenMiddleware:
     def __init__(self, app_id, dashboard_url):
         self.app_id = app_id
         self.dashboard_url = dashboard_url
+        # Pooled, keep-alive connections shared by every call from this app
+        self.bank = BankClient(dashboard_url)
     
     def check_and_spend(self, passport_token, operation, cost):
         """Verify passport and spend tokens before AI operation"""
@@ -20,28 +22,42 @@ class TokenMiddleware:
                 return {"error": "Session budget exceeded"}, 403
             
             # Ask central bank to deduct tokens
-            spend_request = {
-                "email": passport["email"],
-                "app_id": self.app_id,
-                "tokens": cost,
-                "description": operation
-            }
+            try:
+                self.bank.spend(passport["email"], self.app_id, cost, operation)
+            except BankError:
+                return {"error": "Payment failed"}, 402
             
-            response = requests.post(
-                f"{self.dashboard_url}/spend",
-                json=spend_request
-            )
+            # Update passport budget
+            passport["budget"] -= cost
+            new_token = serializer.dumps(passport, salt=f'passport-{self.app_id}')
+            return {"approved": True, "new_passport": new_token}
+                
+        except:
+            return {"error": "Invalid passport"}, 401
+    
+    def authorize(self, passport_token, operation, cost, ttl_seconds=120):
+        """Reserve tokens before a long AI operation; settle() afterwards"""
+        try:
+            passport = serializer.loads(passport_token, salt=f'passport-{self.app_id}')
             
-            if response.status_code == 200:
-                # Update passport budget
-                passport["budget"] -= cost
-                new_token = serializer.dumps(passport, salt=f'passport-{self.app_id}')
-                return {"approved": True, "new_passport": new_token}
-            else:
+            if cost > passport["budget"]:
+                return {"error": "Session budget exceeded"}, 403
+            
+            try:
+                hold = self.bank.hold(passport["email"], self.app_id, cost, operation, ttl_seconds)
+            except BankError:
                 return {"error": "Payment failed"}, 402
+            
+            passport["budget"] -= cost
+            new_token = serializer.dumps(passport, salt=f'passport-{self.app_id}')
+            return {"approved": True, "hold_id": hold.hold_id, "new_passport": new_token}
                 
         except:
             return {"error": "Invalid passport"}, 401
+    
+    def settle(self, hold_id, success=True, actual_cost=None):
+        """Capture the hold (optionally for less) on success, release it on failure"""
+        return self.bank.settle(hold_id, success, actual_cost) is not None
 
 # Usage in your existing AI app:
 # middleware = TokenMiddleware(app_id="image_generator", dashboard_url="https://dashboard.yoursite.com")
@@ -50,4 +66,10 @@ class TokenMiddleware:
 # result = middleware.check_and_spend(passport_token, "generate_image", 50)
 # if result["approved"]:
 #     # Call AI API
-#     # Update passport token in session
\ No newline at end of file
+#     # Update passport token in session
+
+# For slow operations, reserve first and settle when the AI call returns:
+# auth = middleware.authorize(passport_token, "generate_image", 50)
+# if auth["approved"]:
+#     ok = call_ai_api()
+#     middleware.settle(auth["hold_id"], success=ok)
\ No newline at end of file
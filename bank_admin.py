@@ -0,0 +1,233 @@
+# bank_admin.py
+"""Maintenance commands for bank.db.
+
+Usage: python bank_admin.py migrate [--online] [--chunk 50000] [--vacuum]
+       python bank_admin.py backfill-usage [--chunk 50000]
+       python bank_admin.py snapshot [--chunk 50000]
+       python bank_admin.py rebuild-accounts [--full] [--chunk 500000]
+       python bank_admin.py renew [--chunk 5000] [--rollover full|none|cap] [--enroll]
+       python bank_admin.py replica
+       python bank_admin.py reshard --to 4 [--shards 1]
+
+--shards is the bank's current shard count (default BANK_SHARDS); the
+per-database commands run on every shard file in turn.
+"""
+import argparse
+import os
+import sys
+import time
+
+from shared.bank_db import DB_PATH, ConnectionPool, migrate
+from shared.bank_ledger import REPLAY_CHUNK, SNAPSHOT_CHUNK, rebuild_accounts, snapshot_balances
+from shared.bank_replica import Replica
+from shared.bank_renewals import RENEWAL_CHUNK, ROLLOVER, ROLLOVER_POLICIES, renew_due
+from shared.bank_schema import (MIGRATIONS, MIGRATION_CHUNK, backfill_usage,
+                                copy_legacy_transactions, prepare_compact_transactions)
+from shared.bank_shards import SHARD_COUNT, copy_into_shard, shard_path
+
+# Schema version whose transactions table is still the legacy layout
+LEGACY_VERSION = 2
+
+
+def cmd_migrate(db, args):
+    """Upgrade the schema; --online copies legacy rows in small transactions first"""
+    version = db.connection().execute("PRAGMA user_version").fetchone()[0]
+    if args.online and version <= LEGACY_VERSION:
+        migrate(db, MIGRATIONS[:LEGACY_VERSION])
+        with db.transaction("IMMEDIATE") as c:
+            prepare_compact_transactions(c)
+
+        # Each chunk holds the write lock only briefly, so a running bank
+        # keeps serving; rows it writes meanwhile are picked up by the
+        # next chunk or by the final step below
+        copied = 0
+        start = time.perf_counter()
+        while True:
+            with db.transaction("IMMEDIATE") as c:
+                rows = copy_legacy_transactions(c, args.chunk or MIGRATION_CHUNK)
+            if not rows:
+                break
+            copied += rows
+            elapsed = time.perf_counter() - start
+            print(f"copied {copied} rows ({copied / elapsed:.0f} rows/sec)")
+
+    version = migrate(db, MIGRATIONS)
+    print(f"schema at version {version}")
+    if args.vacuum:
+        db.connection().execute("VACUUM")
+        print("vacuumed")
+
+
+def cmd_backfill_usage(db, args):
+    """Rebuild usage_daily from the ledger, chunk by chunk"""
+    migrate(db, MIGRATIONS)
+    # Under the write lock: everything up to `last_id` is recounted here,
+    # everything after it is counted live by the bank as it commits
+    with db.transaction("IMMEDIATE") as c:
+        last_id = c.execute('SELECT COALESCE(MAX(id), 0) FROM transactions').fetchone()[0]
+        c.execute('DELETE FROM usage_daily')
+
+    done = 0
+    start = time.perf_counter()
+    while done < last_id:
+        upto = min(done + (args.chunk or MIGRATION_CHUNK), last_id)
+        with db.transaction("IMMEDIATE") as c:
+            backfill_usage(c, done, upto)
+        done = upto
+        elapsed = time.perf_counter() - start
+        print(f"rolled up {done}/{last_id} ledger rows ({done / elapsed:.0f} rows/sec)")
+
+
+def cmd_snapshot(db, args):
+    """Bring balance_snapshots up to the end of the ledger"""
+    migrate(db, MIGRATIONS)
+    covered = 0
+    start = time.perf_counter()
+    while True:
+        with db.transaction("IMMEDIATE") as c:
+            rows = snapshot_balances(c, args.chunk or SNAPSHOT_CHUNK)
+        if not rows:
+            break
+        covered += rows
+        print(f"snapshotted {covered} ledger rows ({covered / (time.perf_counter() - start):.0f} rows/sec)")
+
+
+def cmd_rebuild_accounts(db, args):
+    """Recompute every balance from the ledger (stop the bank first)"""
+    migrate(db, MIGRATIONS)
+    stats = rebuild_accounts(db, full=args.full, chunk=args.chunk or REPLAY_CHUNK)
+    rate = stats["ledger_rows_replayed"] / max(stats["replay_seconds"], 1e-9)
+    print(f"rebuilt {stats['accounts']} accounts from {stats['ledger_rows_replayed']} ledger rows "
+          f"in {stats['total_seconds']:.2f}s ({rate:.0f} rows/sec replayed)")
+
+
+def cmd_renew(db, args):
+    """Grant the monthly plan tokens of every account due now (stop the bank first).
+
+    The bank does this itself every hour; this is for catching up after
+    downtime. --enroll first puts accounts that never had a plan set on
+    the schedule, due now.
+    """
+    migrate(db, MIGRATIONS)
+    cutoff = int(time.time() * 1000)
+    if args.enroll:
+        with db.transaction("IMMEDIATE") as c:
+            # Team stripes only once they know their share of the team's grant
+            enrolled = c.execute('''UPDATE accounts SET renews_at = ?
+                                   WHERE renews_at IS NULL
+                                     AND (email NOT LIKE 'team:%' OR stripes IS NOT NULL)''',
+                                 (cutoff,)).rowcount
+        print(f"enrolled {enrolled} accounts")
+
+    accounts = tokens = 0
+    start = time.perf_counter()
+    while True:
+        chunk_start = time.perf_counter()
+        with db.transaction("IMMEDIATE") as c:
+            result = renew_due(c, cutoff, args.chunk or RENEWAL_CHUNK, args.rollover)
+        if not result["accounts"]:
+            break
+        accounts += result["accounts"]
+        tokens += result["tokens"]
+        print(f"renewed {accounts} accounts, {tokens} tokens granted "
+              f"({result['accounts'] / (time.perf_counter() - chunk_start):.0f} accounts/sec this chunk)")
+    elapsed = time.perf_counter() - start
+    print(f"done: {accounts} accounts in {elapsed:.2f}s ({accounts / max(elapsed, 1e-9):.0f} accounts/sec)")
+
+
+def cmd_replica(db, args):
+    """Refresh the read-only copy used for reports and exports (safe while the bank runs)"""
+    replica = Replica(db)
+    stats = replica.refresh()
+    print(f"copied {stats['pages']} pages to {replica.path} in {stats['seconds']:.2f}s")
+
+
+def _totals(dbs):
+    """(accounts, tokens, ledger rows, ledger sum) over a set of shard files"""
+    totals = [0, 0, 0, 0]
+    for db in dbs:
+        c = db.connection()
+        row = c.execute('SELECT COUNT(*), COALESCE(SUM(tokens), 0) FROM accounts').fetchone()
+        row += c.execute('SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM transactions').fetchone()
+        totals = [a + b for a, b in zip(totals, row)]
+    return tuple(totals)
+
+
+def cmd_reshard(dbs, args):
+    """Copy the bank into a new set of --to shard files (stop the bank first).
+
+    The current files are left untouched; restart the bank with
+    BANK_SHARDS set to the new count once the totals check out, then
+    remove the old files. Holds still open are copied but their ids
+    keep the old shard prefix, so let them settle or expire first.
+    """
+    if not args.to or args.to < 1:
+        sys.exit("reshard needs --to N (N >= 1)")
+    if args.to == len(dbs):
+        sys.exit(f"bank already has {args.to} shard(s)")
+    targets = [ConnectionPool(shard_path(args.db, i, args.to)) for i in range(args.to)]
+    existing = [t.path for t in targets if os.path.exists(t.path)]
+    if existing:
+        sys.exit(f"refusing to overwrite {', '.join(existing)}")
+    for db in dbs:
+        migrate(db, MIGRATIONS)
+
+    start = time.perf_counter()
+    for index, target in enumerate(targets):
+        migrate(target, MIGRATIONS)
+        for source in dbs:
+            accounts, rows = copy_into_shard(target, source.path, index, args.to, usage=index == 0)
+            print(f"{source.path} -> {target.path}: {accounts} accounts, {rows} ledger rows "
+                  f"({time.perf_counter() - start:.1f}s)")
+
+    before, after = _totals(dbs), _totals(targets)
+    print(f"accounts {after[0]}, tokens {after[1]}, ledger rows {after[2]}, ledger sum {after[3]}")
+    if before != after:
+        print(f"MISMATCH: source totals {before}")
+        return 1
+    print(f"totals match; restart the bank with BANK_SHARDS={args.to}")
+
+
+COMMANDS = {
+    "migrate": cmd_migrate,
+    "backfill-usage": cmd_backfill_usage,
+    "snapshot": cmd_snapshot,
+    "rebuild-accounts": cmd_rebuild_accounts,
+    "renew": cmd_renew,
+    "replica": cmd_replica,
+}
+
+# Commands that work on all shard files at once
+CLUSTER_COMMANDS = {
+    "reshard": cmd_reshard,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="bank.db maintenance")
+    parser.add_argument("command", choices=sorted({**COMMANDS, **CLUSTER_COMMANDS}))
+    parser.add_argument("--db", default=DB_PATH, help="base path; shard files are derived from it")
+    parser.add_argument("--shards", type=int, default=SHARD_COUNT, help="current shard count")
+    parser.add_argument("--to", type=int, help="reshard: new shard count")
+    parser.add_argument("--online", action="store_true")
+    parser.add_argument("--chunk", type=int, help="rows per transaction (per-command default)")
+    parser.add_argument("--vacuum", action="store_true")
+    parser.add_argument("--full", action="store_true", help="rebuild-accounts: ignore snapshots")
+    parser.add_argument("--rollover", choices=sorted(ROLLOVER_POLICIES), default=ROLLOVER,
+                        help="renew: what happens to unspent tokens")
+    parser.add_argument("--enroll", action="store_true",
+                        help="renew: schedule accounts that have no renewal date yet")
+    args = parser.parse_args(argv)
+    dbs = [ConnectionPool(shard_path(args.db, i, args.shards)) for i in range(args.shards)]
+    if args.command in CLUSTER_COMMANDS:
+        return CLUSTER_COMMANDS[args.command](dbs, args)
+    for db in dbs:
+        if len(dbs) > 1:
+            print(f"== {db.path}")
+        status = COMMANDS[args.command](db, args)
+        if status:
+            return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
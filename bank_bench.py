@@ -0,0 +1,823 @@
+# bank_bench.py
+"""Micro-benchmarks for the central bank ledger.
+
+Usage: python bank_bench.py pool [--ops 5000]
+       python bank_bench.py stress [--ops 5000] [--threads 32]
+       python bank_bench.py group [--ops 5000] [--threads 32]
+       python bank_bench.py history [--ops 5000] [--rows 1000000]
+       python bank_bench.py compact [--rows 1000000]
+       python bank_bench.py replay [--rows 10000000]
+       python bank_bench.py shards [--ops 5000] [--threads 32]
+       BANK_SHARDS=4 python bank_bench.py teams [--ops 5000] [--threads 32]
+       python bank_bench.py client [--ops 2000]
+       python bank_bench.py renew [--ops 2000] [--rows 1000000]
+       python bank_bench.py limits [--ops 5000] [--threads 32]
+       python bank_bench.py conformance [--threads 32]
+       python bank_bench.py storage [--ops 5000]
+"""
+import argparse
+import json
+import math
+import os
+import secrets
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+# Point the bank at a scratch database before central_bank is imported
+WORKDIR = tempfile.mkdtemp(prefix="bank_bench_")
+os.environ.setdefault("BANK_DB_PATH", os.path.join(WORKDIR, "bank.db"))
+# The benchmarks hammer a few accounts on purpose; `limits` turns them on itself
+os.environ.setdefault("BANK_RATE_LIMITS", "off")
+
+
+def report(label, ops, seconds):
+    print(f"{label:<28} {ops:>8} ops  {seconds:8.3f}s  {ops / seconds:>10.0f} ops/sec")
+
+
+def legacy_deposit(path, email, tokens):
+    """Connection-per-call deposit, as central_bank did before the pool"""
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    c.execute('INSERT OR IGNORE INTO accounts (email, tokens) VALUES (?, 0)', (email,))
+    c.execute('UPDATE accounts SET tokens = tokens + ? WHERE email = ?', (tokens, email))
+    c.execute('INSERT INTO transactions VALUES (?, ?, ?, ?, ?)',
+              (secrets.token_hex(8), email, tokens, "Purchase via bench", datetime.utcnow()))
+    conn.commit()
+    conn.close()
+    conn = sqlite3.connect(path)
+    conn.execute('SELECT tokens FROM accounts WHERE email = ?', (email,)).fetchone()
+    conn.close()
+
+
+def legacy_balance(path, email):
+    conn = sqlite3.connect(path)
+    result = conn.execute('SELECT tokens FROM accounts WHERE email = ?', (email,)).fetchone()
+    conn.close()
+    return result[0] if result else 0
+
+
+def bench_pool(args):
+    import central_bank
+
+    legacy_path = os.path.join(WORKDIR, "legacy.db")
+    conn = sqlite3.connect(legacy_path)
+    conn.execute('CREATE TABLE accounts (email TEXT PRIMARY KEY, tokens INTEGER DEFAULT 0)')
+    conn.execute('CREATE TABLE transactions (id TEXT, email TEXT, amount INTEGER, description TEXT, timestamp DATETIME)')
+    conn.commit()
+    conn.close()
+
+    emails = [f"user{i}@bench.test" for i in range(100)]
+
+    start = time.perf_counter()
+    for i in range(args.ops):
+        legacy_deposit(legacy_path, emails[i % len(emails)], 1)
+    report("deposit (connect per call)", args.ops, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(args.ops):
+        central_bank.deposit_funds(central_bank.Deposit(
+            email=emails[i % len(emails)], tokens=1, payment_id=f"bench-{i}"))
+    report("deposit (pooled, WAL)", args.ops, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(args.ops):
+        legacy_balance(legacy_path, emails[i % len(emails)])
+    report("balance (connect per call)", args.ops, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(args.ops):
+        central_bank.get_balance(emails[i % len(emails)])
+    report("balance (pooled, WAL)", args.ops, time.perf_counter() - start)
+
+
+def check_ledger(dbs=None):
+    """Return a list of ledger invariant violations (empty when healthy)"""
+    import central_bank
+    problems = []
+    for db in dbs or central_bank.shards.pools:
+        conn = db.connection()
+        negative = conn.execute('SELECT email, tokens FROM accounts WHERE tokens < 0').fetchall()
+        problems += [f"negative balance {email}: {tokens}" for email, tokens in negative]
+        drift = conn.execute('''SELECT a.email, a.tokens, COALESCE(SUM(t.amount), 0)
+                                FROM accounts a LEFT JOIN transactions t ON t.email = a.email
+                                GROUP BY a.email HAVING a.tokens != COALESCE(SUM(t.amount), 0)''').fetchall()
+        problems += [f"ledger drift {email}: balance {tokens}, ledger {total}" for email, tokens, total in drift]
+    return problems
+
+
+def bench_stress(args):
+    """Many threads spend from a few small accounts at once"""
+    import central_bank
+    from fastapi import HTTPException
+
+    emails = [f"stress{i}@bench.test" for i in range(4)]
+    funded = args.ops // 2  # half the attempted spends can succeed
+    for email in emails:
+        central_bank.deposit_funds(central_bank.Deposit(
+            email=email, tokens=funded // len(emails), payment_id=f"stress-{email}"))
+
+    spent = []
+    refused = []
+
+    def spender(worker):
+        for i in range(worker, args.ops, args.threads):
+            try:
+                central_bank.spend_tokens(central_bank.SpendRequest(
+                    email=emails[i % len(emails)], app_id="prompt_wizard",
+                    tokens=1, description="stress"))
+                spent.append(1)
+            except HTTPException:
+                refused.append(1)
+
+    threads = [threading.Thread(target=spender, args=(w,)) for w in range(args.threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    report(f"spend x{args.threads} threads", args.ops, time.perf_counter() - start)
+    print(f"spent {len(spent)}, refused {len(refused)}, funded {funded // len(emails) * len(emails)}")
+
+    problems = check_ledger()
+    if len(spent) != funded // len(emails) * len(emails):
+        problems.append("successful spends do not match funded tokens")
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    if not problems:
+        print("OK: no negative balances, ledger sums match")
+    return 1 if problems else 0
+
+
+def bench_group(args):
+    """Concurrent spends: commit per request vs the group-commit writer.
+
+    Both sides use the fsync-heavy "safe" profile so the difference is
+    the number of commits hitting the disk.
+    """
+    import central_bank
+    from shared.bank_db import ConnectionPool
+    from shared.bank_writer import LedgerWriter
+
+    def spend_request(i):
+        return central_bank.SpendRequest(email=f"group{i % 64}@bench.test",
+                                         app_id="prompt_wizard", tokens=1, description="group")
+
+    def run(label, spend):
+        def worker(w):
+            for i in range(w, args.ops, args.threads):
+                spend(spend_request(i))
+        threads = [threading.Thread(target=worker, args=(w,)) for w in range(args.threads)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        report(label, args.ops, time.perf_counter() - start)
+
+    def setup(name):
+        db = ConnectionPool(os.path.join(WORKDIR, name), "safe")
+        central_bank.init_bank(db)
+        with db.transaction() as c:
+            for i in range(64):
+                central_bank.apply_deposit(c, central_bank.Deposit(
+                    email=f"group{i}@bench.test", tokens=args.ops, payment_id=f"group-{i}"))
+        return db
+
+    direct = setup("direct.db")
+
+    def spend_direct(spend):
+        with direct.transaction("IMMEDIATE") as c:
+            central_bank.apply_spend(c, spend)
+
+    run(f"commit per spend x{args.threads}", spend_direct)
+
+    writer = LedgerWriter(setup("grouped.db"))
+    run(f"group commit x{args.threads}", lambda spend: writer.run(central_bank.apply_spend, spend))
+    writer.stop()
+    print(f"writer: {writer.mutations} spends in {writer.batches} commits "
+          f"({writer.mutations / max(writer.batches, 1):.1f} per commit)")
+
+
+def bench_history(args):
+    """Page latency of GET /transactions as the ledger grows"""
+    import central_bank
+    from pricing import PRICING
+    from shared.bank_db import pool
+
+    apps = list(PRICING)
+    users = 10000
+    probe = "probe@history.test"
+    base = 1704067200000  # 2024-01-01 in epoch ms
+    # The probe account's own history stays fixed; only everyone else grows
+    with pool.transaction() as c:
+        c.executemany(central_bank.SQL_RECORD, (
+            (probe, -1, i % len(apps) + 1, "bench", base + i * 7000) for i in range(1000)))
+    inserted = 0
+    size = 10000
+    while size <= args.rows:
+        with pool.transaction() as c:
+            c.executemany(central_bank.SQL_RECORD, (
+                (f"user{i % users}@history.test", -1, i % len(apps) + 1, "bench", base + i * 1000)
+                for i in range(inserted, size)))
+        inserted = size
+
+        start = time.perf_counter()
+        for _ in range(args.ops):
+            central_bank.list_transactions(email=probe, limit=20)
+        first = (time.perf_counter() - start) / args.ops
+
+        cursor = None
+        pages = 0
+        start = time.perf_counter()
+        while pages < args.ops:
+            page = central_bank.list_transactions(email=probe, cursor=cursor, limit=20)
+            cursor = page["next_cursor"]  # wraps to the first page at the end
+            pages += 1
+        walk = (time.perf_counter() - start) / pages
+
+        print(f"{size:>10} rows   first page {first * 1e6:8.1f} us   cursor page {walk * 1e6:8.1f} us")
+        size *= 10
+
+
+def bench_compact(args):
+    """File size and scan speed of the legacy vs compact transactions layout"""
+    from pricing import PRICING
+    from shared.bank_db import ConnectionPool, migrate
+    from shared.bank_schema import MIGRATIONS
+
+    apps = list(PRICING)
+    db = ConnectionPool(os.path.join(WORKDIR, "compact.db"))
+    migrate(db, MIGRATIONS[:2])
+    base = datetime(2024, 1, 1)
+    with db.transaction() as c:
+        c.executemany('INSERT INTO transactions VALUES (?, ?, ?, ?, ?)', (
+            (secrets.token_hex(8), f"user{i % 10000}@compact.test", -4,
+             f"{apps[i % len(apps)]}: Prompt: write me a hook for a video...",
+             base + timedelta(seconds=i)) for i in range(args.rows)))
+
+    day_start, day_end = base + timedelta(days=3), base + timedelta(days=4)
+    legacy = {
+        "per-app totals": (f'''SELECT substr(description, 1, instr(description, ': ') - 1), SUM(amount)
+                              FROM transactions GROUP BY 1''', ()),
+        "one app, one day": ('''SELECT SUM(amount) FROM transactions
+                                WHERE description LIKE 'hook_wizard: %'
+                                AND timestamp >= ? AND timestamp < ?''', (day_start, day_end)),
+    }
+    day_start_ms = int(day_start.replace(tzinfo=timezone.utc).timestamp() * 1000)
+    day_end_ms = int(day_end.replace(tzinfo=timezone.utc).timestamp() * 1000)
+    compact = {
+        "per-app totals": ('''SELECT app_id, SUM(amount) FROM transactions GROUP BY app_id''', ()),
+        "one app, one day": ('''SELECT SUM(amount) FROM transactions
+                                WHERE app_id = (SELECT id FROM apps WHERE name = 'hook_wizard')
+                                AND ts >= ? AND ts < ?''', (day_start_ms, day_end_ms)),
+    }
+
+    def measure(label, queries):
+        conn = db.connection()
+        conn.execute("VACUUM")
+        size = os.path.getsize(db.path)
+        print(f"{label}: {args.rows} rows, {size / 1e6:.1f} MB ({size / args.rows:.0f} bytes/row)")
+        for name, (sql, params) in queries.items():
+            start = time.perf_counter()
+            conn.execute(sql, params).fetchall()
+            print(f"  {name:<20} {(time.perf_counter() - start) * 1000:9.1f} ms")
+
+    measure("legacy", legacy)
+    start = time.perf_counter()
+    migrate(db, MIGRATIONS)
+    print(f"migrated in {time.perf_counter() - start:.1f}s")
+    measure("compact", compact)
+
+
+def bench_replay(args):
+    """Rebuild accounts from the ledger: full replay vs snapshot + tail"""
+    from shared.bank_db import ConnectionPool, migrate
+    from shared.bank_ledger import rebuild_accounts
+    from shared.bank_schema import MIGRATIONS
+
+    db = ConnectionPool(os.path.join(WORKDIR, "replay.db"), "fast")
+    migrate(db, MIGRATIONS)
+
+    def append(rows):
+        with db.transaction() as c:
+            c.execute('''WITH RECURSIVE seq(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM seq LIMIT ?)
+                         INSERT INTO transactions (email, amount, app_id, description, ts)
+                         SELECT 'user' || (abs(random()) % 100000) || '@replay.test',
+                                CASE WHEN i % 5 = 0 THEN 20 ELSE -4 END,
+                                CASE WHEN i % 5 = 0 THEN NULL ELSE 1 + i % 6 END,
+                                'bench', 1704067200000 + i FROM seq''', (rows,))
+
+    start = time.perf_counter()
+    append(args.rows)
+    print(f"generated {args.rows} ledger rows in {time.perf_counter() - start:.1f}s")
+
+    def run(label, **kwargs):
+        stats = rebuild_accounts(db, **kwargs)
+        print(f"{label:<28} {stats['ledger_rows_replayed']:>10} rows replayed  "
+              f"{stats['total_seconds']:7.2f}s total  "
+              f"{stats['ledger_rows_replayed'] / max(stats['replay_seconds'], 1e-9):>12.0f} rows/sec")
+
+    run("full replay", full=True)
+    append(args.rows // 100)
+    run("snapshot + 1% tail")
+
+
+def bench_shards(args):
+    """Concurrent spends over many accounts with 1, 2, 4 and 8 shard files.
+
+    Uses the fsync-heavy "safe" profile. With one commit per spend (as
+    several worker processes sharing a file would do) the single write
+    lock is the limit and throughput grows with the shard count; the
+    group-commit writer already amortises commits, so it gains less.
+    """
+    import central_bank
+    from shared.bank_shards import ShardRouter
+    from shared.bank_writer import LedgerWriter
+
+    emails = [f"shard{i}@bench.test" for i in range(1024)]
+    problems = []
+    for label, max_batch in (("commit per spend", 1), ("group commit", None)):
+        for count in (1, 2, 4, 8):
+            shards = ShardRouter(os.path.join(WORKDIR, f"{max_batch}-sharded.db"), count, "safe")
+            if max_batch:
+                shards.writers = [LedgerWriter(db, max_batch=max_batch) for db in shards.pools]
+            for db in shards.pools:
+                central_bank.init_bank(db)
+            for email in emails:
+                shards.writer(email).run(central_bank.apply_deposit, central_bank.Deposit(
+                    email=email, tokens=args.ops, payment_id=f"shards-{email}"))
+
+            def worker(w):
+                for i in range(w, args.ops, args.threads):
+                    spend = central_bank.SpendRequest(email=emails[i % len(emails)],
+                                                      app_id="prompt_wizard", tokens=1,
+                                                      description="shards")
+                    shards.writer(spend.email).run(central_bank.apply_spend, spend)
+
+            threads = [threading.Thread(target=worker, args=(w,)) for w in range(args.threads)]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            report(f"{label}, {count} shard(s)", args.ops, time.perf_counter() - start)
+            shards.stop()
+            problems += check_ledger(shards.pools)
+
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    if not problems:
+        print("OK: no negative balances, ledger sums match on every shard")
+    return 1 if problems else 0
+
+
+def bench_teams(args):
+    """Concurrent spends against one shared account vs one striped team account.
+
+    Run with BANK_SHARDS > 1: a team's stripes sit on different shards,
+    so its spends commit on several writers instead of queueing on one.
+    """
+    import central_bank
+    from fastapi import HTTPException
+
+    # Each account is sent twice as many spends as it can pay for; the
+    # team's plan grant comes on top of its deposit
+    deposit = args.ops // 2
+    central_bank.deposit_funds(central_bank.Deposit(email="hot@bench.test", tokens=deposit,
+                                                    payment_id="teams-hot"))
+    granted = central_bank.create_team(central_bank.TeamRequest(team="team:bench"))["granted"]
+    central_bank.deposit_funds(central_bank.Deposit(email="team:bench", tokens=deposit,
+                                                    payment_id="teams-team"))
+
+    problems = []
+    for email, funded in (("hot@bench.test", deposit), ("team:bench", deposit + granted)):
+        spent = []
+
+        def spender(worker):
+            for i in range(worker, 2 * funded, args.threads):
+                try:
+                    central_bank.spend_tokens(central_bank.SpendRequest(
+                        email=email, app_id="prompt_wizard", tokens=1, description="teams"))
+                    spent.append(1)
+                except HTTPException:
+                    pass
+
+        threads = [threading.Thread(target=spender, args=(w,)) for w in range(args.threads)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        report(f"{email} x{args.threads}", 2 * funded, time.perf_counter() - start)
+        balance = central_bank.get_balance(email)
+        print(f"spent {len(spent)} of {funded}, balance left {balance}")
+        if len(spent) != funded or balance != 0:
+            problems.append(f"{email}: spent {len(spent)} of {funded}, {balance} left")
+
+    problems += check_ledger()
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    if not problems:
+        print("OK: every funded token spent once, ledger sums match")
+    return 1 if problems else 0
+
+
+def bench_client(args):
+    """Bank client call latency: in-process vs HTTP (ASGI in memory, and loopback if uvicorn is installed)"""
+    import asyncio
+    import statistics
+    import central_bank
+    import httpx
+    from shared.bank_client import AsyncBankClient
+
+    email = "client@bench.test"
+    central_bank.deposit_funds(central_bank.Deposit(email=email, tokens=args.ops * 10, payment_id="client"))
+
+    async def measure(label, client):
+        for call, op in (("balance", lambda: client.balance(email)),
+                         ("spend", lambda: client.spend(email, "prompt_wizard", 1, "client"))):
+            timings = []
+            for _ in range(args.ops):
+                start = time.perf_counter()
+                await op()
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            print(f"{label + ' ' + call:<32} p50 {statistics.median(timings) * 1e6:8.0f}us  "
+                  f"p99 {timings[int(len(timings) * 0.99)] * 1e6:8.0f}us")
+
+    async def run():
+        await measure("in-process", AsyncBankClient(in_process=True))
+        await measure("http (ASGI, no socket)", AsyncBankClient(
+            "http://bank", in_process=False, transport=httpx.ASGITransport(app=central_bank.app)))
+        try:
+            import uvicorn
+        except ImportError:
+            print("loopback http: skipped (uvicorn not installed)")
+            return
+        server = uvicorn.Server(uvicorn.Config(central_bank.app, port=8765, log_level="warning"))
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        while not server.started:
+            await asyncio.sleep(0.05)
+        await measure("http (loopback)", AsyncBankClient("http://127.0.0.1:8765", in_process=False))
+        server.should_exit = True
+
+    asyncio.run(run())
+
+
+def bench_renew(args):
+    """Monthly plan grants: set-based renewal chunks vs one deposit per account.
+
+    --rows accounts are due; the per-account path (a /deposit-style
+    write per account through the ledger writer) runs on --ops of them
+    and is extrapolated.
+    """
+    import central_bank
+    from pricing import ACCOUNT_TYPES
+    from shared.bank_renewals import renew_due
+
+    db = central_bank.shards.pools[0]
+    plans = list(ACCOUNT_TYPES)
+    due = int(time.time() * 1000) - 1000
+    with db.transaction() as c:
+        c.execute('''WITH RECURSIVE seq(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM seq LIMIT ?)
+                     INSERT INTO accounts (email, tokens, plan, version, renews_at)
+                     SELECT 'user' || i || '@renew.test', 0, json_extract(?, '$[' || (i % ?) || ']'),
+                            1, ? FROM seq''', (args.rows, json.dumps(plans), len(plans), due))
+    print(f"{args.rows} accounts due")
+
+    writer = central_bank.shards.writers[0]
+    start = time.perf_counter()
+    for i in range(1, args.ops + 1):
+        plan = plans[i % len(plans)]
+        writer.run(central_bank.apply_deposit, central_bank.Deposit(
+            email=f"user{i}@renew.test", tokens=ACCOUNT_TYPES[plan]["tokens"],
+            payment_id=f"renew-{i}"))
+    per_account = time.perf_counter() - start
+    report("deposit per account", args.ops, per_account)
+    print(f"{'':<28} ~{per_account / args.ops * args.rows:.0f}s for all {args.rows} accounts")
+
+    for chunk in (1000, 5000, 20000):
+        with db.transaction() as c:
+            c.execute('UPDATE accounts SET renews_at = ?', (due,))
+        start = time.perf_counter()
+        renewed = 0
+        while True:
+            result = writer.run(renew_due, due, chunk)
+            if not result["accounts"]:
+                break
+            renewed += result["accounts"]
+        report(f"set-based, chunk {chunk}", renewed, time.perf_counter() - start)
+    for problem in check_ledger():
+        print(f"FAIL: {problem}")
+
+
+def bench_limits(args):
+    """A runaway client hammers one account while others keep spending.
+
+    Rejected spends should cost far less than real ones, and the
+    well-behaved accounts should not see any 429s.
+    """
+    import central_bank
+    from fastapi import HTTPException
+    from shared.bank_limits import RateLimiter
+
+    central_bank.limiter = RateLimiter(central_bank._plan_of, enabled=True)
+    hot = "runaway@bench.test"
+    calm = [f"calm{i}@bench.test" for i in range(args.threads)]
+    for email in [hot, *calm]:
+        central_bank.deposit_funds(central_bank.Deposit(
+            email=email, tokens=args.ops, payment_id=f"limits-{email}"))
+
+    outcomes = {}
+
+    def hammer(worker):
+        for _ in range(worker, args.ops, args.threads):
+            start = time.perf_counter()
+            try:
+                central_bank.spend_tokens(central_bank.SpendRequest(
+                    email=hot, app_id="prompt_wizard", tokens=1, description="runaway"))
+                status = 200
+            except HTTPException as e:
+                status = e.status_code
+            outcomes.setdefault(("runaway", status), []).append(time.perf_counter() - start)
+        # One spend per calm account, within its burst
+        start = time.perf_counter()
+        try:
+            central_bank.spend_tokens(central_bank.SpendRequest(
+                email=calm[worker], app_id="hook_wizard", tokens=1, description="calm"))
+            status = 200
+        except HTTPException as e:
+            status = e.status_code
+        outcomes.setdefault(("calm", status), []).append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=hammer, args=(w,)) for w in range(args.threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    report(f"spend x{args.threads} threads", args.ops + len(calm), time.perf_counter() - start)
+    for (who, status), times in sorted(outcomes.items()):
+        times.sort()
+        print(f"{who:<8} {status}  {len(times):>7} calls  median {times[len(times) // 2] * 1e6:8.0f}us")
+    print(central_bank.limiter.stats(3))
+
+    problems = check_ledger()
+    if ("calm", 429) in outcomes:
+        problems.append("well-behaved accounts were rate limited")
+    problems += _batch_limit_checks(central_bank)
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    if not problems:
+        print("OK: runaway account throttled, others unaffected, ledger sums match")
+    return 1 if problems else 0
+
+
+def _batch_limit_checks(central_bank):
+    """A batch bigger than its account's bucket passes on a full bucket, and
+    the 429 after it asks for no longer than a refill"""
+    from fastapi import HTTPException
+    from shared.bank_limits import plan_limit
+
+    problems = []
+    email = f"batch-{secrets.token_hex(4)}@bench.test"
+    capacity, rate = plan_limit("free")
+    central_bank.deposit_funds(central_bank.Deposit(email=email, tokens=1000, payment_id=f"limits-{email}"))
+    batch = central_bank.SpendBatch(items=[
+        central_bank.SpendRequest(email=email, app_id="prompt_wizard", tokens=1, description="batch")
+        for _ in range(int(capacity) + 2)])
+    try:
+        central_bank.spend_batch(batch)
+    except HTTPException as e:
+        problems.append(f"batch of {len(batch.items)} on a full bucket of {capacity}: got {e.status_code}")
+    try:
+        central_bank.spend_batch(batch)
+        problems.append("second batch on an empty bucket was not rate limited")
+    except HTTPException as e:
+        if e.status_code != 429 or int(e.headers["Retry-After"]) > math.ceil(capacity / rate):
+            problems.append(f"second batch: got {e.status_code} {e.headers}, "
+                            f"expected 429 within {capacity / rate:.0f}s")
+    return problems
+
+
+def _expect(problems, label, status, call):
+    """Run call(), expecting an HTTPException with `status`; None means it must succeed.
+
+    A request model that refuses its fields counts as the 422 FastAPI would send.
+    """
+    from fastapi import HTTPException
+    from pydantic import ValidationError
+    try:
+        result = call()
+    except ValidationError as e:
+        e = HTTPException(status_code=422, detail=e.errors())
+        if status != 422:
+            problems.append(f"{label}: got 422 {e.detail}, expected {status or 'success'}")
+        return e.detail
+    except HTTPException as e:
+        if e.status_code != status:
+            problems.append(f"{label}: got {e.status_code} {e.detail}, expected {status or 'success'}")
+        return e.detail
+    if status is not None:
+        problems.append(f"{label}: succeeded, expected {status}")
+    return result
+
+
+def conformance_checks(storage, tag, threads):
+    """The rules every BankStorage follows; returns the ones it broke"""
+    from central_bank import HOLD_TTL_SECONDS, CaptureRequest, Deposit, HoldRequest, SpendRequest
+    problems = []
+    email = f"{tag}@conformance.test"
+
+    def check(label, ok):
+        if not ok:
+            problems.append(label)
+
+    check("unknown account is empty", storage.account(email) == (0, 0, 0))
+    paid = _expect(problems, "deposit", None, lambda: storage.deposit(
+        Deposit(email=email, tokens=100, payment_id=f"{tag}-1")))
+    check("deposit returns the new balance", paid["new_balance"] == 100)
+    check("deposit returns the account state", paid["_accounts"][0][:3] == (email, 100, 0))
+    again = _expect(problems, "repeated payment", None, lambda: storage.deposit(
+        Deposit(email=email, tokens=100, payment_id=f"{tag}-1")))
+    check("repeated payment replays", again.get("_replayed") and again["new_balance"] == 100)
+    _expect(problems, "reused payment_id", 422, lambda: storage.deposit(
+        Deposit(email=email, tokens=5, payment_id=f"{tag}-1")))
+    check("repeated payment credits once", storage.account(email)[0] == 100)
+
+    spend = SpendRequest(email=email, app_id="prompt_wizard", tokens=30, description="spend")
+    check("spend returns what remains",
+          _expect(problems, "spend", None, lambda: storage.spend(spend, f"{tag}-k"))["remaining"] == 70)
+    check("repeated key replays",
+          _expect(problems, "repeated key", None, lambda: storage.spend(spend, f"{tag}-k")).get("_replayed"))
+    _expect(problems, "reused key", 422, lambda: storage.spend(
+        SpendRequest(email=email, app_id="prompt_wizard", tokens=1, description="other"), f"{tag}-k"))
+    _expect(problems, "overspend", 402, lambda: storage.spend(
+        SpendRequest(email=email, app_id="prompt_wizard", tokens=71, description="too much")))
+    _expect(problems, "spend from unknown account", 402, lambda: storage.spend(
+        SpendRequest(email=f"nobody-{email}", app_id="prompt_wizard", tokens=1, description="x")))
+    version = storage.account(email)[2]
+    check("failed writes change nothing", storage.account(email) == (70, 0, version))
+    for tokens in (0, -1000):
+        _expect(problems, f"spend of {tokens} tokens", 422, lambda: storage.spend(
+            SpendRequest(email=email, app_id="prompt_wizard", tokens=tokens, description="x")))
+        _expect(problems, f"deposit of {tokens} tokens", 422, lambda: storage.deposit(
+            Deposit(email=email, tokens=tokens, payment_id=f"{tag}-{tokens}")))
+    for tokens, ttl in ((0, 60), (-100, 60), (1, 0), (1, 10 ** 6)):
+        _expect(problems, f"hold of {tokens} tokens for {ttl}s", 422, lambda: storage.reserve(
+            HoldRequest(email=email, app_id="hook_wizard", tokens=tokens, ttl_seconds=ttl)))
+
+    hold = _expect(problems, "reserve", None, lambda: storage.reserve(
+        HoldRequest(email=email, app_id="hook_wizard", tokens=50, description="hold")))
+    check("reserve returns what is available", hold["available"] == 20)
+    check("hold expiry is reported in epoch seconds",
+          abs(hold["expires_at"] - time.time() - HOLD_TTL_SECONDS) < 60)
+    check("held tokens are not spendable", _expect(problems, "spend held tokens", 402,
+          lambda: storage.spend(SpendRequest(email=email, app_id="prompt_wizard", tokens=21,
+                                             description="held"))) is not None)
+    detail = _expect(problems, "reserve over available", 402, lambda: storage.reserve(
+        HoldRequest(email=email, app_id="hook_wizard", tokens=21)))
+    check("a refused hold reports what is available", isinstance(detail, dict) and detail["available"] == 20)
+    _expect(problems, "capture more than held", 400,
+            lambda: storage.capture(hold["hold_id"], CaptureRequest(tokens=51)))
+    captured = _expect(problems, "capture", None,
+                       lambda: storage.capture(hold["hold_id"], CaptureRequest(tokens=40)))
+    check("capture spends what was used, returns the rest",
+          captured["remaining"] == 30 and storage.account(email)[:2] == (30, 0))
+    _expect(problems, "capture twice", 404, lambda: storage.capture(hold["hold_id"], CaptureRequest()))
+    _expect(problems, "unknown hold", 404, lambda: storage.release("missing"))
+
+    hold = storage.reserve(HoldRequest(email=email, app_id="hook_wizard", tokens=10))
+    check("release frees the hold", storage.release(hold["hold_id"])["tokens"] == 10
+          and storage.account(email)[:2] == (30, 0))
+    hold = storage.reserve(HoldRequest(email=email, app_id="hook_wizard", tokens=10, ttl_seconds=1))
+    time.sleep(1)
+    _expect(problems, "capture expired hold", 410, lambda: storage.capture(hold["hold_id"], CaptureRequest()))
+    expired = storage.expire_holds()
+    check("expiry releases the hold", (email, 30, 0) in [a[:3] for a in expired["_accounts"]])
+    _expect(problems, "release expired hold", 404, lambda: storage.release(hold["hold_id"]))
+
+    rows = storage.ledger(email, 10)
+    check("ledger is newest first", [row[0] for row in rows] == [-40, -30, 100])
+    check("ledger keeps apps and descriptions", tuple(rows[1][1:3]) == ("prompt_wizard", "spend"))
+    check("ledger honours limit", len(storage.ledger(email, 2)) == 2)
+
+    storage.spend(SpendRequest(email=email, app_id="prompt_wizard", tokens=1, description="key"),
+                  f"payment:{tag}-2")
+    _expect(problems, "payment after a look-alike client key", None, lambda: storage.deposit(
+        Deposit(email=email, tokens=1, payment_id=f"{tag}-2")))
+    check("client keys cannot block payments", storage.account(email)[0] == 30)
+
+    # Racing spends never overdraw: exactly the funded ones succeed
+    racer = f"{tag}-race@conformance.test"
+    storage.deposit(Deposit(email=racer, tokens=threads * 5, payment_id=f"{tag}-race"))
+    spent = []
+
+    def spender():
+        for _ in range(10):
+            try:
+                storage.spend(SpendRequest(email=racer, app_id="prompt_wizard", tokens=1, description="race"))
+                spent.append(1)
+            except Exception:
+                pass
+
+    workers = [threading.Thread(target=spender) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    check("racing spends stop at zero", len(spent) == threads * 5 and storage.account(racer)[0] == 0)
+    return problems + storage.verify()
+
+
+def bench_conformance(args):
+    """Run the storage conformance checks against every engine"""
+    import central_bank
+    from shared.bank_storage import MemoryStorage
+
+    failed = 0
+    for name, storage in [("sqlite", central_bank.SqliteStorage()), ("memory", MemoryStorage())]:
+        start = time.perf_counter()
+        problems = conformance_checks(storage, f"{name}-{secrets.token_hex(4)}", args.threads)
+        print(f"{name:<8} {'FAIL' if problems else 'OK'} in {time.perf_counter() - start:.3f}s")
+        for problem in problems:
+            print(f"  FAIL: {problem}")
+        failed += bool(problems)
+    return 1 if failed else 0
+
+
+def bench_storage(args):
+    """The same spends through each engine, called directly and over HTTP.
+
+    The memory engine's numbers are the cost of everything above the
+    ledger: routing, validation, rate limits, the balance cache.
+    """
+    import central_bank
+    from fastapi.testclient import TestClient
+    from shared.bank_storage import MemoryStorage
+
+    client = TestClient(central_bank.app)
+    emails = [f"engine{i}@bench.test" for i in range(100)]
+    for name, storage in [("sqlite", central_bank.SqliteStorage()), ("memory", MemoryStorage())]:
+        central_bank.storage = storage
+        for email in emails:
+            central_bank.deposit_funds(central_bank.Deposit(
+                email=email, tokens=args.ops * 2, payment_id=f"storage-{name}-{email}"))
+        start = time.perf_counter()
+        for i in range(args.ops):
+            central_bank.spend_tokens(central_bank.SpendRequest(
+                email=emails[i % len(emails)], app_id="prompt_wizard", tokens=1, description="direct"))
+        report(f"{name} spend (direct)", args.ops, time.perf_counter() - start)
+        start = time.perf_counter()
+        for i in range(args.ops):
+            client.post("/spend", json={"email": emails[i % len(emails)], "app_id": "prompt_wizard",
+                                        "tokens": 1, "description": "http"}).raise_for_status()
+        report(f"{name} spend (HTTP)", args.ops, time.perf_counter() - start)
+        start = time.perf_counter()
+        for i in range(args.ops):
+            client.get("/balance", params={"email": emails[i % len(emails)]}).raise_for_status()
+        report(f"{name} balance (HTTP)", args.ops, time.perf_counter() - start)
+        problems = storage.verify()
+        for problem in problems:
+            print(f"FAIL: {problem}")
+        if problems:
+            return 1
+    print("OK: ledger sums match on both engines")
+    return 0
+
+
+BENCHMARKS = {
+    "pool": bench_pool,
+    "stress": bench_stress,
+    "group": bench_group,
+    "history": bench_history,
+    "compact": bench_compact,
+    "replay": bench_replay,
+    "shards": bench_shards,
+    "teams": bench_teams,
+    "client": bench_client,
+    "renew": bench_renew,
+    "limits": bench_limits,
+    "conformance": bench_conformance,
+    "storage": bench_storage,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Central bank benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--ops", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--rows", type=int, default=1000000)
+    args = parser.parse_args(argv)
+    print(f"SQLite {sqlite3.sqlite_version}, scratch dir {WORKDIR}")
+    return BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
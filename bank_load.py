@@ -0,0 +1,280 @@
+# bank_load.py
+"""Load generator for the central bank: how fast can it spend before latency collapses?
+
+Usage: python bank_load.py [--concurrency 64] [--duration 10] [--mix spend=80,deposit=5,balance=15]
+       python bank_load.py --serve [--port 8765]     # bank on a loopback socket (needs uvicorn)
+       python bank_load.py --url http://127.0.0.1:8001 --db bank.db
+       python bank_load.py --compare load-previous.json
+
+By default the bank runs in this process on a scratch database and is
+driven over ASGI, with no socket. --serve puts the same in-process bank
+behind uvicorn on loopback; --url drives a bank that is already running
+(pass its --db to check its ledger too). Each of --concurrency workers
+sends one request at a time, picking /spend, /deposit or /balance by
+--mix, for --duration seconds or --requests requests in total.
+
+At the end every account's balance must equal what the harness itself
+deposited minus what it spent, never below zero, and (in-process or
+with --db) every ledger must sum to its balances. Results go to --out
+as JSON; --compare prints the change from an earlier run.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import secrets
+import sys
+import tempfile
+import threading
+import time
+
+DEFAULT_MIX = "spend=80,deposit=5,balance=15"
+SEED_TOKENS = 1000000
+
+
+def parse_mix(text):
+    """"spend=80,deposit=5,balance=15" -> {"spend": 80, ...}"""
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in ("spend", "deposit", "balance"):
+            raise argparse.ArgumentTypeError(f"unknown operation {kind!r}")
+        mix[kind.strip()] = float(weight)
+    if sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError("mix weights must add up to more than 0")
+    return mix
+
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of a sorted list, in milliseconds"""
+    if not ordered:
+        return None
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000, 3)
+
+
+def summarize(latencies, statuses):
+    ordered = sorted(latencies)
+    return {
+        "requests": len(ordered),
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "p50_ms": percentile(ordered, 50),
+        "p95_ms": percentile(ordered, 95),
+        "p99_ms": percentile(ordered, 99),
+        "max_ms": round(ordered[-1] * 1000, 3) if ordered else None,
+    }
+
+
+class Load:
+    """Request generator plus the harness's own record of what each account should hold"""
+
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+        self.run_id = secrets.token_hex(4)
+        self.emails = [f"load{i}-{self.run_id}@load.test" for i in range(args.accounts)]
+        self.expected = dict.fromkeys(self.emails, 0)
+        # Accounts with a request whose outcome we never saw (transport error)
+        self.uncertain = set()
+        self.kinds, self.weights = zip(*args.mix.items())
+        self.latencies = {kind: [] for kind in self.kinds}
+        self.statuses = {kind: {} for kind in self.kinds}
+        self.sent = 0
+
+    async def seed(self):
+        for email in self.emails:
+            response = await self.client.post("/deposit", json={
+                "email": email, "tokens": self.args.seed, "payment_id": f"load-{self.run_id}-{email}"})
+            response.raise_for_status()
+            self.expected[email] += self.args.seed
+
+    async def one(self, kind, email):
+        if kind == "spend":
+            tokens = random.randint(1, 5)
+            change = -tokens
+            request = self.client.post("/spend", json={
+                "email": email, "app_id": "prompt_wizard", "tokens": tokens, "description": "load"})
+        elif kind == "deposit":
+            change = random.randint(1, 100)
+            request = self.client.post("/deposit", json={
+                "email": email, "tokens": change, "payment_id": f"load-{secrets.token_hex(8)}"})
+        else:
+            change = 0
+            request = self.client.get("/balance", params={"email": email})
+        start = time.perf_counter()
+        try:
+            response = await request
+            status = response.status_code
+        except Exception as e:
+            status = type(e).__name__
+            self.uncertain.add(email)
+        self.latencies[kind].append(time.perf_counter() - start)
+        self.statuses[kind][status] = self.statuses[kind].get(status, 0) + 1
+        if status == 200:
+            self.expected[email] += change
+
+    async def worker(self, deadline):
+        while time.perf_counter() < deadline:
+            if self.args.requests and self.sent >= self.args.requests:
+                return
+            self.sent += 1
+            kind = random.choices(self.kinds, self.weights)[0]
+            await self.one(kind, random.choice(self.emails))
+
+    async def run(self):
+        await self.seed()
+        start = time.perf_counter()
+        deadline = float("inf") if self.args.requests else start + self.args.duration
+        await asyncio.gather(*(self.worker(deadline) for _ in range(self.args.concurrency)))
+        return time.perf_counter() - start
+
+    async def check_balances(self):
+        """Balances the bank reports against what the harness saw succeed"""
+        problems = []
+        for email in self.emails:
+            if email in self.uncertain:
+                continue
+            account = (await self.client.get("/balance", params={"email": email})).json()
+            if account["balance"] < 0:
+                problems.append(f"negative balance {email}: {account['balance']}")
+            if account["balance"] != self.expected[email]:
+                problems.append(f"balance {email}: bank says {account['balance']}, "
+                                f"harness expected {self.expected[email]}")
+        return problems
+
+
+def compare(previous, current):
+    """Print throughput and latency changes from an earlier result file"""
+    print(f"compared with {previous['started_at']}:")
+    before, after = previous["throughput"], current["throughput"]
+    print(f"  throughput {before:10.1f} -> {after:10.1f} req/sec ({(after / before - 1) * 100:+.1f}%)")
+    for kind, now in current["operations"].items():
+        then = previous["operations"].get(kind)
+        if not then:
+            continue
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            if then[key] and now[key]:
+                print(f"  {kind:<8} {key:<7} {then[key]:9.2f} -> {now[key]:9.2f} "
+                      f"({(now[key] / then[key] - 1) * 100:+.1f}%)")
+
+
+def start_server(app, port):
+    """Run app under uvicorn on loopback in a daemon thread"""
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit("--serve needs uvicorn (pip install uvicorn)")
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the central bank")
+    parser.add_argument("--concurrency", type=int, default=64, help="requests in flight")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run")
+    parser.add_argument("--requests", type=int, help="stop after this many requests instead")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                        help=f"operation weights (default {DEFAULT_MIX})")
+    parser.add_argument("--accounts", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=SEED_TOKENS, help="tokens each account starts with")
+    parser.add_argument("--url", help="drive a running bank instead of an in-process one")
+    parser.add_argument("--serve", action="store_true", help="in-process bank behind uvicorn")
+    parser.add_argument("--port", type=int, default=8765, help="--serve port")
+    parser.add_argument("--db", help="bank database (in-process default: a scratch file)")
+    parser.add_argument("--shards", type=int, help="shard count (default BANK_SHARDS)")
+    parser.add_argument("--out", help="result file (default load-<time>.json)")
+    parser.add_argument("--compare", help="earlier result file to compare with")
+    args = parser.parse_args(argv)
+
+    # The bank reads its storage settings when it is imported; by
+    # default load never touches a real bank.db
+    os.environ["BANK_DB_PATH"] = args.db or os.path.join(tempfile.mkdtemp(prefix="bank_load_"), "bank.db")
+    if args.shards:
+        os.environ["BANK_SHARDS"] = str(args.shards)
+    # One process sending everything would trip its own per-account limits
+    if not args.url:
+        os.environ.setdefault("BANK_RATE_LIMITS", "off")
+    import httpx
+
+    central_bank = None
+    if not args.url or args.db:
+        import central_bank
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    server = None
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, limits=limits, timeout=30)
+        target = args.url
+    elif args.serve:
+        server = start_server(central_bank.app, args.port)
+        target = f"http://127.0.0.1:{args.port}"
+        client = httpx.AsyncClient(base_url=target, limits=limits, timeout=30)
+    else:
+        target = "asgi"
+        client = httpx.AsyncClient(base_url="http://bank", transport=httpx.ASGITransport(app=central_bank.app))
+
+    async def run():
+        async with client:
+            load = Load(client, args)
+            elapsed = await load.run()
+            return load, elapsed, await load.check_balances()
+
+    started_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+    try:
+        load, elapsed, problems = asyncio.run(run())
+    except httpx.TransportError as e:
+        sys.exit(f"cannot reach the bank at {target}: {e!r}")
+    if central_bank is not None:
+        # In-process the bank is idle now; over a socket only --db's own ledger is read
+        problems += central_bank.storage.verify()
+    if server is not None:
+        server.should_exit = True
+
+    total = sum(len(latencies) for latencies in load.latencies.values())
+    statuses = {}
+    for counts in load.statuses.values():
+        for status, count in counts.items():
+            statuses[status] = statuses.get(status, 0) + count
+    result = {
+        "started_at": started_at,
+        "target": target,
+        "config": {"concurrency": args.concurrency, "duration": args.duration, "requests": args.requests,
+                   "mix": args.mix, "accounts": args.accounts, "shards": int(os.getenv("BANK_SHARDS", "1")),
+                   "storage": os.getenv("BANK_STORAGE", "sqlite")},
+        "elapsed": round(elapsed, 3),
+        "throughput": round(total / elapsed, 1),
+        "operations": {kind: summarize(load.latencies[kind], load.statuses[kind]) for kind in load.kinds},
+        "overall": summarize([t for latencies in load.latencies.values() for t in latencies], statuses),
+        "invariants": {"ledger_checked": central_bank is not None,
+                       "unverified_accounts": len(load.uncertain), "problems": problems},
+    }
+
+    print(f"{target}: {total} requests in {elapsed:.2f}s, {result['throughput']:.0f} req/sec, "
+          f"concurrency {args.concurrency}")
+    for kind, stats in [*result["operations"].items(), ("all", result["overall"])]:
+        if not stats["requests"]:
+            continue
+        print(f"{kind:<8} {stats['requests']:>8}  p50 {stats['p50_ms']:8.2f}ms  p95 {stats['p95_ms']:8.2f}ms  "
+              f"p99 {stats['p99_ms']:8.2f}ms  {stats['statuses']}")
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    if not problems:
+        checked = "balances and ledger sums match" if central_bank else "balances match (no --db, ledger not read)"
+        print(f"OK: no negative balances, {checked}")
+
+    out = args.out or f"load-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(out, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"results saved to {out}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), result)
+    if central_bank is not None:
+        central_bank.shards.stop()
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,89 +1,1422 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-import sqlite3
+from fastapi import FastAPI, Header, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, field_validator
+from typing import Annotated, List, Literal, Optional
+import asyncio
+import base64
+import csv
+import io
+import json
+import math
+import random
 import secrets
-from datetime import datetime, timedelta
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import date, datetime, timedelta, timezone
+from pricing import ACCOUNT_TYPES
+from shared.bank_cache import BalanceCache
+from shared.bank_db import pool, migrate
+from shared.bank_events import BalanceEvents
+from shared.bank_jobs import PeriodicJobs
+from shared.bank_limits import RateLimiter
+from shared.bank_ledger import (RECON_CHUNK, get_meta, ledger_emails, record_reconciliation,
+                                 snapshot_balances, verify_accounts)
+from shared.bank_replica import REPLICA_SECONDS, Replica
+from shared.bank_renewals import RENEWAL_CHUNK, ROLLOVER, ROLLOVER_CAP, renew_due
+from shared.bank_schema import DAY_MS, MIGRATIONS, SQL_ADD_USAGE, SQL_ADD_USAGE_ROWS
+from shared.bank_shards import SHARD_COUNT, ShardRouter
+from shared.bank_storage import (STORAGE_ENGINE, BankStorage, MemoryStorage, client_key,
+                                 request_fingerprint)
 
 app = FastAPI()
 
+# Accounts are hash-partitioned over BANK_SHARDS database files (just
+# bank.db by default). Each shard's writes go through its own thread
+# that group-commits them.
+shards = ShardRouter(pools=[pool] if SHARD_COUNT == 1 else None)
+# Read-only copies of the shards, refreshed every REPLICA_SECONDS, for
+# reads that scan a lot and can be a few minutes stale (/usage, exports)
+replicas = [Replica(db) for db in shards.pools]
+
+# Balances as of the last committed write; see _write_through
+balance_cache = BalanceCache()
+# Wakes /balance/stream clients when an account they watch changes
+balance_events = BalanceEvents()
+
+# Hold expiry, balance snapshots; started by the first write
+jobs = PeriodicJobs()
+
+# Statements are module constants so the pooled connections reuse their
+# compiled form from sqlite3's per-connection statement cache.
+# Every write to accounts bumps accounts.version and returns the new
+# (tokens, held, version) for the balance cache.
+SQL_CREDIT = '''INSERT INTO accounts (email, tokens, version) VALUES (?, ?, 1)
+                ON CONFLICT(email) DO UPDATE SET tokens = tokens + excluded.tokens,
+                                                 version = version + 1
+                RETURNING tokens, held, version, plan'''
+# Conditional debit: no row comes back when the balance is too low.
+# Tokens reserved by holds (accounts.held) are not spendable.
+SQL_DEBIT = '''UPDATE accounts SET tokens = tokens - ?, version = version + 1
+               WHERE email = ? AND tokens - held >= ?
+               RETURNING tokens, held, version, plan'''
+SQL_BALANCE = 'SELECT tokens FROM accounts WHERE email = ?'
+SQL_ACCOUNT = 'SELECT tokens, held, version FROM accounts WHERE email = ?'
+SQL_RECORD = 'INSERT INTO transactions (email, amount, app_id, description, ts) VALUES (?, ?, ?, ?, ?)'
+SQL_APP_ID = 'SELECT id FROM apps WHERE name = ?'
+SQL_ADD_APP = 'INSERT INTO apps (name) VALUES (?) RETURNING id'
+
+SQL_RESERVE = '''UPDATE accounts SET held = held + ?, version = version + 1
+                 WHERE email = ? AND tokens - held >= ?
+                 RETURNING tokens, held, version'''
+SQL_ADD_HOLD = 'INSERT INTO holds VALUES (?, ?, ?, ?, ?, ?)'
+SQL_GET_HOLD = 'SELECT email, app_id, tokens, description, expires_at FROM holds WHERE id = ?'
+SQL_DROP_HOLD = 'DELETE FROM holds WHERE id = ?'
+SQL_CAPTURE = '''UPDATE accounts SET tokens = tokens - ?, held = held - ?, version = version + 1
+                 WHERE email = ? RETURNING tokens, held, version, plan'''
+SQL_UNHOLD = '''UPDATE accounts SET held = held - ?, version = version + 1
+                WHERE email = ? RETURNING tokens, held, version'''
+
+SQL_GET_KEY = 'SELECT request_hash, response FROM idempotency_keys WHERE key = ? AND expires_at > ?'
+# Expired rows may linger until the sweep, so a reused key overwrites them
+SQL_PUT_KEY = '''INSERT INTO idempotency_keys VALUES (?, ?, ?, ?)
+                 ON CONFLICT (key) DO UPDATE SET request_hash = excluded.request_hash,
+                                                 response = excluded.response,
+                                                 expires_at = excluded.expires_at'''
+
+# Default and longest lifetime of a hold, and how often expired ones are swept
+HOLD_TTL_SECONDS = 120
+MAX_HOLD_TTL_SECONDS = 3600
+HOLD_SWEEP_SECONDS = 15
+# How often new ledger rows are folded into balance_snapshots
+SNAPSHOT_SECONDS = 60
+# How often the reconciliation job runs, and most ledger rows per run
+RECON_SECONDS = 300
+RECON_MAX_ROWS = 500000
+# How long an Idempotency-Key answers repeats, and how long a Stripe
+# payment_id is remembered (Stripe redelivers webhooks for days)
+IDEMPOTENCY_TTL_SECONDS = 24 * 3600
+PAYMENT_KEY_TTL_SECONDS = 90 * 24 * 3600
+# How long a team operation's claim on its key holds off repeats (see
+# _striped_once); well past a client's deadline. A claim whose process
+# died is taken over by the next repeat after that.
+IDEMPOTENCY_CLAIM_SECONDS = 30
+IDEMPOTENCY_SWEEP_SECONDS = 300
+# How often accounts due a monthly plan grant are renewed
+RENEWAL_SECONDS = 3600
+
+# usage_daily.day counts days since 1970-01-01
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# Interned app ids; only committed rows are cached (see _app_id)
+_app_ids = {}
+
 # Bank database setup
-def init_bank():
-    conn = sqlite3.connect('bank.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS accounts
-                 (email TEXT PRIMARY KEY, tokens INTEGER DEFAULT 0)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS transactions
-                 (id TEXT, email TEXT, amount INTEGER, description TEXT, timestamp DATETIME)''')
-    conn.commit()
-    conn.close()
-
-init_bank()
+def init_bank(db=None):
+    """Migrate one database, or every shard, and load the shared app ids"""
+    dbs = [db] if db else shards.pools
+    for shard in dbs:
+        migrate(shard, MIGRATIONS)
+    # Apps registered at runtime can get different ids on different
+    # shards; only cache the ids every shard agrees on
+    known = [set(shard.connection().execute('SELECT id, name FROM apps')) for shard in dbs]
+    _app_ids.update((name, app_id) for app_id, name in set.intersection(*known))
+    if db is None:
+        _schedule_old_stripes()
+
+# Team stripes opened before they were put on the plan schedule
+SQL_UNSCHEDULED_STRIPES = '''SELECT email FROM accounts
+                              WHERE email >= 'team:' AND email < 'team;' AND stripes IS NULL'''
+
+def _schedule_old_stripes():
+    """Give such stripes their team's stripe count and put them on the schedule, due now"""
+    for shard in shards.pools:
+        for (key,) in shard.connection().execute(SQL_UNSCHEDULED_STRIPES).fetchall():
+            team = key.partition("#")[0]
+            row = shards.pool(team).connection().execute(
+                'SELECT stripes FROM teams WHERE team = ?', (team,)).fetchone()
+            if row is None:
+                continue
+            with shard.transaction("IMMEDIATE") as c:
+                c.execute('UPDATE accounts SET stripes = ?, renews_at = COALESCE(renews_at, ?) WHERE email = ?',
+                          (row[0], _now_ms(), key))
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+def _record(c, email, amount, app_id, description, plan, usage=True):
+    """Append a ledger row and fold it into today's usage rollup"""
+    ts = _now_ms()
+    c.execute(SQL_RECORD, (email, amount, app_id, description, ts))
+    if usage:
+        c.execute(SQL_ADD_USAGE, (ts // DAY_MS, app_id or 0, plan, max(-amount, 0), max(amount, 0)))
+
+def _app_id(c, name: str) -> int:
+    """apps.id for an app name, registering apps not seeded from PRICING"""
+    app_id = _app_ids.get(name)
+    if app_id is None:
+        # Not cached: a row inserted here could still be rolled back
+        row = c.execute(SQL_APP_ID, (name,)).fetchone()
+        app_id = row[0] if row else c.execute(SQL_ADD_APP, (name,)).fetchall()[0][0]
+    return app_id
 
 class Deposit(BaseModel):
     email: str
-    tokens: int
+    tokens: int = Field(gt=0)
     payment_id: str  # From Stripe
 
 class SpendRequest(BaseModel):
     email: str
     app_id: str
-    tokens: int
+    tokens: int = Field(gt=0)
     description: str
 
-@app.post("/deposit")
-def deposit_funds(deposit: Deposit):
-    """When user buys tokens via Stripe"""
-    conn = sqlite3.connect('bank.db')
-    c = conn.cursor()
-    
-    # Add to balance
-    c.execute('INSERT OR IGNORE INTO accounts (email, tokens) VALUES (?, 0)', (deposit.email,))
-    c.execute('UPDATE accounts SET tokens = tokens + ? WHERE email = ?', 
-              (deposit.tokens, deposit.email))
+class HoldRequest(BaseModel):
+    email: str
+    app_id: str
+    tokens: int = Field(gt=0)
+    description: str = ""
+    ttl_seconds: int = Field(HOLD_TTL_SECONDS, ge=1, le=MAX_HOLD_TTL_SECONDS)
+
+class CaptureRequest(BaseModel):
+    tokens: Optional[int] = None  # defaults to the whole hold
+    description: Optional[str] = None
+
+def _replay(c, key, fingerprint):
+    """The stored response for a key seen before, None for a new key"""
+    row = c.execute(SQL_GET_KEY, (key, _now_ms())).fetchone()
+    if row is None:
+        return None
+    if row[0] != fingerprint:
+        raise HTTPException(status_code=422,
+                            detail="Idempotency key was already used for a different request")
+    if row[1] is None:
+        raise HTTPException(status_code=409,
+                            detail="A request with this idempotency key is still in progress")
+    return {**json.loads(row[1]), "_accounts": [], "_replayed": True}
+
+def apply_idempotent(c, key, fingerprint, ttl_seconds, apply, *args):
+    """Run apply(c, *args) once per key; repeats get the first response back.
+
+    The key is stored in the same transaction as the mutation, so a
+    response is on record exactly when its effects are. Failed requests
+    change nothing and are not stored, so they can simply be retried.
+    """
+    stored = _replay(c, key, fingerprint)
+    if stored is not None:
+        return stored
+    result = apply(c, *args)
+    response = {k: v for k, v in result.items() if not k.startswith("_")}
+    c.execute(SQL_PUT_KEY, (key, fingerprint, json.dumps(response), _now_ms() + ttl_seconds * 1000))
+    return result
+
+def apply_claim_key(c, key, fingerprint, lease_seconds):
+    """Mark a key as in progress for lease_seconds, or return its stored response (see _striped_once).
+
+    A claim past its lease reads as no key at all, so it is simply claimed again.
+    """
+    stored = _replay(c, key, fingerprint)
+    if stored is None:
+        c.execute(SQL_PUT_KEY, (key, fingerprint, None, _now_ms() + lease_seconds * 1000))
+    return stored
+
+def apply_finish_key(c, key, response, ttl_seconds=IDEMPOTENCY_TTL_SECONDS):
+    """Store a claimed key's response for ttl_seconds, or drop the claim (response None)"""
+    if response is None:
+        c.execute('DELETE FROM idempotency_keys WHERE key = ?', (key,))
+    else:
+        c.execute('UPDATE idempotency_keys SET response = ?, expires_at = ? WHERE key = ?',
+                  (json.dumps(response), _now_ms() + ttl_seconds * 1000, key))
+
+def expire_idempotency_keys(c, limit=10000):
+    """Drop up to `limit` expired keys; returns how many went"""
+    return c.execute('''DELETE FROM idempotency_keys WHERE key IN
+                         (SELECT key FROM idempotency_keys WHERE expires_at <= ? LIMIT ?)''',
+                     (_now_ms(), limit)).rowcount
+
+def apply_deposit(c, deposit: Deposit):
+    """Credit a deposit on connection c (caller owns the transaction).
+
+    payment_id is the deposit's idempotency key: a repeated payment gets
+    the first response back and credits nothing.
+    """
+    return apply_idempotent(c, f"payment:{deposit.payment_id}",
+                            request_fingerprint("deposit", deposit),
+                            PAYMENT_KEY_TTL_SECONDS, _credit_deposit, deposit)
+
+def _credit_deposit(c, deposit: Deposit):
+    # Add to balance, opening the account if needed
+    new_balance, held, version, plan = c.execute(SQL_CREDIT, (deposit.email, deposit.tokens)).fetchall()[0]
     
     # Record transaction
-    tx_id = secrets.token_hex(8)
-    c.execute('INSERT INTO transactions VALUES (?, ?, ?, ?, ?)',
-              (tx_id, deposit.email, deposit.tokens, 
-               f"Purchase via {deposit.payment_id}", datetime.utcnow()))
+    _record(c, deposit.email, deposit.tokens, None, f"Purchase via {deposit.payment_id}", plan)
+    return {"status": "deposited", "new_balance": new_balance,
+            "_accounts": [(deposit.email, new_balance, held, version)]}
+
+def apply_deposit_rows(c, deposits):
+    """Credit many deposits on one shard with a few executemany calls.
+
+    Same effects as apply_deposit for each item (balance, ledger row,
+    usage, stored payment key and response), only set at a time; used
+    by bank_import.py. Payments seen before, or repeated within
+    `deposits`, are skipped; one reused with different details is
+    reported as a conflict.
+    """
+    now = _now_ms()
+    fresh, duplicates, conflicts, seen = [], 0, [], {}
+    stored = dict(c.execute('''SELECT key, request_hash FROM idempotency_keys
+                               WHERE key IN (SELECT value FROM json_each(?)) AND expires_at > ?''',
+                            (json.dumps([f"payment:{d.payment_id}" for d in deposits]), now)))
+    for deposit in deposits:
+        key, fingerprint = f"payment:{deposit.payment_id}", request_fingerprint("deposit", deposit)
+        known = stored.get(key) or seen.get(key)
+        if known is None:
+            seen[key] = fingerprint
+            fresh.append((deposit, key, fingerprint))
+        elif known == fingerprint:
+            duplicates += 1
+        else:
+            conflicts.append(deposit.payment_id)
+    if not fresh:
+        return {"applied": 0, "tokens": 0, "duplicates": duplicates, "conflicts": conflicts,
+                "_accounts": []}
+
+    c.executemany(SQL_CREDIT, ((d.email, d.tokens) for d, _, _ in fresh))
+    c.executemany(SQL_RECORD, ((d.email, d.tokens, None, f"Purchase via {d.payment_id}", now)
+                               for d, _, _ in fresh))
+    emails = json.dumps(sorted({d.email for d, _, _ in fresh}))
+    accounts = c.execute('''SELECT email, tokens, held, version, plan FROM accounts
+                            WHERE email IN (SELECT value FROM json_each(?))''', (emails,)).fetchall()
+    plans = {email: plan for email, _, _, _, plan in accounts}
+    usage = {}
+    for deposit, _, _ in fresh:
+        totals = usage.setdefault(plans[deposit.email], [0, 0])
+        totals[0] += deposit.tokens
+        totals[1] += 1
+    c.executemany(SQL_ADD_USAGE_ROWS, ((now // DAY_MS, 0, plan, 0, tokens, count)
+                                       for plan, (tokens, count) in usage.items()))
+
+    # Each payment's stored response carries the balance right after it,
+    # i.e. the final balance less the deposits that came after it
+    balances = {email: tokens for email, tokens, _, _, _ in accounts}
+    keys = []
+    for deposit, key, fingerprint in reversed(fresh):
+        response = {"status": "deposited", "new_balance": balances[deposit.email]}
+        balances[deposit.email] -= deposit.tokens
+        keys.append((key, fingerprint, json.dumps(response), now + PAYMENT_KEY_TTL_SECONDS * 1000))
+    c.executemany(SQL_PUT_KEY, keys)
+    return {"applied": len(fresh), "tokens": sum(d.tokens for d, _, _ in fresh),
+            "duplicates": duplicates, "conflicts": conflicts,
+            "_accounts": [account[:4] for account in accounts]}
+
+def apply_spend(c, spend: SpendRequest):
+    """Debit a spend on connection c (caller owns the transaction)"""
+    # Check and deduct in one statement; the writer's BEGIN IMMEDIATE
+    # means no other spender can interleave
+    result = c.execute(SQL_DEBIT, (spend.tokens, spend.email, spend.tokens)).fetchall()
+    if not result:
+        raise HTTPException(status_code=402, detail="Insufficient tokens")
+    remaining, held, version, plan = result[0]
     
-    conn.commit()
-    conn.close()
-    return {"status": "deposited", "new_balance": get_balance(deposit.email)}
+    # Record spend
+    _record(c, spend.email, -spend.tokens, _app_id(c, spend.app_id), spend.description, plan)
+    return {"status": "spent", "remaining": remaining,
+            "_accounts": [(spend.email, remaining, held, version)]}
+
+# Items per batch; a batch holds its shard's writer until it commits
+MAX_BATCH_ITEMS = 500
+
+class SpendBatch(BaseModel):
+    items: List[SpendRequest] = Field(max_length=MAX_BATCH_ITEMS)
+    mode: Literal["all_or_nothing", "best_effort"] = "all_or_nothing"
+
+class DepositBatch(BaseModel):
+    items: List[Deposit] = Field(max_length=MAX_BATCH_ITEMS)
+    mode: Literal["all_or_nothing", "best_effort"] = "all_or_nothing"
+
+def apply_batch(c, apply, batch):
+    """Apply every item of a batch on connection c with per-item results.
+
+    In all_or_nothing mode the first failing item aborts the batch with
+    its status code; in best_effort mode failed items are reported and
+    skipped while the rest are kept.
+    """
+    results = []
+    accounts = {}
+    for index, item in enumerate(batch.items):
+        c.execute("SAVEPOINT batch_item")
+        try:
+            result = apply(c, item)
+        except HTTPException as e:
+            c.execute("ROLLBACK TO batch_item")
+            c.execute("RELEASE batch_item")
+            if batch.mode == "all_or_nothing":
+                raise HTTPException(status_code=e.status_code,
+                                    detail={"failed_index": index, "error": e.detail})
+            results.append({"index": index, "status": "failed", "error": e.detail})
+            continue
+        c.execute("RELEASE batch_item")
+        # Later items see later versions, so the last state per email wins
+        accounts.update((state[0], state) for state in result.pop("_accounts"))
+        if result.pop("_replayed", False):
+            result["replayed"] = True
+        results.append({"index": index, **result})
+
+    balances = {}
+    for email in {item.email for item in batch.items}:
+        row = c.execute(SQL_BALANCE, (email,)).fetchone()
+        balances[email] = row[0] if row else 0
+    return {
+        "status": "ok" if all(r["status"] != "failed" for r in results) else "partial",
+        "results": results,
+        "balances": balances,
+        "_accounts": list(accounts.values())
+    }
+
+def apply_reserve(c, hold: HoldRequest):
+    """Set tokens aside for a pending operation"""
+    result = c.execute(SQL_RESERVE, (hold.tokens, hold.email, hold.tokens)).fetchall()
+    if not result:
+        account = c.execute(SQL_ACCOUNT, (hold.email,)).fetchone()
+        available = account[0] - account[1] if account else 0
+        raise HTTPException(status_code=402,
+                            detail={"error": "Insufficient tokens", "available": available})
+    
+    hold_id = _new_hold_id(hold.email)
+    expires_at = _now_ms() + hold.ttl_seconds * 1000
+    c.execute(SQL_ADD_HOLD, (hold_id, hold.email, hold.app_id, hold.tokens,
+                             hold.description, expires_at))
+    tokens, held, version = result[0]
+    # The API keeps answering in epoch seconds
+    return {"status": "held", "hold_id": hold_id, "tokens": hold.tokens,
+            "available": tokens - held, "expires_at": expires_at / 1000,
+            "_accounts": [(hold.email, tokens, held, version)]}
+
+def _new_hold_id(email):
+    """Random hold id; on a sharded bank it is prefixed with the account's shard"""
+    if shards.count == 1:
+        return secrets.token_hex(8)
+    return f"s{shards.index(email)}-{secrets.token_hex(8)}"
+
+def _hold_writer(hold_id):
+    """Writer of the shard a hold lives on (see _new_hold_id)"""
+    if shards.count == 1:
+        return shards.writers[0]
+    prefix, _, _ = hold_id.partition("-")
+    if not (prefix[:1] == "s" and prefix[1:].isdigit() and int(prefix[1:]) < shards.count):
+        raise HTTPException(status_code=404, detail="Hold not found")
+    return shards.writers[int(prefix[1:])]
+
+def _take_hold(c, hold_id):
+    """Remove a hold and return its row, or fail if it is gone or expired"""
+    hold = c.execute(SQL_GET_HOLD, (hold_id,)).fetchone()
+    if not hold:
+        raise HTTPException(status_code=404, detail="Hold not found")
+    if hold[4] <= _now_ms():
+        raise HTTPException(status_code=410, detail="Hold expired")
+    c.execute(SQL_DROP_HOLD, (hold_id,))
+    return hold
+
+def apply_capture(c, hold_id, capture: CaptureRequest):
+    """Turn a hold into a spend, returning any unused part of it"""
+    email, app_id, held, description, _ = _take_hold(c, hold_id)
+    tokens = held if capture.tokens is None else capture.tokens
+    if not 0 <= tokens <= held:
+        raise HTTPException(status_code=400, detail=f"Can capture at most {held} tokens")
+    
+    remaining, still_held, version, plan = c.execute(SQL_CAPTURE, (tokens, held, email)).fetchall()[0]
+    _record(c, email, -tokens, _app_id(c, app_id), capture.description or description, plan)
+    return {"status": "captured", "tokens": tokens, "remaining": remaining,
+            "_accounts": [(email, remaining, still_held, version)]}
+
+def apply_release(c, hold_id):
+    """Give held tokens back without spending them"""
+    email, _, held, _, _ = _take_hold(c, hold_id)
+    tokens, still_held, version = c.execute(SQL_UNHOLD, (held, email)).fetchall()[0]
+    return {"status": "released", "tokens": held,
+            "_accounts": [(email, tokens, still_held, version)]}
+
+def expire_holds(c):
+    """Release every hold past its expiry"""
+    now = _now_ms()
+    expired = c.execute('''SELECT email, SUM(tokens) FROM holds
+                           WHERE expires_at <= ? GROUP BY email''', (now,)).fetchall()
+    accounts = [(email, *c.execute(SQL_UNHOLD, (tokens, email)).fetchall()[0])
+                for email, tokens in expired]
+    c.execute('DELETE FROM holds WHERE expires_at <= ?', (now,))
+    return {"status": "expired", "accounts": len(accounts), "_accounts": accounts}
+
+SQL_LEDGER = '''SELECT t.amount, a.name, t.description, t.ts
+                FROM transactions t LEFT JOIN apps a ON a.id = t.app_id
+                WHERE t.email = ? ORDER BY t.ts DESC, t.id DESC LIMIT ?'''
+# Accounts whose balance is not their snapshot plus later ledger rows,
+# or whose held tokens are not the sum of their holds
+SQL_VERIFY = '''SELECT a.email, a.tokens, a.held,
+                       COALESCE(s.tokens, 0) + (SELECT COALESCE(SUM(t.amount), 0) FROM transactions t
+                                                WHERE t.email = a.email AND t.id > COALESCE(s.tx_id, 0)),
+                       (SELECT COALESCE(SUM(h.tokens), 0) FROM holds h WHERE h.email = a.email)
+                FROM accounts a LEFT JOIN balance_snapshots s ON s.email = a.email'''
+
+class SqliteStorage(BankStorage):
+    """The shard files: each mutation is one apply_* transaction on its shard's writer"""
+
+    def account(self, email):
+        row = shards.pool(email).connection().execute(SQL_ACCOUNT, (email,)).fetchone()
+        return row if row else (0, 0, 0)
+
+    def plan(self, email):
+        # A team's plan is in `teams`
+        c = shards.pool(email).connection()
+        if email.startswith(TEAM_PREFIX):
+            row = c.execute('SELECT plan FROM teams WHERE team = ?', (email,)).fetchone()
+        else:
+            row = c.execute('SELECT plan FROM accounts WHERE email = ?', (email,)).fetchone()
+        return row[0] if row else "free"
+
+    def deposit(self, deposit):
+        return shards.writer(deposit.email).run(apply_deposit, deposit)
+
+    def _once(self, email, key, name, apply, request):
+        writer = shards.writer(email)
+        if not key:
+            return writer.run(apply, request)
+        return writer.run(apply_idempotent, client_key(name, email, key),
+                          request_fingerprint(name, request), IDEMPOTENCY_TTL_SECONDS, apply, request)
+
+    def spend(self, spend, key=None):
+        return self._once(spend.email, key, "spend", apply_spend, spend)
+
+    def reserve(self, hold, key=None):
+        return self._once(hold.email, key, "hold", apply_reserve, hold)
+
+    def capture(self, hold_id, capture):
+        return _hold_writer(hold_id).run(apply_capture, hold_id, capture)
+
+    def release(self, hold_id):
+        return _hold_writer(hold_id).run(apply_release, hold_id)
+
+    def expire_holds(self):
+        accounts = []
+        for writer in shards.writers:
+            accounts += writer.run(expire_holds)["_accounts"]
+        return {"status": "expired", "accounts": len(accounts), "_accounts": accounts}
+
+    def ledger(self, email, limit=50):
+        return shards.pool(email).connection().execute(SQL_LEDGER, (email, limit)).fetchall()
+
+    def verify(self):
+        problems = []
+        for db in shards.pools:
+            for email, tokens, held, total, holds in db.connection().execute(SQL_VERIFY):
+                if tokens < 0:
+                    problems.append(f"negative balance {email}: {tokens}")
+                if tokens != total:
+                    problems.append(f"ledger drift {email}: balance {tokens}, ledger {total}")
+                if held != holds:
+                    problems.append(f"hold drift {email}: held {held}, holds {holds}")
+        return problems
+
+# Where accounts, the ledger and holds live; BANK_STORAGE=memory swaps
+# the shard files for dicts (see shared.bank_storage)
+storage = MemoryStorage() if STORAGE_ENGINE == "memory" else SqliteStorage()
+# The memory engine never opens, creates or migrates a shard file
+if isinstance(storage, SqliteStorage):
+    init_bank()
+
+# What _needs_sqlite refuses on the memory engine (reported by /health)
+SQLITE_ONLY = ["Batches", "Team accounts", "Plans and renewals", "Transaction history and exports",
+               "Usage reports", "Reconciliation reports", "Replicas"]
+
+def _needs_sqlite(feature):
+    """501 for features the in-memory engine does not have, rather than
+    writing them to the shard files behind its back"""
+    if not isinstance(storage, SqliteStorage):
+        raise HTTPException(status_code=501, detail=f"{feature} need BANK_STORAGE=sqlite")
+
+def _sqlite_job(seconds, fn):
+    """jobs.every for jobs that only work on the shard files"""
+    if isinstance(storage, SqliteStorage):
+        jobs.every(seconds, fn)
+
+def _write_through(result, response=None):
+    """Copy the account states a committed mutation returned into the cache (and tell streams)"""
+    jobs.start()
+    for email, tokens, held, version in result.pop("_accounts"):
+        balance_cache.put(email, tokens, held, version)
+        # A team stripe's stream is the team's
+        balance_events.publish(email.split("#")[0] if email.startswith(TEAM_PREFIX) else email)
+    if result.pop("_replayed", False) and response is not None:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+def _plan_of(email):
+    """An account's plan, from whichever engine is in use"""
+    return storage.plan(email)
+
+# Per-account and per-app write rates; see shared.bank_limits
+limiter = RateLimiter(_plan_of)
+
+def _rate_limit(email, app_id):
+    """429 before any database work when the account or the app is over its rate"""
+    _retry_after(limiter.acquire(email, app_id))
+
+def _rate_limit_batch(batch):
+    """_rate_limit for every item of a batch (deposits have no app); all pass or the batch gets 429"""
+    _retry_after(limiter.acquire_many([(item.email, getattr(item, "app_id", None))
+                                       for item in batch.items]))
+
+def _retry_after(wait):
+    if wait:
+        raise HTTPException(status_code=429, detail="Rate limit exceeded",
+                            headers={"Retry-After": str(math.ceil(wait))})
+
+def _striped_once(email, key, name, request, response, run):
+    """Idempotent team operation: claim the key on the team's shard, run, store the response.
+
+    A team operation commits on several shards, so unlike a one-account spend the key
+    cannot share its transaction; a repeat that arrives meanwhile gets 409. If this
+    process dies before storing the response, the claim lapses after
+    IDEMPOTENCY_CLAIM_SECONDS and a repeat runs the operation.
+    """
+    if not key:
+        return run()
+    key = client_key(name, email, key)
+    writer = shards.writer(email)
+    stored = writer.run(apply_claim_key, key, request_fingerprint(name, request), IDEMPOTENCY_CLAIM_SECONDS)
+    if stored is not None:
+        return _write_through(stored, response)
+    try:
+        result = run()
+    except BaseException:
+        writer.run(apply_finish_key, key, None)
+        raise
+    writer.run(apply_finish_key, key, result)
+    return result
+
+# Idempotency-Key request header; FastAPI reads it, direct callers pass it
+IdempotencyKey = Annotated[Optional[str], Header()]
+
+@app.post("/deposit")
+def deposit_funds(deposit: Deposit, response: Response = None):
+    """When user buys tokens via Stripe (a repeated payment_id credits nothing)"""
+    stripes = _team_stripes(deposit.email)
+    if stripes:
+        return _deposit_striped(deposit, stripes)
+    return _write_through(storage.deposit(deposit), response)
 
 @app.post("/spend")
-def spend_tokens(spend: SpendRequest):
+def spend_tokens(spend: SpendRequest, response: Response = None,
+                 idempotency_key: IdempotencyKey = None):
     """When an AI app uses tokens"""
-    conn = sqlite3.connect('bank.db')
-    c = conn.cursor()
+    _rate_limit(spend.email, spend.app_id)
+    stripes = _team_stripes(spend.email)
+    if stripes:
+        return _striped_once(spend.email, idempotency_key, "spend", spend, response,
+                             lambda: _on_stripe(apply_spend, spend, stripes))
+    return _write_through(storage.spend(spend, idempotency_key), response)
+
+def _run_batch(apply, batch):
+    """Run a batch on its shard, or split a best_effort batch across shards"""
+    groups = {}
+    for index, item in enumerate(batch.items):
+        if _team_stripes(item.email):
+            raise HTTPException(status_code=400,
+                                detail={"failed_index": index,
+                                        "error": "Team accounts are not supported in batches"})
+        groups.setdefault(shards.index(item.email), []).append(index)
+    if len(groups) <= 1:
+        return _write_through(shards.writers[next(iter(groups), 0)].run(apply_batch, apply, batch))
+    if batch.mode == "all_or_nothing":
+        raise HTTPException(status_code=400,
+                            detail="all_or_nothing batches must stay on one shard; "
+                                   "use best_effort or split the batch")
+
+    # Each shard commits its part independently, in parallel
+    futures = []
+    for shard, indexes in groups.items():
+        part = type(batch)(items=[batch.items[i] for i in indexes], mode=batch.mode)
+        futures.append((indexes, shards.writers[shard].submit(apply_batch, apply, part)))
+    results, balances = [None] * len(batch.items), {}
+    for indexes, future in futures:
+        part = _write_through(future.result())
+        for result in part["results"]:
+            result["index"] = indexes[result["index"]]
+            results[result["index"]] = result
+        balances.update(part["balances"])
+    return {
+        "status": "ok" if all(r["status"] != "failed" for r in results) else "partial",
+        "results": results,
+        "balances": balances
+    }
+
+@app.post("/deposit/batch")
+def deposit_batch(batch: DepositBatch):
+    """Several deposits in one transaction"""
+    _needs_sqlite("Batches")
+    _rate_limit_batch(batch)
+    return _run_batch(apply_deposit, batch)
+
+@app.post("/spend/batch")
+def spend_batch(batch: SpendBatch):
+    """Several spends (e.g. a bulk thumbnail analysis) in one transaction"""
+    _needs_sqlite("Batches")
+    _rate_limit_batch(batch)
+    return _run_batch(apply_spend, batch)
+
+def sweep_holds():
+    _write_through(storage.expire_holds())
+
+def sweep_idempotency_keys():
+    for writer in shards.writers:
+        while writer.run(expire_idempotency_keys):
+            pass
+
+def take_snapshots():
+    # One chunk per writer mutation keeps each lock hold short
+    for writer in shards.writers:
+        while writer.run(snapshot_balances):
+            pass
+
+def reconcile(max_rows=RECON_MAX_ROWS):
+    """Check accounts touched since each shard's reconciliation checkpoint.
+
+    Each chunk is verified inside a read transaction (WAL readers never
+    block the writer); only the short checkpoint update goes through
+    the shard's writer. At most max_rows ledger rows per shard per call.
+    """
+    return sum(_reconcile_shard(db, writer, max_rows)
+               for db, writer in zip(shards.pools, shards.writers))
+
+def _reconcile_shard(db, writer, max_rows):
+    checked = 0
+    while checked < max_rows:
+        with db.transaction() as c:
+            after = get_meta(c, "recon_tx_id", 0)
+            last = c.execute('SELECT COALESCE(MAX(id), 0) FROM transactions').fetchone()[0]
+            upto = min(after + RECON_CHUNK, last)
+            if upto <= after:
+                break
+            emails = ledger_emails(c, after, upto)
+            mismatches = verify_accounts(c, emails)
+        for email, balance, expected in mismatches:
+            print(f"⚠️ RECONCILIATION: {email} balance {balance} != ledger {expected}")
+        if not writer.run(record_reconciliation, after, upto, emails, mismatches):
+            break
+        checked += upto - after
+    return checked
+
+jobs.every(HOLD_SWEEP_SECONDS, sweep_holds)
+_sqlite_job(SNAPSHOT_SECONDS, take_snapshots)
+_sqlite_job(RECON_SECONDS, reconcile)
+_sqlite_job(IDEMPOTENCY_SWEEP_SECONDS, sweep_idempotency_keys)
+
+def refresh_replicas():
+    for replica in replicas:
+        replica.refresh()
+
+_sqlite_job(REPLICA_SECONDS, refresh_replicas)
+
+@app.post("/holds")
+def reserve_tokens(hold: HoldRequest, response: Response = None,
+                   idempotency_key: IdempotencyKey = None):
+    """Authorize tokens up front for a long-running generation"""
+    _rate_limit(hold.email, hold.app_id)
+    stripes = _team_stripes(hold.email)
+    if stripes:
+        return _striped_once(hold.email, idempotency_key, "hold", hold, response,
+                             lambda: _on_stripe(apply_reserve, hold, stripes))
+    return _write_through(storage.reserve(hold, idempotency_key), response)
+
+@app.post("/holds/{hold_id}/capture")
+def capture_hold(hold_id: str, capture: CaptureRequest = CaptureRequest()):
+    """Settle a hold once the work succeeded"""
+    return _write_through(storage.capture(hold_id, capture))
+
+@app.post("/holds/{hold_id}/release")
+def release_hold(hold_id: str):
+    """Drop a hold when the work failed"""
+    return _write_through(storage.release(hold_id))
+
+# --- Team accounts ------------------------------------------------------
+#
+# A team account ("team:<name>") shares one balance across a whole team,
+# which would make its accounts row the hottest write in the bank. Its
+# balance is instead split over `stripes` ordinary accounts
+# "team:<name>#0" .. "#<stripes - 1>", which the shard router spreads
+# over consecutive shards. A spend or hold lands on one stripe with
+# enough funds, so concurrent spends against one team commit on
+# different writers. Reads sum the stripes; the ledger, snapshots and
+# reconciliation see each stripe as a plain account.
+
+TEAM_PREFIX = "team:"
+TEAM_STRIPES = 8
+MAX_TEAM_STRIPES = 64
+
+# team -> stripe count; teams are never removed or restriped
+_teams = {}
+_team_locks = {}
+
+class TeamRequest(BaseModel):
+    team: str
+    stripes: int = Field(TEAM_STRIPES, ge=1, le=MAX_TEAM_STRIPES)
+    plan: str = "agency"
+
+    @field_validator("plan")
+    @classmethod
+    def _known_plan(cls, plan):
+        if plan not in ACCOUNT_TYPES:
+            raise ValueError(f"Unknown plan; expected one of {', '.join(ACCOUNT_TYPES)}")
+        return plan
+
+def _team_stripes(email):
+    """Stripe count of a team account, None for every other account"""
+    if not email.startswith(TEAM_PREFIX) or "#" in email:
+        return None
+    _needs_sqlite("Team accounts")
+    stripes = _teams.get(email)
+    if stripes is None:
+        row = shards.pool(email).connection().execute(
+            'SELECT stripes FROM teams WHERE team = ?', (email,)).fetchone()
+        if row:
+            stripes = _teams[email] = row[0]
+    return stripes
+
+def _stripe_keys(team, stripes):
+    return [f"{team}#{k}" for k in range(stripes)]
+
+def _for_stripe(request, key):
+    """Copy of a spend/hold/deposit request aimed at one stripe"""
+    return type(request)(**{**vars(request), "email": key})
+
+SQL_OPEN_STRIPE = '''INSERT INTO accounts (email, plan, version, renews_at, stripes) VALUES (?, ?, 1, ?, ?)
+                     ON CONFLICT (email) DO UPDATE SET plan = excluded.plan, version = version + 1,
+                                                       renews_at = COALESCE(renews_at, excluded.renews_at),
+                                                       stripes = excluded.stripes
+                     RETURNING tokens, held, version, renews_at'''
+
+def apply_open_stripe(c, key, plan, stripes):
+    """Open a team stripe on the plan schedule; its share of the first grant is credited now"""
+    now = _now_ms()
+    tokens, held, version, renews_at = c.execute(SQL_OPEN_STRIPE, (key, plan, now, stripes)).fetchall()[0]
+    if renews_at != now:
+        return {"granted": 0, "_accounts": [(key, tokens, held, version)]}
+    result = renew_due(c, now, 1, email=key)
+    return {"granted": result["tokens"], "_accounts": result["_accounts"] or [(key, tokens, held, version)]}
+
+def apply_register_team(c, team, stripes, plan):
+    c.execute('INSERT INTO teams VALUES (?, ?, ?, ?)', (team, stripes, plan, _now_ms()))
+
+def apply_stripe_move(c, sources, target, transfer_id):
+    """Debit team stripes on this shard for a rebalance; credits `target` too if it is here.
+
+    sources is [(key, tokens)]; a stripe that can no longer cover its
+    part is skipped. Returns the tokens taken and not yet credited,
+    which are recorded under transfer_id in stripe_transfers until
+    apply_transfer_credit has run on the target's shard.
+    """
+    moved, accounts = 0, []
+    for key, tokens in sources:
+        result = c.execute(SQL_DEBIT, (tokens, key, tokens)).fetchall()
+        if not result:
+            continue
+        remaining, held, version, plan = result[0]
+        _record(c, key, -tokens, None, f"Team rebalance to {target}", plan, usage=False)
+        accounts.append((key, remaining, held, version))
+        moved += tokens
+    if moved and shards.index(target) == shards.index(sources[0][0]):
+        accounts.append(apply_stripe_credit(c, target, moved)["_accounts"][0])
+        moved = 0
+    if moved:
+        c.execute('INSERT INTO stripe_transfers VALUES (?, ?, ?, ?)', (transfer_id, target, moved, _now_ms()))
+    return {"uncredited": moved, "_accounts": accounts}
+
+def apply_stripe_credit(c, key, tokens):
+    new_balance, held, version, plan = c.execute(SQL_CREDIT, (key, tokens)).fetchall()[0]
+    _record(c, key, tokens, None, "Team rebalance", plan, usage=False)
+    return {"_accounts": [(key, new_balance, held, version)]}
+
+def apply_transfer_credit(c, transfer_id, key, tokens):
+    """Credit a transfer once; its key makes a replay after a crash a no-op"""
+    return apply_idempotent(c, f"transfer:{transfer_id}", f"{key}:{tokens}", PAYMENT_KEY_TTL_SECONDS,
+                            apply_stripe_credit, key, tokens)
+
+def apply_drop_transfer(c, transfer_id):
+    c.execute('DELETE FROM stripe_transfers WHERE id = ?', (transfer_id,))
+
+def _finish_transfer(source, transfer_id, target, tokens):
+    """Credit a recorded transfer on its target's shard, then forget it on `source`'s"""
+    _write_through(shards.writer(target).run(apply_transfer_credit, transfer_id, target, tokens))
+    source.run(apply_drop_transfer, transfer_id)
+
+def replay_transfers():
+    """Finish the rebalance transfers a crash left debited but maybe not credited"""
+    for db, writer in zip(shards.pools, shards.writers):
+        for transfer_id, target, tokens in db.connection().execute(
+                'SELECT id, target, tokens FROM stripe_transfers').fetchall():
+            print(f"Replaying team transfer {transfer_id}: {tokens} tokens to {target}")
+            try:
+                _finish_transfer(writer, transfer_id, target, tokens)
+            except Exception as e:
+                # Left in place for the next start
+                print(f"⚠️ Team transfer {transfer_id} not replayed: {e}")
+
+if isinstance(storage, SqliteStorage):
+    replay_transfers()
+
+def _stripe_available(key):
+    """Tokens a stripe can spend, read from its shard (not the cache)"""
+    row = shards.pool(key).connection().execute(SQL_ACCOUNT, (key,)).fetchone()
+    return row[0] - row[1] if row else 0
+
+def _rebalance(team, keys, tokens):
+    """Gather funds from a team's stripes into one that can cover `tokens`.
+
+    Returns that stripe, or None if the whole team cannot. Moves are
+    ledger rows on both stripes (not counted as usage). Stripes on the
+    target's shard move in one transaction; each other shard's stripes
+    are debited in one transaction, together with a stripe_transfers
+    row, and credited afterwards. A crash in between leaves the row,
+    and replay_transfers finishes the move at the next start.
+    """
+    with _team_locks.setdefault(team, threading.Lock()):
+        available = {key: _stripe_available(key) for key in keys}
+        if sum(max(a, 0) for a in available.values()) < tokens:
+            return None
+        target = max(keys, key=available.get)
+        need = tokens - available[target]
+        by_shard = {}
+        for key in sorted(keys, key=available.get, reverse=True):
+            if need <= 0:
+                break
+            if key == target or available[key] <= 0:
+                continue
+            take = min(available[key], need)
+            by_shard.setdefault(shards.index(key), []).append((key, take))
+            need -= take
+
+        futures = [(shards.writers[shard], transfer_id,
+                    shards.writers[shard].submit(apply_stripe_move, sources, target, transfer_id))
+                   for shard, sources in by_shard.items()
+                   for transfer_id in [secrets.token_hex(8)]]
+        for writer, transfer_id, future in futures:
+            uncredited = _write_through(future.result())["uncredited"]
+            if uncredited:
+                _finish_transfer(writer, transfer_id, target, uncredited)
+        return target
+
+def _team_totals(team, result):
+    """A stripe's spend or hold response, with the team's totals in place of the stripe's"""
+    tokens, held = _account(team)
+    if "remaining" in result:
+        result["remaining"] = tokens
+    if "available" in result:
+        result["available"] = tokens - held
+    return result
+
+def _on_stripe(apply, request, stripes):
+    """Run a spend or hold against a team on one of its stripes.
+
+    Stripes the balance cache says can cover it are tried first, in an
+    order that starts at a random stripe so concurrent callers spread
+    out; failing that, the team is rebalanced onto one stripe.
+    """
+    keys = _stripe_keys(request.email, stripes)
+    start = random.randrange(stripes)
+    for key in keys[start:] + keys[:start]:
+        tokens, held = _account(key)
+        if tokens - held < request.tokens:
+            continue
+        try:
+            return _team_totals(request.email, _write_through(
+                shards.writer(key).run(apply, _for_stripe(request, key))))
+        except HTTPException as e:
+            if e.status_code != 402:
+                raise
+
+    key = _rebalance(request.email, keys, request.tokens)
+    if key is not None:
+        try:
+            return _team_totals(request.email, _write_through(
+                shards.writer(key).run(apply, _for_stripe(request, key))))
+        except HTTPException as e:
+            if e.status_code != 402:
+                raise
+    detail = "Insufficient tokens"
+    if apply is apply_reserve:
+        tokens, held = _account(request.email)
+        detail = {"error": detail, "available": tokens - held}
+    raise HTTPException(status_code=402, detail=detail)
+
+def _deposit_striped(deposit, stripes):
+    """Split a team deposit evenly over its stripes (each stripe commits on its own shard)"""
+    keys = _stripe_keys(deposit.email, stripes)
+    share, extra = divmod(deposit.tokens, stripes)
+    # Each stripe's part is deduplicated on its own shard by "<payment_id>#<k>"
+    futures = [shards.writer(key).submit(apply_deposit, Deposit(
+                   email=key, tokens=share + (k < extra), payment_id=f"{deposit.payment_id}#{k}"))
+               for k, key in enumerate(keys) if share + (k < extra)]
+    for future in futures:
+        _write_through(future.result())
+    return {"status": "deposited", "new_balance": _account(deposit.email)[0]}
+
+@app.post("/teams")
+def create_team(request: TeamRequest):
+    """Open a striped team account (e.g. an agency plan shared by a team)"""
+    _needs_sqlite("Team accounts")
+    if not request.team.startswith(TEAM_PREFIX) or "#" in request.team:
+        raise HTTPException(status_code=400,
+                            detail=f"Team accounts are named {TEAM_PREFIX}<name> (no '#')")
+    if _team_stripes(request.team):
+        raise HTTPException(status_code=409, detail="Team already exists")
     
-    # Check balance
-    c.execute('SELECT tokens FROM accounts WHERE email = ?', (spend.email,))
-    result = c.fetchone()
-    if not result or result[0] < spend.tokens:
-        raise HTTPException(status_code=402, detail="Insufficient tokens")
+    # Stripes first: the team only becomes visible once it is registered
+    keys = _stripe_keys(request.team, request.stripes)
+    granted = 0
+    for future in [shards.writer(key).submit(apply_open_stripe, key, request.plan, request.stripes)
+                   for key in keys]:
+        granted += _write_through(future.result())["granted"]
+    try:
+        shards.writer(request.team).run(apply_register_team, request.team, request.stripes, request.plan)
+    except sqlite3.IntegrityError:
+        raise HTTPException(status_code=409, detail="Team already exists")
+    return {"status": "created", "team": request.team, "stripes": request.stripes, "plan": request.plan,
+            "granted": granted}
+
+@app.get("/teams/{team}")
+def team_balance(team: str):
+    """A team's balance per stripe"""
+    _needs_sqlite("Team accounts")
+    stripes = _team_stripes(team)
+    if not stripes:
+        raise HTTPException(status_code=404, detail="Team not found")
+    parts = [(key, shards.index(key), *_account(key)) for key in _stripe_keys(team, stripes)]
+    return {
+        "team": team,
+        "balance": sum(p[2] for p in parts),
+        "available": sum(p[2] - p[3] for p in parts),
+        "stripes": [{"key": key, "shard": shard, "balance": tokens, "held": held}
+                    for key, shard, tokens, held in parts]
+    }
+
+def _account(email: str):
+    """(tokens, held) for an account, from the balance cache when possible"""
+    stripes = _team_stripes(email)
+    if stripes:
+        parts = [_account(key) for key in _stripe_keys(email, stripes)]
+        return sum(p[0] for p in parts), sum(p[1] for p in parts)
+    state = balance_cache.get(email)
+    if state is None:
+        state = storage.account(email)
+        balance_cache.put(email, *state)
+    return state[0], state[1]
+
+@app.get("/balance")
+def balance(email: str):
+    tokens, held = _account(email)
+    return {"email": email, "balance": tokens, "held": held, "available": tokens - held}
+
+# Seconds between keep-alive comments on an idle balance stream
+STREAM_KEEPALIVE_SECONDS = 15
+
+@app.get("/balance/stream")
+async def balance_stream(email: str):
+    """Server-sent events: the balance now, then again each time it changes.
+
+    Pushed by this process's writes (other workers' writes show once
+    the balance cache entry expires and something touches the account).
+    """
+    if balance_events.full():
+        raise HTTPException(status_code=503, detail="Too many balance streams")
+
+    async def events():
+        changed = balance_events.subscribe(email)
+        try:
+            last = None
+            while True:
+                # A cache miss reads the database; keep that off the event loop
+                current = await asyncio.to_thread(balance, email)
+                if current != last:
+                    last = current
+                    yield f"event: balance\ndata: {json.dumps(current)}\n\n"
+                try:
+                    await asyncio.wait_for(changed.wait(), STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                changed.clear()
+        finally:
+            balance_events.unsubscribe(email, changed)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# --- Plans ----------------------------------------------------------------
+#
+# An account joins the monthly schedule the first time its plan is set
+# (POST /plan): it gets its plan's tokens right away and again every
+# month after, from the renew_plans job. A team joins when it is
+# created, each stripe granted its share (see shared.bank_renewals).
+
+SQL_SET_PLAN = '''INSERT INTO accounts (email, plan, version, renews_at) VALUES (?, ?, 1, ?)
+                  ON CONFLICT (email) DO UPDATE SET plan = excluded.plan, version = version + 1,
+                                                    renews_at = COALESCE(renews_at, excluded.renews_at)
+                  RETURNING tokens, held, version, renews_at'''
+
+class PlanChange(BaseModel):
+    email: str
+    plan: str
+
+def apply_set_plan(c, change: PlanChange):
+    """Move an account to a plan; its first plan is granted immediately"""
+    now = _now_ms()
+    tokens, held, version, renews_at = c.execute(SQL_SET_PLAN, (change.email, change.plan, now)).fetchall()[0]
+    accounts = [(change.email, tokens, held, version)]
+    granted = 0
+    if renews_at == now:
+        result = renew_due(c, now, 1, email=change.email)
+        accounts, granted = result["_accounts"] or accounts, result["tokens"]
+        renews_at = c.execute('SELECT renews_at FROM accounts WHERE email = ?',
+                              (change.email,)).fetchone()[0]
+    return {"status": "ok", "email": change.email, "plan": change.plan, "granted": granted,
+            "balance": accounts[0][1], "renews_at_ms": renews_at, "_accounts": accounts}
+
+def renew_plans(chunk=RENEWAL_CHUNK, rollover=ROLLOVER, cap=ROLLOVER_CAP):
+    """Grant every account due by now, one chunk per transaction on each shard.
+
+    The cutoff is fixed at the start, so the run ends even though renewed
+    accounts stay on the schedule; anything left after a crash is simply
+    still due on the next run. See shared.bank_renewals for rollover.
+    """
+    cutoff = _now_ms()
+    accounts = tokens = 0
+    for writer in shards.writers:
+        while True:
+            result = _write_through(writer.run(renew_due, cutoff, chunk, rollover, cap))
+            if not result["accounts"]:
+                break
+            accounts += result["accounts"]
+            tokens += result["tokens"]
+    return {"accounts": accounts, "tokens": tokens}
+
+_sqlite_job(RENEWAL_SECONDS, renew_plans)
+
+@app.post("/plan")
+def set_plan(change: PlanChange):
+    """Change an account's plan; the new grant applies from its next renewal"""
+    _needs_sqlite("Plans and renewals")
+    if change.plan not in ACCOUNT_TYPES:
+        raise HTTPException(status_code=400,
+                            detail=f"Unknown plan; expected one of {', '.join(ACCOUNT_TYPES)}")
+    if change.email.startswith(TEAM_PREFIX):
+        raise HTTPException(status_code=400, detail="Team plans are set when the team is created")
+    result = _write_through(shards.writer(change.email).run(apply_set_plan, change))
+    limiter.forget(change.email)
+    return result
+
+def _epoch_ms(moment: datetime) -> int:
+    """Epoch milliseconds for a datetime (naive values are taken as UTC)"""
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp() * 1000)
+
+def _encode_cursor(ts, tx_id):
+    return base64.urlsafe_b64encode(f"{ts}|{tx_id}".encode()).decode()
+
+def _decode_cursor(cursor):
+    try:
+        ts, tx_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return int(ts), int(tx_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@app.get("/transactions")
+def list_transactions(
+    email: str,
+    app_id: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500)
+):
+    """Newest-first transaction history, one page per call.
+
+    Pages are keyed on (ts, id) and walk the (email, ts) index, so a page
+    costs the same however deep it is or however large the ledger grows.
+    Pass next_cursor back to get the following page.
+    """
+    _needs_sqlite("Transaction history and exports")
+    query = '''SELECT t.id, t.amount, a.name, t.description, t.ts
+               FROM transactions t LEFT JOIN apps a ON a.id = t.app_id
+               WHERE t.email = ?'''
+    params = [email]
+    if app_id:
+        # Unary + keeps SQLite on the (email, ts) index instead of (app_id, ts)
+        query += ' AND +t.app_id = (SELECT id FROM apps WHERE name = ?)'
+        params.append(app_id)
+    if since:
+        query += ' AND t.ts >= ?'
+        params.append(_epoch_ms(since))
+    if until:
+        query += ' AND t.ts < ?'
+        params.append(_epoch_ms(until))
+    if cursor:
+        query += ' AND (t.ts, t.id) < (?, ?)'
+        params.extend(_decode_cursor(cursor))
+    query += ' ORDER BY t.ts DESC, t.id DESC LIMIT ?'
+    params.append(limit)
     
-    # Deduct
-    c.execute('UPDATE accounts SET tokens = tokens - ? WHERE email = ?',
-              (spend.tokens, spend.email))
+    rows = shards.pool(email).connection().execute(query, params).fetchall()
+    next_cursor = _encode_cursor(rows[-1][4], rows[-1][0]) if len(rows) == limit else None
+    return {
+        "transactions": [
+            {
+                "id": tx_id,
+                "amount": amount,
+                "app_id": app_name,
+                "description": description,
+                "timestamp": datetime.fromtimestamp(ts / 1000, timezone.utc).isoformat()
+            }
+            for tx_id, amount, app_name, description, ts in rows
+        ],
+        "next_cursor": next_cursor
+    }
+
+# Ledger rows read, encoded and sent per chunk of an export
+EXPORT_BATCH = 2000
+EXPORT_FIELDS = ["id", "timestamp", "email", "amount", "app_id", "description"]
+
+def _export_batches(db, filters, params):
+    """Yield one shard's matching ledger rows, oldest first, EXPORT_BATCH at a time.
+
+    Each batch is a short keyset read (id > last id sent), so memory
+    stays flat and no read transaction stays open for the whole export.
+    The ledger is append-only, so stopping at the id that was last when
+    the export began still gives a consistent cut.
+    """
+    head = db.connection().execute('SELECT COALESCE(MAX(id), 0) FROM transactions').fetchone()[0]
+    query = f'''SELECT t.id, t.ts, t.email, t.amount, a.name, t.description
+                FROM transactions t LEFT JOIN apps a ON a.id = t.app_id
+                WHERE t.id > ? AND t.id <= ?{filters}
+                ORDER BY t.id LIMIT ?'''
+    after = 0
+    while after < head:
+        # The response is iterated from a thread pool, so batches can
+        # run on different threads; take that thread's connection each time
+        rows = db.connection().execute(query, (after, head, *params, EXPORT_BATCH)).fetchall()
+        if not rows:
+            break
+        yield rows
+        after = rows[-1][0]
+
+def _export_records(rows, shard):
+    for tx_id, ts, email, amount, app_name, description in rows:
+        record = [tx_id, datetime.fromtimestamp(ts / 1000, timezone.utc).isoformat(),
+                  email, amount, app_name, description]
+        yield record if shard is None else [shard, *record]
+
+def _gzipped(chunks):
+    compressor = zlib.compressobj(wbits=31)  # 31 = gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.get("/export/transactions")
+def export_transactions(
+    format: Literal["ndjson", "csv"] = "ndjson",
+    email: Optional[str] = None,
+    app_id: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    gzip: bool = False
+):
+    """Stream the ledger (optionally filtered) as NDJSON or CSV, oldest first.
+
+    The response is sent in chunks as rows are read, so an export of
+    the whole ledger costs the bank no more memory than a small one.
+    gzip=true sends a .gz file instead. On a sharded bank rows come
+    shard by shard, with a leading "shard" field (ids are per shard).
+    Read from the shard replicas, so the newest rows may be missing.
+    """
+    _needs_sqlite("Transaction history and exports")
+    filters, params = '', []
+    targets = list(enumerate(replicas))
+    if email:
+        stripes = _team_stripes(email)
+        emails = _stripe_keys(email, stripes) if stripes else [email]
+        filters += f' AND t.email IN ({", ".join("?" for _ in emails)})'
+        params += emails
+        indexes = {shards.index(key) for key in emails}
+        targets = [(i, db) for i, db in targets if i in indexes]
+    if app_id:
+        filters += ' AND t.app_id = (SELECT id FROM apps WHERE name = ?)'
+        params.append(app_id)
+    if since:
+        filters += ' AND t.ts >= ?'
+        params.append(_epoch_ms(since))
+    if until:
+        filters += ' AND t.ts < ?'
+        params.append(_epoch_ms(until))
+    fields = EXPORT_FIELDS if shards.count == 1 else ["shard", *EXPORT_FIELDS]
+
+    def body():
+        if format == "csv":
+            buffer = io.StringIO()
+            out = csv.writer(buffer)
+            out.writerow(fields)
+        for index, db in targets:
+            for rows in _export_batches(db, filters, params):
+                records = _export_records(rows, None if shards.count == 1 else index)
+                if format == "ndjson":
+                    yield "".join(json.dumps(dict(zip(fields, record))) + "\n" for record in records)
+                    continue
+                out.writerows(records)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        if format == "csv" and buffer.tell():
+            yield buffer.getvalue()
+
+    filename = f"transactions.{format}"
+    media_type = "application/x-ndjson" if format == "ndjson" else "text/csv"
+    chunks = body()
+    if gzip:
+        filename += ".gz"
+        media_type = "application/gzip"
+        chunks = _gzipped(chunks)
+    return StreamingResponse(chunks, media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+# Longest range /usage will answer in one call
+USAGE_MAX_DAYS = 366
+
+@app.get("/usage")
+def usage(
+    since: date,
+    until: Optional[date] = None,
+    app_id: Optional[str] = None,
+    plan: Optional[str] = None
+):
+    """Tokens spent and deposited per app, plan and day, from usage_daily.
+
+    Reads only rollup rows (days x apps x plans), never the ledger, so
+    cost does not depend on transaction volume. `until` is inclusive.
+    Ledger rows without an app (deposits) are reported with app_id null.
+    On a sharded bank each shard's rollup is read and summed. Served
+    from the shard replicas, so up to REPLICA_SECONDS behind.
+    """
+    _needs_sqlite("Usage reports")
+    until = until or since
+    first, last = since.toordinal() - EPOCH_ORDINAL, until.toordinal() - EPOCH_ORDINAL
+    if not 0 <= last - first < USAGE_MAX_DAYS:
+        raise HTTPException(status_code=400,
+                            detail=f"Range must be 1 to {USAGE_MAX_DAYS} days, since <= until")
     
-    # Record spend
-    tx_id = secrets.token_hex(8)
-    c.execute('INSERT INTO transactions VALUES (?, ?, ?, ?, ?)',
-              (tx_id, spend.email, -spend.tokens, 
-               f"{spend.app_id}: {spend.description}", datetime.utcnow()))
+    query = '''SELECT u.day, u.app_id, a.name, u.plan, u.spent, u.deposited, u.transactions
+               FROM usage_daily u LEFT JOIN apps a ON a.id = u.app_id
+               WHERE u.day BETWEEN ? AND ?'''
+    params = [first, last]
+    if app_id:
+        query += ' AND u.app_id = (SELECT id FROM apps WHERE name = ?)'
+        params.append(app_id)
+    if plan:
+        query += ' AND u.plan = ?'
+        params.append(plan)
     
-    conn.commit()
-    conn.close()
-    return {"status": "spent", "remaining": get_balance(spend.email)}
+    # (day, app, plan) -> [app_id for ordering, spent, deposited, transactions]
+    totals = {}
+    for db in replicas:
+        for day, app_key, app_name, plan_name, spent, deposited, count in db.connection().execute(query, params):
+            row = totals.setdefault((day, app_name, plan_name), [app_key, 0, 0, 0])
+            row[1] += spent
+            row[2] += deposited
+            row[3] += count
+    rows = sorted(totals.items(), key=lambda item: (item[0][0], item[1][0], item[0][2]))
+    return {
+        "since": since.isoformat(),
+        "until": until.isoformat(),
+        "usage": [
+            {
+                "day": date.fromordinal(day + EPOCH_ORDINAL).isoformat(),
+                "app_id": app_name,
+                "plan": plan_name,
+                "tokens_spent": spent,
+                "tokens_deposited": deposited,
+                "transactions": count
+            }
+            for (day, app_name, plan_name), (_, spent, deposited, count) in rows
+        ]
+    }
 
 def get_balance(email: str) -> int:
-    conn = sqlite3.connect('bank.db')
-    c = conn.cursor()
-    c.execute('SELECT tokens FROM accounts WHERE email = ?', (email,))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else 0
+    return _account(email)[0]
+
+@app.get("/admin/reconciliation")
+def reconciliation_report(limit: int = Query(100, ge=1, le=1000)):
+    """Reconciliation progress and accounts whose balance disagrees with the ledger"""
+    _needs_sqlite("Reconciliation reports")
+    progress, mismatches, count = [], [], 0
+    for shard, db in enumerate(shards.pools):
+        c = db.connection()
+        checkpoint = get_meta(c, "recon_tx_id", 0)
+        head = c.execute('SELECT COALESCE(MAX(id), 0) FROM transactions').fetchone()[0]
+        progress.append({"shard": shard, "checkpoint_tx_id": checkpoint, "ledger_head_tx_id": head,
+                         "lag": head - checkpoint, "last_run_ms": get_meta(c, "recon_last_run")})
+        count += c.execute('SELECT COUNT(*) FROM recon_mismatches').fetchone()[0]
+        mismatches += [
+            {"shard": shard, "email": email, "balance": balance, "expected": expected,
+             "difference": balance - expected, "checked_tx_id": tx_id, "detected_at_ms": at}
+            for email, balance, expected, tx_id, at in c.execute(
+                '''SELECT email, balance, expected, checked_tx_id, detected_at
+                   FROM recon_mismatches ORDER BY detected_at DESC LIMIT ?''', (limit,))
+        ]
+    mismatches.sort(key=lambda m: m["detected_at_ms"], reverse=True)
+    return {
+        "lag": sum(p["lag"] for p in progress),
+        "shards": progress,
+        "mismatch_count": count,
+        "mismatches": mismatches[:limit]
+    }
+
+@app.post("/admin/reconciliation/run")
+def run_reconciliation():
+    """Reconcile now instead of waiting for the next scheduled run"""
+    _needs_sqlite("Reconciliation reports")
+    return {"ledger_rows_checked": reconcile(), **reconciliation_report(limit=100)}
+
+@app.get("/admin/replicas")
+def replica_status():
+    """Age and last refresh cost of each shard's read-only copy"""
+    _needs_sqlite("Replicas")
+    return {"refresh_seconds": REPLICA_SECONDS,
+            "replicas": [{"shard": i, **replica.status()} for i, replica in enumerate(replicas)]}
+
+@app.post("/admin/replicas/refresh")
+def refresh_replicas_now():
+    """Refresh the read-only copies now (e.g. before a finance export)"""
+    _needs_sqlite("Replicas")
+    refresh_replicas()
+    return replica_status()
+
+@app.get("/stats/cache")
+def cache_stats():
+    return {"balance": balance_cache.stats(), "streams": balance_events.stats()}
+
+@app.get("/stats/rate-limits")
+def rate_limit_stats(limit: int = Query(20, ge=1, le=1000)):
+    """Rate limiter counters, app bucket levels and the emptiest account buckets"""
+    return limiter.stats(limit)
+
+@app.on_event("shutdown")
+def stop_writer():
+    shards.stop()
+
+@app.get("/health")
+def health():
+    """Storage engine in use, and the features it answers 501 for"""
+    return {"status": "healthy", "storage": STORAGE_ENGINE,
+            "unsupported": [] if isinstance(storage, SqliteStorage) else SQLITE_ONLY}
 
 @app.get("/test")
 def test():
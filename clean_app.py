@@ -165,11 +165,21 @@ async def settings(request: Request, session: str = Cookie(default=None)):
     return templates.TemplateResponse("settings.html", {"request": request})
 
 @app.get("/logout")
-async def logout():
+async def logout(session: str = Cookie(default=None)):
+    # Revoke the token too, so a copied cookie stops working (and it leaves the session cache)
+    if session:
+        from shared.auth import revoke_magic_link
+        revoke_magic_link(session)
     response = RedirectResponse("/")
     response.delete_cookie(key="session")
     return response
 
+@app.get("/debug-auth")
+async def debug_auth():
+    """Verified-session cache hit rate"""
+    from shared.auth import session_cache
+    return session_cache.stats()
+
 # In clean_app.py, add after /login route:
 @app.get("/check-email")
 async def check_email(request: Request, email: str):
@@ -203,9 +213,11 @@ async def debug_db():
             "size": os.path.getsize(db_file) if exists else 0
         })
     
-    # Also try to connect
+    # Also try to connect, read-only and to the bank's replica when there
+    # is one, so debugging never competes with the bank's writer
     try:
-        conn = sqlite3.connect('bank.db')
+        from shared.bank_replica import open_replica
+        conn = open_replica(str(DB_PATH))
         cursor = conn.cursor()
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
         tables = cursor.fetchall()
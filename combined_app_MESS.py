@@ -7,6 +7,7 @@ from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from dashboard.app import app as dashboard_app
+from shared.bank_client import AsyncBankClient, BankError, InsufficientTokens
 import os
 import sys
 from fastapi import Cookie as FastAPICookie
@@ -14,6 +15,10 @@ from fastapi import Cookie as FastAPICookie
 print("=== DEBUG IMPORTS ===")
 print("Cookie imported?", "Cookie" in dir())
 
+# Bank API is mounted in this process (see below), so the client calls
+# it in-process; it falls back to HTTP if the bank is split out
+bank = AsyncBankClient("http://localhost:8001")
+
 # Define dashboard_path before using it
 dashboard_path = os.path.join(os.path.dirname(__file__), "dashboard")
 
@@ -210,39 +215,31 @@ async def generate_prompt(
     if not email:
         return RedirectResponse("/login")
     
-    # 2. TOKEN CHECK (5 tokens for Prompt Wizard)
-    try:
-        import httpx
-        async with httpx.AsyncClient() as client:
-            # Check balance
-            balance_response = await client.get(
-                f"http://localhost:8001/balance?email={email}",
-                timeout=5.0
-            )
-            
-            if balance_response.status_code == 200:
-                balance = balance_response.json().get("balance", 0)
-                if balance < 5:
-                    return templates.TemplateResponse("insufficient_tokens.html", {
-                        "request": request,
-                        "balance": balance,
-                        "required": 5,
-                        "app_name": "Prompt Wizard"
-                    })
-            else:
-                return layout("Bank Error", 
-                    "<div class='card'><h2>Token system unavailable</h2></div>")
-    except Exception as e:
-        print(f"Token check error: {e}")
-        return layout("System Error", 
-            "<div class='card'><h2>Cannot connect to token system</h2></div>")
-    
-    # 3. DEEPSEEK API CALL
+    # 2. CONFIG CHECK (before any tokens are reserved)
     api_key = os.getenv("DEEPSEEK_API_KEY")
     if not api_key:
         return layout("Error", 
             "<div class='card'><h2>API not configured</h2><p>DeepSeek API key missing.</p></div>")
     
+    # 3. RESERVE TOKENS (5 tokens for Prompt Wizard)
+    # One hold call both checks the balance and keeps the 5 tokens aside
+    # while DeepSeek runs, so the balance can't go negative meanwhile
+    try:
+        hold = await bank.hold(email, "prompt_wizard", 5, f"Prompt: {goal[:50]}...")
+    except InsufficientTokens as e:
+        return templates.TemplateResponse("insufficient_tokens.html", {
+            "request": request,
+            "balance": e.available,
+            "required": 5,
+            "app_name": "Prompt Wizard"
+        })
+    except BankError as e:
+        print(f"Token check error: {e}")
+        return layout("Bank Error", 
+            "<div class='card'><h2>Token system unavailable</h2></div>")
+    hold_id = hold.hold_id
+    
+    # 4. DEEPSEEK API CALL
     prompt_text = f"""
     Create a {style} prompt for {audience} to achieve this goal: {goal}.
     Platform: {platform}
@@ -251,6 +248,7 @@ async def generate_prompt(
     Provide a complete, ready‑to‑use prompt.
     """
     
+    generated = None
     try:
         headers = {
             "Authorization": f"Bearer {api_key}",
@@ -275,46 +273,31 @@ async def generate_prompt(
         if response.status_code == 200:
             result = response.json()
             generated = result["choices"][0]["message"]["content"]
-            
-            # 4. DEDUCT TOKENS AFTER SUCCESS
-            try:
-                async with httpx.AsyncClient() as client:
-                    spend_data = {
-                        "email": email,
-                        "app_id": "prompt_wizard",
-                        "tokens": 5,
-                        "description": f"Prompt: {goal[:50]}..."
-                    }
-                    spend_response = await client.post(
-                        "http://localhost:8001/spend",
-                        json=spend_data,
-                        timeout=5.0
-                    )
-                    if spend_response.status_code != 200:
-                        print(f"Token spend failed but prompt generated: {spend_response.text}")
-            except Exception as e:
-                print(f"Token spend error: {e}")
-            
-            # 5. RETURN RESULT
-            return templates.TemplateResponse("prompt_result.html", {
-                "request": request,
-                "goal": goal,
-                "audience": audience,
-                "platform": platform,
-                "style": style,
-                "tone": tone,
-                "generated_prompt": generated,
-                "tokens_spent": 5
-            })
-            
         else:
-            return layout("API Error", 
+            error_page = layout("API Error", 
                 f"<div class='card'><h2>API Error {response.status_code}</h2>"
                 f"<p>{response.text}</p></div>")
                 
     except Exception as e:
-        return layout("Error", 
+        error_page = layout("Error", 
             f"<div class='card'><h2>Generation failed</h2><p>{str(e)}</p></div>")
+    
+    # 5. SETTLE THE HOLD: capture on success, release on failure
+    await bank.settle(hold_id, capture=generated is not None)
+    if generated is None:
+        return error_page
+    
+    # 6. RETURN RESULT
+    return templates.TemplateResponse("prompt_result.html", {
+        "request": request,
+        "goal": goal,
+        "audience": audience,
+        "platform": platform,
+        "style": style,
+        "tone": tone,
+        "generated_prompt": generated,
+        "tokens_spent": 5
+    })
 
 @app.get("/prompt-wizard/intro")
 async def prompt_wizard_intro(request: Request, session: str = Cookie(default=None)):
@@ -1,7 +1,6 @@
 from fastapi import FastAPI, Request, Form, Cookie, Response
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
-import sqlite3
 import os
 import sys
 from pathlib import Path
@@ -31,29 +30,23 @@ except ImportError as e:
         print(f"📨 MOCK: Magic link for {email}")
         return f"http://localhost:8000/auth?token=test_{email}"
 
+from shared.bank_client import AsyncBankClient, BankError, InsufficientTokens
+import json
+
 app = FastAPI()
 
-def get_user_balance(email: str):
-    """Get user's token balance from bank database, create if doesn't exist"""
-    db_path = Path(__file__).parent.parent / "bank.db"
-    conn = sqlite3.connect(str(db_path))
-    c = conn.cursor()
-    
-    # Check if exists
-    c.execute('SELECT tokens FROM accounts WHERE email = ?', (email,))
-    result = c.fetchone()
-    
-    if result:
-        balance = result[0]
-    else:
-        # Create new account with 0 tokens
-        c.execute('INSERT INTO accounts (email, tokens) VALUES (?, ?)', (email, 0))
-        conn.commit()
-        balance = 0
-        print(f"Created new account for {email}")
-    
-    conn.close()
-    return balance
+BANK_URL = "http://localhost:8001"
+
+# One pooled client for every bank call this dashboard makes
+bank = AsyncBankClient(BANK_URL)
+
+async def get_user_balance(email: str):
+    """Get user's token balance (in-process when the bank is mounted alongside)"""
+    try:
+        return (await bank.balance(email)).balance
+    except BankError as e:
+        print(f"Balance lookup failed: {e}")
+        return 0
 
 # Routes
 @app.get("/")
@@ -147,7 +140,7 @@ async def settings_page(request: Request, session: str = Cookie(default=None)):
     if not email:
         return RedirectResponse("/login")
     
-    balance = get_user_balance(email)
+    balance = await get_user_balance(email)
     
     # DEFINE current_plan here (mock for now)
     current_plan = "Free Tier"  # TODO: Get from database
@@ -166,6 +159,24 @@ async def settings_page(request: Request, session: str = Cookie(default=None)):
         "renewal_date": renewal_date
     })
 
+@app.get("/balance/stream")
+async def balance_stream(session: str = Cookie(default=None)):
+    """Relay the bank's balance events for the logged-in user (pages listen with EventSource)"""
+    email = verify_magic_link(session, mark_used=False) if session else None
+    if not email:
+        return Response(status_code=401)
+
+    async def events():
+        try:
+            async for update in bank.balance_updates(email):
+                yield f"event: balance\ndata: {json.dumps({'balance': update.balance, 'available': update.available})}\n\n"
+        except BankError as e:
+            # The browser's EventSource reconnects on its own
+            print(f"Balance stream ended: {e}")
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.post("/generate-prompt")
 async def generate_prompt(
     request: Request,
@@ -186,39 +197,31 @@ async def generate_prompt(
     if not email:
         return RedirectResponse("/login")
     
-    # 2. TOKEN CHECK (5 tokens for Prompt Wizard)
-    try:
-        import httpx
-        async with httpx.AsyncClient() as client:
-            # Check balance
-            balance_response = await client.get(
-                f"http://localhost:8001/balance?email={email}",
-                timeout=5.0
-            )
-            
-            if balance_response.status_code == 200:
-                balance = balance_response.json().get("balance", 0)
-                if balance < 5:
-                    return templates.TemplateResponse("insufficient_tokens.html", {
-                        "request": request,
-                        "balance": balance,
-                        "required": 5,
-                        "app_name": "Prompt Wizard"
-                    })
-            else:
-                return layout("Bank Error", 
-                    "<div class='card'><h2>Token system unavailable</h2></div>")
-    except Exception as e:
-        print(f"Token check error: {e}")
-        return layout("System Error", 
-            "<div class='card'><h2>Cannot connect to token system</h2></div>")
-    
-    # 3. DEEPSEEK API CALL
+    # 2. CONFIG CHECK (before any tokens are reserved)
     api_key = os.getenv("DEEPSEEK_API_KEY")
     if not api_key:
         return layout("Error", 
             "<div class='card'><h2>API not configured</h2><p>DeepSeek API key missing.</p></div>")
     
+    # 3. RESERVE TOKENS (5 tokens for Prompt Wizard)
+    # One hold call both checks the balance and keeps the 5 tokens aside
+    # while DeepSeek runs, so the balance can't go negative meanwhile
+    try:
+        hold = await bank.hold(email, "prompt_wizard", 5, f"Prompt: {goal[:50]}...")
+    except InsufficientTokens as e:
+        return templates.TemplateResponse("insufficient_tokens.html", {
+            "request": request,
+            "balance": e.available,
+            "required": 5,
+            "app_name": "Prompt Wizard"
+        })
+    except BankError as e:
+        print(f"Token check error: {e}")
+        return layout("Bank Error", 
+            "<div class='card'><h2>Token system unavailable</h2></div>")
+    hold_id = hold.hold_id
+    
+    # 4. DEEPSEEK API CALL
     prompt_text = f"""
     Create a {style} prompt for {audience} to achieve this goal: {goal}.
     Platform: {platform}
@@ -227,6 +230,7 @@ async def generate_prompt(
     Provide a complete, ready‑to‑use prompt.
     """
     
+    generated = None
     try:
         headers = {
             "Authorization": f"Bearer {api_key}",
@@ -251,46 +255,31 @@ async def generate_prompt(
         if response.status_code == 200:
             result = response.json()
             generated = result["choices"][0]["message"]["content"]
-            
-            # 4. DEDUCT TOKENS AFTER SUCCESS
-            try:
-                async with httpx.AsyncClient() as client:
-                    spend_data = {
-                        "email": email,
-                        "app_id": "prompt_wizard",
-                        "tokens": 5,
-                        "description": f"Prompt: {goal[:50]}..."
-                    }
-                    spend_response = await client.post(
-                        "http://localhost:8001/spend",
-                        json=spend_data,
-                        timeout=5.0
-                    )
-                    if spend_response.status_code != 200:
-                        print(f"Token spend failed but prompt generated: {spend_response.text}")
-            except Exception as e:
-                print(f"Token spend error: {e}")
-            
-            # 5. RETURN RESULT
-            return templates.TemplateResponse("prompt_result.html", {
-                "request": request,
-                "goal": goal,
-                "audience": audience,
-                "platform": platform,
-                "style": style,
-                "tone": tone,
-                "generated_prompt": generated,
-                "tokens_spent": 5
-            })
-            
         else:
-            return layout("API Error", 
+            error_page = layout("API Error", 
                 f"<div class='card'><h2>API Error {response.status_code}</h2>"
                 f"<p>{response.text}</p></div>")
                 
     except Exception as e:
-        return layout("Error", 
+        error_page = layout("Error", 
             f"<div class='card'><h2>Generation failed</h2><p>{str(e)}</p></div>")
+    
+    # 5. SETTLE THE HOLD: capture on success, release on failure
+    await bank.settle(hold_id, capture=generated is not None)
+    if generated is None:
+        return error_page
+    
+    # 6. RETURN RESULT
+    return templates.TemplateResponse("prompt_result.html", {
+        "request": request,
+        "goal": goal,
+        "audience": audience,
+        "platform": platform,
+        "style": style,
+        "tone": tone,
+        "generated_prompt": generated,
+        "tokens_spent": 5
+    })
 
 @app.get("/prompt-wizard/intro")
 async def prompt_wizard_intro(request: Request, session: str = Cookie(default=None)):
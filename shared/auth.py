@@ -1,10 +1,77 @@
 import os
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from itsdangerous import URLSafeTimedSerializer
 
 SECRET_KEY = "your-secret-key-change-in-production"
 serializer = URLSafeTimedSerializer(SECRET_KEY)
 
+# Verified session tokens kept in memory, and for how long at most. A
+# token used or revoked by another process can still pass here for up to
+# SESSION_CACHE_TTL seconds.
+SESSION_CACHE_SIZE = int(os.getenv("AUTH_SESSION_CACHE_SIZE", "10000"))
+SESSION_CACHE_TTL = float(os.getenv("AUTH_SESSION_CACHE_TTL", "60"))
+
+
+class SessionCache:
+    """LRU of token -> (email, signed_at, cached_until) for tokens that verified.
+
+    An entry never outlives the token: a hit also needs
+    signed_at + max_age to be in the future, for the caller's max_age.
+    """
+
+    def __init__(self, max_entries=SESSION_CACHE_SIZE, ttl_seconds=SESSION_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # Bumped by every invalidate; see put
+        self.invalidations = 0
+
+    def get(self, token, max_age):
+        """The email for a cached, still valid token, else None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None or entry[2] <= now or entry[1] + max_age <= now:
+                if entry is not None:
+                    del self._entries[token]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token, email, signed_at, max_age, invalidations):
+        """Cache a verified token, unless something was invalidated since the
+        caller read self.invalidations (it may have been this token)"""
+        cached_until = min(time.time() + self.ttl, signed_at + max_age)
+        with self._lock:
+            if invalidations != self.invalidations:
+                return
+            self._entries[token] = (email, signed_at, cached_until)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token):
+        with self._lock:
+            self._entries.pop(token, None)
+            self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+                "invalidations": self.invalidations}
+
+
+session_cache = SessionCache()
+
 def get_db_path():
     """Get the absolute path to bank.db, works both locally and on Render"""
     # Try several possible locations
@@ -26,15 +93,26 @@ def get_db_path():
     return default_path
 
 def verify_magic_link(token: str, max_age=900, mark_used=True):
-    """Verify magic link token"""
+    """Verify magic link token.
+
+    With mark_used=False (checking a session) a token that verified
+    recently comes from session_cache without touching the database.
+    """
     
     if token.startswith("test_"):
         return token[5:]  # Return email after "test_"
     
+    if not mark_used:
+        email = session_cache.get(token, max_age)
+        if email is not None:
+            return email
+        invalidations = session_cache.invalidations
+    
     print(f"🔍 VERIFY DEBUG: Checking token {token[:30]}...")
     
     try:
-        email = serializer.loads(token, salt="magic-link", max_age=max_age)
+        email, signed_at = serializer.loads(token, salt="magic-link", max_age=max_age,
+                                            return_timestamp=True)
         print(f"🔍 VERIFY DEBUG: Token valid for {email}")
         
         # USE THE SHARED FUNCTION
@@ -57,7 +135,10 @@ def verify_magic_link(token: str, max_age=900, mark_used=True):
         if mark_used:
             c.execute("UPDATE magic_links SET used = TRUE WHERE token = ?", (token,))
             conn.commit()
+            session_cache.invalidate(token)
             print(f"🔍 VERIFY DEBUG: Marked token as used")
+        else:
+            session_cache.put(token, email, signed_at.timestamp(), max_age, invalidations)
         
         conn.close()
         print(f"🔍 VERIFY DEBUG: SUCCESS! Login for {email}")
@@ -66,4 +147,13 @@ def verify_magic_link(token: str, max_age=900, mark_used=True):
     except Exception as e:
         print(f"🔍 VERIFY DEBUG: Error: {type(e).__name__}: {e}")
         return None
-    return token
+
+def revoke_magic_link(token: str):
+    """Mark a token used so it no longer works as a session (e.g. on logout)"""
+    if not token.startswith("test_"):
+        conn = sqlite3.connect(get_db_path())
+        conn.execute("UPDATE magic_links SET used = TRUE WHERE token = ?", (token,))
+        conn.commit()
+        conn.close()
+    # After the commit, so a verify racing this cannot cache the token again
+    session_cache.invalidate(token)
@@ -0,0 +1,72 @@
+# shared/bank_cache.py
+"""In-process cache of account balances"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+BALANCE_CACHE_SIZE = int(os.getenv("BANK_BALANCE_CACHE_SIZE", "100000"))
+BALANCE_CACHE_TTL = float(os.getenv("BANK_BALANCE_CACHE_TTL", "30"))
+
+
+class BalanceCache:
+    """LRU of email -> (tokens, held, version) with a TTL.
+
+    `version` is accounts.version, bumped by every committed write, so a
+    late write-through or a read that raced a write can never replace a
+    newer state with an older one. The TTL bounds staleness from writers
+    in other processes.
+    """
+
+    def __init__(self, max_entries=BALANCE_CACHE_SIZE, ttl_seconds=BALANCE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self._entries = OrderedDict()  # email -> (tokens, held, version, expires)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    def get(self, email):
+        """(tokens, held, version) if cached and fresh, else None"""
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry is None or entry[3] <= time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(email)
+            self.hits += 1
+            return entry[:3]
+
+    def put(self, email, tokens, held, version):
+        """Store a state unless a newer version is already cached"""
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry is not None and entry[2] > version:
+                return False
+            self._entries[email] = (tokens, held, version, time.monotonic() + self.ttl)
+            self._entries.move_to_end(email)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self.writes += 1
+            return True
+
+    def invalidate(self, email):
+        with self._lock:
+            self._entries.pop(email, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
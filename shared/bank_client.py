@@ -0,0 +1,347 @@
+# shared/bank_client.py
+"""Client for the central bank API.
+
+One client holds a keep-alive connection pool, so callers should share
+it rather than build one per request:
+
+    bank = AsyncBankClient(BANK_URL)      # async code (dashboard, proxy)
+    hold = await bank.hold(email, "prompt_wizard", 5)
+    await bank.settle(hold.hold_id, capture=succeeded)
+
+    bank = BankClient(BANK_URL)           # sync code (AI app middleware)
+    bank.spend(email, "hook_wizard", 4, "Generate hooks")
+
+Every call has a deadline covering all of its attempts. Calls that are
+safe to repeat are retried with jittered exponential backoff on network
+errors and 502/503/504: reads, deposits (deduplicated by payment_id)
+and spends/holds, which carry an Idempotency-Key (a fresh one per call
+unless the caller passes its own) so the bank applies them only once.
+Other writes are only retried when the connection could not be made,
+i.e. the bank never saw the request.
+
+AsyncBankClient.balance_updates follows /balance/stream, the bank's
+server-sent events feed of one account's balance.
+
+When the bank runs in the same process (combined_app mounts
+central_bank.app at /api), calls skip HTTP and go straight to
+central_bank's endpoint functions, with the same results and errors.
+BANK_TRANSPORT=http forces HTTP, =local forces in-process.
+"""
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from typing import Optional
+
+import httpx
+from pydantic import BaseModel
+
+BANK_URL = os.getenv("BANK_URL", "http://localhost:8001")
+# Seconds a call may take in total, retries included
+DEADLINE = float(os.getenv("BANK_CLIENT_DEADLINE", "5"))
+# Attempts per call, and the first backoff (doubled per attempt, full jitter)
+ATTEMPTS = int(os.getenv("BANK_CLIENT_ATTEMPTS", "3"))
+BACKOFF = 0.05
+POOL_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+
+RETRY_STATUS = {502, 503, 504}
+
+# auto: in-process when central_bank is loaded in this process
+BANK_TRANSPORT = os.getenv("BANK_TRANSPORT", "auto")
+
+
+class BankError(Exception):
+    """The bank refused a call (status_code and detail come from its response)"""
+
+    def __init__(self, status_code, detail):
+        super().__init__(f"{status_code}: {detail}")
+        self.status_code = status_code
+        self.detail = detail
+
+
+class InsufficientTokens(BankError):
+    """402 from the bank; `available` is set when the bank reports it"""
+
+    @property
+    def available(self):
+        return self.detail.get("available") if isinstance(self.detail, dict) else None
+
+
+class BankUnavailable(BankError):
+    """The bank could not be reached (or kept failing) within the deadline"""
+
+    def __init__(self, reason):
+        super().__init__(503, reason)
+
+
+class Balance(BaseModel):
+    email: str
+    balance: int
+    held: int = 0
+    available: int
+
+
+class Deposited(BaseModel):
+    new_balance: int
+
+
+class Spent(BaseModel):
+    remaining: int
+
+
+class Hold(BaseModel):
+    hold_id: str
+    tokens: int
+    available: int
+    expires_at: float
+
+
+class Captured(BaseModel):
+    tokens: int
+    remaining: int
+
+
+class Released(BaseModel):
+    tokens: int
+
+
+def _backoff(attempt):
+    return random.uniform(0, BACKOFF * 2 ** attempt)
+
+
+def _retryable(idempotent, error=None, status_code=None):
+    if status_code is not None:
+        return idempotent and status_code in RETRY_STATUS
+    # A failed connect means the request was never sent, so even a write is safe to resend
+    return idempotent or isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout))
+
+
+def _result(response, model):
+    if response.status_code == 200:
+        return model(**response.json())
+    try:
+        detail = response.json().get("detail", response.text)
+    except ValueError:
+        detail = response.text
+    if response.status_code == 402:
+        raise InsufficientTokens(402, detail)
+    raise BankError(response.status_code, detail)
+
+
+def _co_resident_bank(in_process):
+    """The central_bank module if calls should stay in this process, else None"""
+    mode = BANK_TRANSPORT if in_process is None else ("local" if in_process else "http")
+    if mode == "http":
+        return None
+    bank = sys.modules.get("central_bank")
+    if bank is None and mode == "local":
+        import central_bank as bank
+    return bank
+
+
+def _local_call(bank, method, path, params=None, json=None, headers=None):
+    """Route one API call to the matching central_bank endpoint function"""
+    key = (headers or {}).get("Idempotency-Key")
+    if path == "/balance":
+        return bank.balance(**params)
+    if path == "/deposit":
+        return bank.deposit_funds(bank.Deposit(**json))
+    if path == "/spend":
+        return bank.spend_tokens(bank.SpendRequest(**json), idempotency_key=key)
+    if path == "/holds":
+        return bank.reserve_tokens(bank.HoldRequest(**json), idempotency_key=key)
+    hold_id, action = path[len("/holds/"):].rsplit("/", 1)
+    if action == "capture":
+        return bank.capture_hold(hold_id, bank.CaptureRequest(**(json or {})))
+    return bank.release_hold(hold_id)
+
+
+def _local_result(bank, model, method, path, **kwargs):
+    """In-process counterpart of an HTTP round trip plus _result"""
+    from fastapi import HTTPException
+    from pydantic import ValidationError
+    try:
+        return model(**_local_call(bank, method, path, **kwargs))
+    except HTTPException as e:
+        if e.status_code == 402:
+            raise InsufficientTokens(402, e.detail)
+        raise BankError(e.status_code, e.detail)
+    except ValidationError as e:
+        raise BankError(422, e.errors())
+
+
+async def _lines(chunks):
+    async for chunk in chunks:
+        for line in chunk.splitlines():
+            yield line
+
+
+async def _balance_events(lines):
+    """Balance for each data line of the bank's /balance/stream"""
+    async for line in lines:
+        if line.startswith("data:"):
+            yield Balance(**json.loads(line[len("data:"):]))
+
+
+class _BankCalls:
+    """Typed bank calls; the sync and async clients decide how _call runs them"""
+
+    def balance(self, email: str) -> Balance:
+        return self._call("GET", "/balance", Balance, True, params={"email": email})
+
+    def deposit(self, email: str, tokens: int, payment_id: str) -> Deposited:
+        return self._call("POST", "/deposit", Deposited, True,
+                          json={"email": email, "tokens": tokens, "payment_id": payment_id})
+
+    def spend(self, email: str, app_id: str, tokens: int, description: str,
+              idempotency_key: Optional[str] = None) -> Spent:
+        return self._call("POST", "/spend", Spent, True,
+                          json={"email": email, "app_id": app_id, "tokens": tokens,
+                                "description": description},
+                          headers={"Idempotency-Key": idempotency_key or str(uuid.uuid4())})
+
+    def hold(self, email: str, app_id: str, tokens: int, description: str = "",
+             ttl_seconds: Optional[int] = None, idempotency_key: Optional[str] = None) -> Hold:
+        body = {"email": email, "app_id": app_id, "tokens": tokens, "description": description}
+        if ttl_seconds is not None:
+            body["ttl_seconds"] = ttl_seconds
+        return self._call("POST", "/holds", Hold, True, json=body,
+                          headers={"Idempotency-Key": idempotency_key or str(uuid.uuid4())})
+
+    def capture(self, hold_id: str, tokens: Optional[int] = None,
+                description: Optional[str] = None) -> Captured:
+        body = {k: v for k, v in (("tokens", tokens), ("description", description)) if v is not None}
+        return self._call("POST", f"/holds/{hold_id}/capture", Captured, False, json=body)
+
+    def release(self, hold_id: str) -> Released:
+        return self._call("POST", f"/holds/{hold_id}/release", Released, False)
+
+
+class BankClient(_BankCalls):
+    """Blocking bank client"""
+
+    def __init__(self, base_url=BANK_URL, deadline=DEADLINE, attempts=ATTEMPTS, transport=None,
+                 in_process=None):
+        self.deadline = deadline
+        self.attempts = attempts
+        self.in_process = in_process
+        self._http = httpx.Client(base_url=base_url, limits=POOL_LIMITS, transport=transport)
+
+    def _call(self, method, path, model, idempotent, **kwargs):
+        bank = _co_resident_bank(self.in_process)
+        if bank is not None:
+            return _local_result(bank, model, method, path, **kwargs)
+        deadline = time.monotonic() + self.deadline
+        for attempt in range(self.attempts):
+            remaining = deadline - time.monotonic()
+            try:
+                response = self._http.request(method, path, timeout=remaining, **kwargs)
+            except httpx.TransportError as e:
+                error, retry = e, _retryable(idempotent, error=e)
+            else:
+                if not _retryable(idempotent, status_code=response.status_code):
+                    return _result(response, model)
+                error, retry = f"HTTP {response.status_code}", True
+            pause = _backoff(attempt)
+            if not retry or attempt + 1 == self.attempts or time.monotonic() + pause >= deadline:
+                break
+            time.sleep(pause)
+        raise BankUnavailable(f"{method} {path}: {error}")
+
+    def settle(self, hold_id: str, capture: bool, tokens: Optional[int] = None):
+        """Capture a hold (for `tokens`, default all of it) or release it.
+
+        Failures are logged, not raised: an unsettled hold expires on its
+        own. Returns the Captured/Released result, None on failure.
+        """
+        try:
+            return self.capture(hold_id, tokens) if capture else self.release(hold_id)
+        except BankError as e:
+            print(f"Token {'capture' if capture else 'release'} failed: {e}")
+            return None
+
+    def close(self):
+        self._http.close()
+
+
+class AsyncBankClient(_BankCalls):
+    """Bank client for async code; methods return awaitables. Use one per event loop."""
+
+    def __init__(self, base_url=BANK_URL, deadline=DEADLINE, attempts=ATTEMPTS, transport=None,
+                 in_process=None):
+        self.deadline = deadline
+        self.attempts = attempts
+        self.in_process = in_process
+        self._http = httpx.AsyncClient(base_url=base_url, limits=POOL_LIMITS, transport=transport)
+
+    async def _call(self, method, path, model, idempotent, **kwargs):
+        bank = _co_resident_bank(self.in_process)
+        if bank is not None:
+            if method == "GET":
+                # Balance reads are served from the bank's cache; no need to leave the loop
+                return _local_result(bank, model, method, path, **kwargs)
+            # Writes wait for the ledger writer's commit, so keep them off
+            # the event loop (as FastAPI does for the bank's sync endpoints)
+            return await asyncio.to_thread(_local_result, bank, model, method, path, **kwargs)
+        deadline = time.monotonic() + self.deadline
+        for attempt in range(self.attempts):
+            remaining = deadline - time.monotonic()
+            try:
+                response = await self._http.request(method, path, timeout=remaining, **kwargs)
+            except httpx.TransportError as e:
+                error, retry = e, _retryable(idempotent, error=e)
+            else:
+                if not _retryable(idempotent, status_code=response.status_code):
+                    return _result(response, model)
+                error, retry = f"HTTP {response.status_code}", True
+            pause = _backoff(attempt)
+            if not retry or attempt + 1 == self.attempts or time.monotonic() + pause >= deadline:
+                break
+            await asyncio.sleep(pause)
+        raise BankUnavailable(f"{method} {path}: {error}")
+
+    async def settle(self, hold_id: str, capture: bool, tokens: Optional[int] = None):
+        """BankClient.settle for async code"""
+        try:
+            if capture:
+                return await self.capture(hold_id, tokens)
+            return await self.release(hold_id)
+        except BankError as e:
+            print(f"Token {'capture' if capture else 'release'} failed: {e}")
+            return None
+
+    async def balance_updates(self, email: str):
+        """Yield the account's Balance now and after every change, until the stream ends.
+
+        Streams are not retried; call again to resume after BankUnavailable.
+        """
+        bank = _co_resident_bank(self.in_process)
+        if bank is not None:
+            from fastapi import HTTPException
+            try:
+                response = await bank.balance_stream(email)
+            except HTTPException as e:
+                raise BankError(e.status_code, e.detail)
+            try:
+                async for balance in _balance_events(_lines(response.body_iterator)):
+                    yield balance
+            finally:
+                # Ends the bank's side of the stream (and its subscription)
+                await response.body_iterator.aclose()
+            return
+        try:
+            async with self._http.stream("GET", "/balance/stream", params={"email": email},
+                                         timeout=httpx.Timeout(self.deadline, read=None)) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    _result(response, Balance)
+                async for balance in _balance_events(response.aiter_lines()):
+                    yield balance
+        except httpx.TransportError as e:
+            raise BankUnavailable(f"GET /balance/stream: {e}")
+
+    async def aclose(self):
+        await self._http.aclose()
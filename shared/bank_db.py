@@ -0,0 +1,119 @@
+# shared/bank_db.py
+"""Pooled SQLite access for bank.db"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+DB_PATH = os.getenv("BANK_DB_PATH", "bank.db")
+
+# PRAGMA settings applied to every pooled connection.
+# cache_size is negative = KiB, mmap_size is bytes, busy_timeout is ms.
+PRAGMA_PROFILES = {
+    "safe": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "cache_size": -16000,
+        "mmap_size": 0,
+        "busy_timeout": 5000
+    },
+    "default": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -64000,
+        "mmap_size": 268435456,
+        "busy_timeout": 5000
+    },
+    "fast": {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "cache_size": -256000,
+        "mmap_size": 1073741824,
+        "busy_timeout": 10000
+    }
+}
+
+PRAGMA_PROFILE = os.getenv("BANK_DB_PROFILE", "default")
+
+# sqlite3 keeps this many compiled statements per connection, keyed by SQL text
+STATEMENT_CACHE_SIZE = 256
+
+
+def apply_pragmas(conn, profile):
+    """Apply a PRAGMA profile (name or dict) to a connection"""
+    settings = PRAGMA_PROFILES[profile] if isinstance(profile, str) else profile
+    for name, value in settings.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+
+
+class ConnectionPool:
+    """One long-lived connection per worker thread for a single database file"""
+
+    def __init__(self, path=DB_PATH, profile=PRAGMA_PROFILE):
+        self.path = path
+        self.profile = profile
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            isolation_level=None,  # we issue BEGIN/COMMIT ourselves
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
+        apply_pragmas(conn, self.profile)
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def connection(self):
+        """Return this thread's connection, opening it on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self, mode="DEFERRED"):
+        """BEGIN ... COMMIT on this thread's connection, ROLLBACK on error"""
+        conn = self.connection()
+        conn.execute(f"BEGIN {mode}")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def close_all(self):
+        """Close every connection handed out by this pool"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+
+pool = ConnectionPool()
+
+
+def migrate(db, migrations):
+    """Bring a database up to date with a list of schema migrations.
+
+    migrations[n] is a function taking a connection that moves the schema
+    from version n to n + 1; the current version lives in PRAGMA
+    user_version. Each step commits on its own, so an interrupted run
+    resumes from the last completed step.
+    """
+    while True:
+        # Re-read the version under the write lock in case another worker
+        # is migrating the same file
+        with db.transaction("IMMEDIATE") as c:
+            version = c.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(migrations):
+                return version
+            migrations[version](c)
+            c.execute(f"PRAGMA user_version = {version + 1}")
@@ -0,0 +1,63 @@
+# shared/bank_events.py
+"""In-process pub/sub of balance changes, for server-sent event streams.
+
+The bank publishes an email after every committed write to it, from
+whichever thread committed. A subscriber is an asyncio.Event on its
+own event loop, so an idle stream costs one Event and a suspended
+coroutine (no thread), and a burst of writes to one account wakes its
+streams once. Publishing to an email nobody watches is a dict miss.
+"""
+import asyncio
+import os
+import threading
+
+# Streams one bank process will hold open
+MAX_STREAMS = int(os.getenv("BANK_MAX_STREAMS", "10000"))
+
+
+class BalanceEvents:
+    """email -> events of the streams watching it"""
+
+    def __init__(self, max_streams=MAX_STREAMS):
+        self.max_streams = max_streams
+        self._subscribers = {}  # email -> {event: loop}
+        self._lock = threading.Lock()
+        self.streams = 0
+        self.published = 0
+
+    def full(self):
+        return self.streams >= self.max_streams
+
+    def subscribe(self, email):
+        """An asyncio.Event set whenever email changes; call from the stream's event loop"""
+        event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._subscribers.setdefault(email, {})[event] = loop
+            self.streams += 1
+        return event
+
+    def unsubscribe(self, email, event):
+        with self._lock:
+            watchers = self._subscribers.get(email, {})
+            if watchers.pop(event, None) is not None:
+                self.streams -= 1
+            if not watchers:
+                self._subscribers.pop(email, None)
+
+    def publish(self, email):
+        """Wake every stream watching email; safe from any thread"""
+        if email not in self._subscribers:
+            return
+        with self._lock:
+            watchers = list(self._subscribers.get(email, {}).items())
+        self.published += 1
+        for event, loop in watchers:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass  # loop already closed; its stream is gone
+
+    def stats(self):
+        return {"streams": self.streams, "accounts": len(self._subscribers),
+                "max_streams": self.max_streams, "published": self.published}
@@ -0,0 +1,49 @@
+# shared/bank_jobs.py
+"""Background maintenance for the bank (hold expiry, snapshots, ...)"""
+import threading
+import time
+
+
+class PeriodicJobs:
+    """Runs registered functions on fixed intervals in one daemon thread.
+
+    The thread is started on demand rather than from a startup event,
+    because mounted apps (combined_app mounts the bank at /api) never
+    see their startup events.
+    """
+
+    def __init__(self, name="bank-jobs"):
+        self.name = name
+        self._jobs = []  # [interval, fn, next_run]
+        self._lock = threading.Lock()
+        self._thread = None
+        self.runs = {}
+        self.failures = {}
+
+    def every(self, seconds, fn):
+        """Register fn() to run every `seconds`"""
+        self._jobs.append([seconds, fn, time.monotonic() + seconds])
+        return fn
+
+    def start(self):
+        if self._thread is not None or not self._jobs:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            job = min(self._jobs, key=lambda j: j[2])
+            delay = job[2] - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            interval, fn, _ = job
+            try:
+                fn()
+                self.runs[fn.__name__] = self.runs.get(fn.__name__, 0) + 1
+            except Exception as e:
+                self.failures[fn.__name__] = self.failures.get(fn.__name__, 0) + 1
+                print(f"Bank job {fn.__name__} failed: {e}")
+            job[2] = time.monotonic() + interval
@@ -0,0 +1,146 @@
+# shared/bank_ledger.py
+"""Ledger snapshots and replay.
+
+The transactions table is the source of truth: accounts.tokens must
+equal the sum of an account's ledger rows. balance_snapshots stores
+that sum up to some ledger id, so rebuilding balances only has to read
+the ledger rows written after the last snapshot.
+"""
+import os
+import time
+
+# Ledger rows folded into snapshots per write transaction
+SNAPSHOT_CHUNK = int(os.getenv("BANK_SNAPSHOT_CHUNK", "50000"))
+# Ledger rows aggregated per read while replaying
+REPLAY_CHUNK = int(os.getenv("BANK_REPLAY_CHUNK", "500000"))
+# Ledger rows scanned per reconciliation read transaction
+RECON_CHUNK = int(os.getenv("BANK_RECON_CHUNK", "10000"))
+
+
+def get_meta(c, key, default=None):
+    row = c.execute('SELECT value FROM bank_meta WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else default
+
+
+def set_meta(c, key, value):
+    c.execute('''INSERT INTO bank_meta (key, value) VALUES (?, ?)
+                 ON CONFLICT (key) DO UPDATE SET value = excluded.value''', (key, value))
+
+
+def snapshot_balances(c, limit=SNAPSHOT_CHUNK):
+    """Fold up to `limit` ledger rows past the last snapshot into balance_snapshots.
+
+    Returns the number of ledger ids covered; 0 when snapshots are current.
+    Every account touched in the range gets a new snapshot at the range's
+    end, so each account's snapshot is always at or before the mark.
+    """
+    after = get_meta(c, "snapshot_tx_id", 0)
+    last = c.execute('SELECT COALESCE(MAX(id), 0) FROM transactions').fetchone()[0]
+    upto = min(after + limit, last)
+    if upto <= after:
+        return 0
+    c.execute('''INSERT INTO balance_snapshots (email, tx_id, tokens)
+                 SELECT t.email, ?, COALESCE(s.tokens, 0) + SUM(t.amount)
+                 FROM transactions t LEFT JOIN balance_snapshots s ON s.email = t.email
+                 WHERE t.id > ? AND t.id <= ?
+                 GROUP BY t.email
+                 ON CONFLICT (email) DO UPDATE SET tx_id = excluded.tx_id,
+                                                   tokens = excluded.tokens''',
+              (upto, after, upto))
+    set_meta(c, "snapshot_tx_id", upto)
+    return upto - after
+
+
+def ledger_balances(c, after_id=0, chunk=REPLAY_CHUNK):
+    """Sum ledger amounts per email for ids > after_id, reading in id-range chunks"""
+    last = c.execute('SELECT COALESCE(MAX(id), 0) FROM transactions').fetchone()[0]
+    totals = {}
+    lo = after_id
+    while lo < last:
+        hi = min(lo + chunk, last)
+        for email, amount in c.execute('''SELECT email, SUM(amount) FROM transactions
+                                          WHERE id > ? AND id <= ? GROUP BY email''', (lo, hi)):
+            totals[email] = totals.get(email, 0) + amount
+        lo = hi
+    return totals, last
+
+
+def rebuild_accounts(db, full=False, chunk=REPLAY_CHUNK):
+    """Recompute accounts.tokens (and held) from snapshots + ledger tail.
+
+    With full=True snapshots are ignored and the whole ledger is
+    replayed (and the snapshots are rewritten from the result). Runs in
+    one write transaction, so the bank should be stopped or quiet.
+    Returns a dict of counts and timings.
+    """
+    start = time.perf_counter()
+    with db.transaction("IMMEDIATE") as c:
+        mark = 0 if full else get_meta(c, "snapshot_tx_id", 0)
+        balances = {} if full else dict(c.execute('SELECT email, tokens FROM balance_snapshots'))
+        tail, last = ledger_balances(c, mark, chunk)
+        for email, amount in tail.items():
+            balances[email] = balances.get(email, 0) + amount
+        replayed = time.perf_counter() - start
+
+        c.execute('UPDATE accounts SET tokens = 0, version = version + 1')
+        c.executemany('''INSERT INTO accounts (email, tokens, version) VALUES (?, ?, 1)
+                         ON CONFLICT (email) DO UPDATE SET tokens = excluded.tokens''',
+                      balances.items())
+        c.execute('''UPDATE accounts SET held = COALESCE(
+                         (SELECT SUM(tokens) FROM holds WHERE holds.email = accounts.email), 0)''')
+        if full:
+            c.execute('DELETE FROM balance_snapshots')
+            c.executemany('INSERT INTO balance_snapshots VALUES (?, ?, ?)',
+                          ((email, last, tokens) for email, tokens in balances.items()))
+            set_meta(c, "snapshot_tx_id", last)
+    return {
+        "accounts": len(balances),
+        "ledger_rows_replayed": last - mark,
+        "replay_seconds": replayed,
+        "total_seconds": time.perf_counter() - start
+    }
+
+
+def ledger_emails(c, after_id, upto_id):
+    """Accounts with ledger rows in after_id < id <= upto_id"""
+    return [email for email, in c.execute(
+        'SELECT DISTINCT email FROM transactions WHERE id > ? AND id <= ?', (after_id, upto_id))]
+
+
+def verify_accounts(c, emails):
+    """(email, balance, expected) for each account whose balance != its ledger sum.
+
+    expected is the account's snapshot plus the ledger rows after it, so
+    only the tail since the last snapshot is read. Run inside one read
+    transaction for a consistent view.
+    """
+    mismatches = []
+    for email in emails:
+        snapshot = c.execute('SELECT tx_id, tokens FROM balance_snapshots WHERE email = ?',
+                             (email,)).fetchone()
+        after_id, expected = snapshot if snapshot else (0, 0)
+        expected += c.execute('''SELECT COALESCE(SUM(amount), 0) FROM transactions
+                                 WHERE email = ? AND id > ?''', (email, after_id)).fetchone()[0]
+        account = c.execute('SELECT tokens FROM accounts WHERE email = ?', (email,)).fetchone()
+        balance = account[0] if account else 0
+        if balance != expected:
+            mismatches.append((email, balance, expected))
+    return mismatches
+
+
+def record_reconciliation(c, after_id, upto_id, emails, mismatches):
+    """Store one verified chunk and move the checkpoint to upto_id.
+
+    A no-op if another run already moved the checkpoint past after_id.
+    Accounts verified clean in this chunk drop any earlier mismatch.
+    """
+    if get_meta(c, "recon_tx_id", 0) != after_id:
+        return False
+    now = int(time.time() * 1000)
+    c.executemany('DELETE FROM recon_mismatches WHERE email = ?', ((email,) for email in emails))
+    c.executemany('INSERT INTO recon_mismatches VALUES (?, ?, ?, ?, ?)',
+                  ((email, balance, expected, upto_id, now)
+                   for email, balance, expected in mismatches))
+    set_meta(c, "recon_tx_id", upto_id)
+    set_meta(c, "recon_last_run", now)
+    return True
@@ -0,0 +1,176 @@
+# shared/bank_limits.py
+"""In-process token-bucket rate limits for bank writes.
+
+Every spend or hold, batched or not, takes one token from its
+account's bucket and one from its app's bucket; a batched deposit takes
+one from its account's. A batch takes at most a full bucket, so one
+bigger than the bucket still goes through once the bucket has refilled.
+An empty bucket means a 429 without touching
+the database, so one runaway client cannot starve the ledger writer. The
+buckets live in each bank process; with several workers each enforces
+its own share.
+"""
+import heapq
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from pricing import ACCOUNT_TYPES, PRICING
+
+RATE_LIMITS = os.getenv("BANK_RATE_LIMITS", "on") != "off"
+# An account's bucket holds as many actions as its plan's monthly grant
+# buys at the cheapest paid price (at least ACCOUNT_MIN_BURST), and
+# refills completely every ACCOUNT_REFILL_SECONDS
+ACCOUNT_MIN_BURST = int(os.getenv("BANK_ACCOUNT_MIN_BURST", "10"))
+ACCOUNT_REFILL_SECONDS = float(os.getenv("BANK_ACCOUNT_REFILL_SECONDS", "60"))
+# Writes per second shared by all users of an app; apps not in PRICING
+# (registered at runtime) get less. Bursts of APP_BURST_SECONDS are allowed.
+APP_RATE = float(os.getenv("BANK_APP_RATE", "500"))
+UNKNOWN_APP_RATE = float(os.getenv("BANK_UNKNOWN_APP_RATE", "50"))
+APP_BURST_SECONDS = 2
+# Account buckets kept; the least recently used are dropped (and start full again)
+MAX_BUCKETS = int(os.getenv("BANK_RATE_MAX_BUCKETS", "100000"))
+# App buckets kept; past this, app names never seen before share one
+# bucket (at UNKNOWN_APP_RATE), so made-up names cannot grow the table
+MAX_APP_BUCKETS = int(os.getenv("BANK_RATE_MAX_APP_BUCKETS", "1000"))
+OVERFLOW_APP = "*"
+
+_CHEAPEST_ACTION = min(price for actions in PRICING.values() for price in actions.values() if price > 0)
+
+
+def plan_limit(plan):
+    """(capacity, tokens per second) of an account bucket for a plan"""
+    grant = ACCOUNT_TYPES.get(plan, ACCOUNT_TYPES["free"])["tokens"]
+    capacity = max(ACCOUNT_MIN_BURST, grant // _CHEAPEST_ACTION)
+    return capacity, capacity / ACCOUNT_REFILL_SECONDS
+
+
+def app_limit(app_id):
+    """(capacity, tokens per second) of an app bucket"""
+    rate = APP_RATE if app_id in PRICING else UNKNOWN_APP_RATE
+    return rate * APP_BURST_SECONDS, rate
+
+
+class TokenBucket:
+    __slots__ = ("capacity", "rate", "level", "updated")
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def current(self, now):
+        return min(self.capacity, self.level + (now - self.updated) * self.rate)
+
+    def refill(self, now):
+        self.level = self.current(now)
+        self.updated = now
+
+    def wait(self, cost=1):
+        """Seconds until `cost` tokens are available (0 when they are now)"""
+        return max(cost - self.level, 0) / self.rate
+
+
+class RateLimiter:
+    """Account and app buckets; plan_of(email) is only called for an account's first request"""
+
+    def __init__(self, plan_of, max_buckets=MAX_BUCKETS, enabled=RATE_LIMITS,
+                 max_app_buckets=MAX_APP_BUCKETS):
+        self.plan_of = plan_of
+        self.max_buckets = max_buckets
+        self.max_app_buckets = max_app_buckets
+        self.enabled = enabled
+        self._accounts = OrderedDict()  # email -> TokenBucket
+        self._apps = {}
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.rejected = {"account": 0, "app": 0}
+
+    def acquire(self, email, app_id):
+        """Take one token from both buckets; returns 0, or the seconds to wait if either is empty"""
+        return self.acquire_many([(email, app_id)])
+
+    def acquire_many(self, requests):
+        """acquire() for several (email, app_id or None) at once: all are allowed or none are.
+
+        A bucket is charged at most its capacity, however many items name it.
+        """
+        if not self.enabled:
+            return 0
+        fresh = {}
+        while True:
+            with self._lock:
+                missing = {email for email, _ in requests
+                           if email not in self._accounts and email not in fresh}
+                if not missing:
+                    return self._charge(requests, fresh)
+            # First requests from these accounts (or evicted): look up plans outside the lock
+            fresh.update((email, TokenBucket(*plan_limit(self.plan_of(email)))) for email in missing)
+
+    def _charge(self, requests, fresh):
+        charges = {}  # id(bucket) -> [bucket, kind, tokens to take]
+        for email, app_id in requests:
+            account = self._accounts.get(email)
+            if account is None:
+                account = self._accounts[email] = fresh[email]
+            else:
+                self._accounts.move_to_end(email)
+            charges.setdefault(id(account), [account, "account", 0])[2] += 1
+            if app_id is not None:
+                app = self._app_bucket(app_id)
+                charges.setdefault(id(app), [app, "app", 0])[2] += 1
+        while len(self._accounts) > self.max_buckets:
+            self._accounts.popitem(last=False)
+        now = time.monotonic()
+        for charge in charges.values():
+            bucket, kind, cost = charge
+            # Never more than the bucket holds, or the wait could not end
+            charge[2] = cost = min(cost, bucket.capacity)
+            bucket.refill(now)
+            wait = bucket.wait(cost)
+            if wait:
+                self.rejected[kind] += 1
+                return wait
+        for bucket, _, cost in charges.values():
+            bucket.level -= cost
+        self.allowed += len(requests)
+        return 0
+
+    def _app_bucket(self, app_id):
+        """An app's bucket, or the shared overflow bucket once there are max_app_buckets"""
+        app = self._apps.get(app_id)
+        if app is None:
+            if len(self._apps) >= self.max_app_buckets and app_id not in PRICING:
+                app_id = OVERFLOW_APP
+                app = self._apps.get(app_id)
+            if app is None:
+                app = self._apps[app_id] = TokenBucket(*app_limit(app_id))
+        return app
+
+    def forget(self, email):
+        """Drop an account's bucket, e.g. after a plan change"""
+        with self._lock:
+            self._accounts.pop(email, None)
+
+    def stats(self, limit=20):
+        """Counters, every app bucket and the `limit` emptiest account buckets"""
+        with self._lock:
+            now = time.monotonic()
+            accounts = heapq.nsmallest(limit, self._accounts.items(),
+                                       key=lambda item: item[1].current(now) / item[1].capacity)
+            return {
+                "enabled": self.enabled,
+                "allowed": self.allowed,
+                "rejected": dict(self.rejected),
+                "account_buckets": len(self._accounts),
+                "apps": {app_id: {"level": round(b.current(now), 2), "capacity": b.capacity,
+                                  "per_second": b.rate}
+                         for app_id, b in sorted(self._apps.items())},
+                "lowest_accounts": [
+                    {"email": email, "level": round(b.current(now), 2), "capacity": b.capacity,
+                     "per_second": round(b.rate, 3)}
+                    for email, b in accounts
+                ]
+            }
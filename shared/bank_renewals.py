@@ -0,0 +1,103 @@
+# shared/bank_renewals.py
+"""Monthly plan grants (pricing.ACCOUNT_TYPES).
+
+Accounts on a plan schedule have accounts.renews_at set. Each call to
+renew_due grants one chunk of due accounts with a handful of set-based
+statements, and moves their renews_at a month ahead in the same
+transaction, so a run can stop anywhere and the next one simply picks
+up whatever is still due. Accounts that missed several months (e.g.
+the bank was down) are granted once per missed month.
+
+Renewals stay on the day of the month of the first one
+(accounts.renewal_day), or the month's last day when it is shorter:
+Jan 31, Feb 28, Mar 31. A team stripe (accounts.stripes set) is granted
+its share of the team's plan, split like a team deposit, and the
+rollover policy weighs that share against the stripe's own balance.
+"""
+import os
+import time
+
+from pricing import ACCOUNT_TYPES
+from shared.bank_ledger import set_meta
+from shared.bank_schema import DAY_MS, SQL_ADD_USAGE_ROWS
+
+# Accounts granted per transaction
+RENEWAL_CHUNK = int(os.getenv("BANK_RENEWAL_CHUNK", "5000"))
+# What happens to tokens left over at renewal; see ROLLOVER_POLICIES
+ROLLOVER = os.getenv("BANK_ROLLOVER", "full")
+# For the "cap" policy: the grant never lifts a balance above this many grants
+ROLLOVER_CAP = float(os.getenv("BANK_ROLLOVER_CAP", "2"))
+
+# Tokens credited to account `a` whose plan grants `g.tokens`. Balances
+# only ever go up here, so purchased tokens are never taken away.
+ROLLOVER_POLICIES = {
+    "full": "g.tokens",                         # leftovers carry over in full
+    "none": "MAX(g.tokens - a.tokens, 0)",      # top up to the grant
+    "cap": "MIN(g.tokens, MAX(CAST(g.tokens * {cap} AS INTEGER) - a.tokens, 0))",
+}
+
+# What an account's plan grants it: a stripe "<team>#<k>" of `stripes`
+# gets the grant // stripes, plus one for the first grant % stripes
+# stripes (as central_bank._deposit_striped splits a deposit)
+_STRIPE = "CAST(substr(a.email, instr(a.email, '#') + 1) AS INTEGER)"
+_GRANT = f"""CASE WHEN a.stripes IS NULL THEN g.tokens
+                  ELSE g.tokens / a.stripes + ({_STRIPE} < g.tokens % a.stripes) END"""
+
+# The next renewal: same time of day, next month, on renewal_day
+# (renews_at's own day on a first renewal) or that month's last day.
+# Stepping '+1 month' from each renewal would drift: Jan 31, Mar 3, Apr 3.
+_DAY = "CAST(strftime('%d', renews_at / 1000, 'unixepoch') AS INTEGER)"
+_MONTH = "renews_at / 1000, 'unixepoch', 'start of month'"
+_NEXT_MONTH = f"""CAST(strftime('%s', {_MONTH}, '+1 month') AS INTEGER) * 1000
+                  + (MIN(COALESCE(renewal_day, {_DAY}),
+                         CAST(strftime('%d', {_MONTH}, '+2 months', '-1 day') AS INTEGER)) - 1) * {DAY_MS}
+                  + renews_at % {DAY_MS}"""
+
+
+def renew_due(c, cutoff_ms, limit=RENEWAL_CHUNK, rollover=ROLLOVER, cap=ROLLOVER_CAP, email=None):
+    """Grant up to `limit` accounts due at cutoff_ms (or just `email`) on connection c.
+
+    The caller owns the transaction. Returns the accounts renewed, the
+    tokens granted and, under "_accounts", the new (email, tokens, held,
+    version) of each renewed account for the balance cache.
+    """
+    if rollover not in ROLLOVER_POLICIES:
+        raise ValueError(f"unknown rollover policy {rollover!r}")
+    credit = ROLLOVER_POLICIES[rollover].format(cap=float(cap))
+    grants = ", ".join("(?, ?)" for _ in ACCOUNT_TYPES)
+    params = [value for plan, spec in ACCOUNT_TYPES.items() for value in (plan, spec["tokens"])]
+    where = "a.renews_at <= ?" + (" AND a.email = ?" if email else "")
+    params += [cutoff_ms, email] if email else [cutoff_ms]
+
+    c.execute('CREATE TEMP TABLE IF NOT EXISTS renewal (email TEXT PRIMARY KEY, plan TEXT, credit INTEGER)')
+    c.execute('DELETE FROM temp.renewal')
+    # Unknown plans are renewed with a zero grant so they don't stay due forever.
+    # g is each due account's own grant (its share, for a team stripe).
+    c.execute(f'''INSERT INTO temp.renewal (email, plan, credit)
+                  WITH grants (plan, tokens) AS (VALUES {grants}),
+                       due (email, tokens) AS (
+                           SELECT a.email, {_GRANT}
+                           FROM accounts a LEFT JOIN grants g ON g.plan = a.plan
+                           WHERE {where}
+                           ORDER BY a.renews_at LIMIT ?)
+                  SELECT a.email, a.plan, COALESCE({credit}, 0)
+                  FROM due g JOIN accounts a ON a.email = g.email''', params + [limit])
+    accounts = c.execute(f'''UPDATE accounts SET tokens = tokens + r.credit, version = version + 1,
+                                                renews_at = {_NEXT_MONTH},
+                                                renewal_day = COALESCE(renewal_day, {_DAY})
+                             FROM temp.renewal r WHERE accounts.email = r.email
+                             RETURNING accounts.email, tokens, held, version''').fetchall()
+    if not accounts:
+        return {"accounts": 0, "tokens": 0, "_accounts": []}
+
+    now = int(time.time() * 1000)
+    c.execute('''INSERT INTO transactions (email, amount, app_id, description, ts)
+                 SELECT email, credit, NULL, 'Monthly ' || plan || ' plan grant', ?
+                 FROM temp.renewal WHERE credit > 0 ORDER BY email''', (now,))
+    totals = c.execute('''SELECT plan, SUM(credit), COUNT(*) FROM temp.renewal
+                          WHERE credit > 0 GROUP BY plan''').fetchall()
+    c.executemany(SQL_ADD_USAGE_ROWS, ((now // DAY_MS, 0, plan, 0, tokens, count)
+                                       for plan, tokens, count in totals))
+    set_meta(c, "renewal_last_run", now)
+    return {"accounts": len(accounts), "tokens": sum(tokens for _, tokens, _ in totals),
+            "_accounts": accounts}
@@ -0,0 +1,105 @@
+# shared/bank_replica.py
+"""Read-only copy of a bank file for reports, exports and debugging.
+
+The copy is taken with SQLite's online backup API, a few hundred pages
+per step with a pause in between. The copying connection holds one
+read transaction for the whole run; under WAL that never blocks the
+writer, and it pins the snapshot so commits during the copy do not
+restart it. The finished copy replaces the old one atomically, and
+readers move to it on their next connection().
+"""
+import os
+import sqlite3
+import threading
+import time
+
+# How often the bank refreshes its copies
+REPLICA_SECONDS = float(os.getenv("BANK_REPLICA_SECONDS", "300"))
+# Pages copied per backup step, and the pause between steps
+BACKUP_PAGES = int(os.getenv("BANK_BACKUP_PAGES", "1000"))
+BACKUP_PAUSE = float(os.getenv("BANK_BACKUP_PAUSE", "0.005"))
+
+
+def replica_path(path):
+    root, ext = os.path.splitext(path)
+    return f"{root}.replica{ext or '.db'}"
+
+
+def connect_readonly(path):
+    """A read-only connection to a database file that must already exist"""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, isolation_level=None,
+                           check_same_thread=False)
+    conn.execute("PRAGMA query_only = ON")
+    return conn
+
+
+def open_replica(path):
+    """Read-only connection to a bank file's copy, or to the file itself if it has none"""
+    copy = replica_path(path)
+    return connect_readonly(copy if os.path.exists(copy) else path)
+
+
+def backup(source_path, target_path, pages=BACKUP_PAGES, pause=BACKUP_PAUSE):
+    """Copy a live database into target_path step by step; returns the pages copied"""
+    source = sqlite3.connect(source_path, isolation_level=None)
+    target = sqlite3.connect(target_path)
+    try:
+        # Pin one snapshot for every step (see module docstring)
+        source.execute("BEGIN")
+        source.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+        copied = []
+        source.backup(target, pages=pages, sleep=pause,
+                      progress=lambda status, remaining, total: copied.append(total))
+        source.execute("COMMIT")
+        # The copy inherits WAL mode; a rollback journal lets it be opened read-only
+        target.execute("PRAGMA journal_mode = DELETE")
+    finally:
+        target.close()
+        source.close()
+    return copied[-1] if copied else 0
+
+
+class Replica:
+    """Refreshable read-only copy of one pooled database"""
+
+    def __init__(self, source, path=None):
+        self.source = source
+        self.path = path or replica_path(source.path)
+        self.generation = 0  # bumped by each refresh; 0 = no copy yet, read the source
+        self.refreshed_at = None
+        self.last_refresh = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def refresh(self, pages=BACKUP_PAGES, pause=BACKUP_PAUSE):
+        """Take a new copy and switch readers to it"""
+        with self._lock:
+            start = time.perf_counter()
+            # Unique per process, in case several bank workers refresh at once
+            temporary = f"{self.path}.{os.getpid()}.tmp"
+            copied = backup(self.source.path, temporary, pages, pause)
+            os.replace(temporary, self.path)
+            self.generation += 1
+            self.refreshed_at = time.time()
+            self.last_refresh = {"pages": copied, "seconds": time.perf_counter() - start}
+            return self.last_refresh
+
+    def connection(self):
+        """This thread's connection to the newest copy (the source's until the first refresh)"""
+        if not self.generation:
+            return self.source.connection()
+        conn, generation = getattr(self._local, "conn", (None, 0))
+        if generation != self.generation:
+            if conn is not None:
+                conn.close()
+            conn = connect_readonly(self.path)
+            self._local.conn = (conn, self.generation)
+        return conn
+
+    def status(self):
+        return {
+            "path": self.path,
+            "refreshed_at": self.refreshed_at,
+            "age_seconds": time.time() - self.refreshed_at if self.refreshed_at else None,
+            "last_refresh": self.last_refresh
+        }
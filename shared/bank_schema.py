@@ -0,0 +1,251 @@
+# shared/bank_schema.py
+"""bank.db schema migrations (applied by shared.bank_db.migrate)"""
+import os
+from pricing import PRICING
+
+# Legacy rows copied per transaction by the online v3 migration
+MIGRATION_CHUNK = int(os.getenv("BANK_MIGRATION_CHUNK", "50000"))
+
+
+def _ensure_column(c, table, column, decl):
+    """Add a column to a table created by an older version of the bank"""
+    if column not in [row[1] for row in c.execute(f"PRAGMA table_info({table})")]:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _schema_v1(c):
+    """Base tables (also adopts databases from before versioning)"""
+    c.execute('''CREATE TABLE IF NOT EXISTS accounts
+                 (email TEXT PRIMARY KEY, tokens INTEGER DEFAULT 0, held INTEGER DEFAULT 0)''')
+    _ensure_column(c, "accounts", "held", "INTEGER DEFAULT 0")
+    c.execute('''CREATE TABLE IF NOT EXISTS transactions
+                 (id TEXT, email TEXT, amount INTEGER, description TEXT, timestamp DATETIME)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS holds
+                 (id TEXT PRIMARY KEY, email TEXT, app_id TEXT, tokens INTEGER,
+                  description TEXT, expires_at REAL)''')
+    c.execute('CREATE INDEX IF NOT EXISTS holds_expiry ON holds (expires_at)')
+
+
+def _schema_v2(c):
+    """Per-user history lookups"""
+    c.execute('CREATE INDEX IF NOT EXISTS transactions_email_time ON transactions (email, timestamp)')
+
+
+# --- v3: compact transactions -------------------------------------------
+#
+# Legacy rows carry a random hex id, a DATETIME string and the app id
+# baked into the description ("prompt_wizard: ..."). The compact table
+# uses the rowid as primary key, epoch-ms timestamps and a small integer
+# reference into `apps`. Rows keep their legacy rowid as their new id,
+# so "copied so far" is simply MAX(id) and the copy can resume anywhere.
+
+def prepare_compact_transactions(c):
+    """Create the apps table and the empty compact transactions table"""
+    c.execute('''CREATE TABLE IF NOT EXISTS apps
+                 (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)''')
+    # Seed in PRICING order so every bank file gives the wizards the same ids
+    c.executemany('INSERT OR IGNORE INTO apps (id, name) VALUES (?, ?)',
+                  enumerate(PRICING, start=1))
+    c.execute('''CREATE TABLE IF NOT EXISTS transactions_v3
+                 (id INTEGER PRIMARY KEY, email TEXT NOT NULL, amount INTEGER NOT NULL,
+                  app_id INTEGER REFERENCES apps (id), description TEXT, ts INTEGER NOT NULL)''')
+
+
+# Spends were recorded as "<app_id>: <description>"
+_LEGACY_APP = "substr(description, 1, instr(description, ': ') - 1)"
+_IS_APP_ROW = "amount <= 0 AND instr(description, ': ') > 1"
+
+
+def copy_legacy_transactions(c, limit):
+    """Copy the next `limit` legacy rows into transactions_v3; returns rows copied"""
+    last = c.execute('SELECT COALESCE(MAX(id), 0) FROM transactions_v3').fetchone()[0]
+    chunk = f'''SELECT rowid AS old_id, email, amount, description, timestamp,
+                       CASE WHEN {_IS_APP_ROW} THEN {_LEGACY_APP} END AS app_name
+                FROM transactions WHERE rowid > {int(last)} ORDER BY rowid LIMIT {int(limit)}'''
+    c.execute(f'''INSERT OR IGNORE INTO apps (name)
+                  SELECT DISTINCT app_name FROM ({chunk}) WHERE app_name IS NOT NULL''')
+    return c.execute(f'''
+        INSERT INTO transactions_v3 (id, email, amount, app_id, description, ts)
+        SELECT t.old_id, t.email, t.amount, a.id,
+               CASE WHEN a.id IS NULL THEN t.description
+                    ELSE substr(t.description, instr(t.description, ': ') + 2) END,
+               COALESCE(CAST(ROUND((julianday(t.timestamp) - 2440587.5) * 86400000) AS INTEGER), 0)
+        FROM ({chunk}) t
+        LEFT JOIN apps a ON a.name = t.app_name
+        ORDER BY t.old_id''').rowcount
+
+
+def _schema_v3(c):
+    """Integer rowids, epoch-ms timestamps and interned app ids.
+
+    Runs under the write lock; whatever `bank_admin.py migrate --online`
+    has already copied in small transactions is skipped.
+    """
+    prepare_compact_transactions(c)
+    while copy_legacy_transactions(c, MIGRATION_CHUNK):
+        pass
+    c.execute('DROP TABLE transactions')
+    c.execute('ALTER TABLE transactions_v3 RENAME TO transactions')
+    c.execute('CREATE INDEX transactions_email_ts ON transactions (email, ts)')
+    c.execute('CREATE INDEX transactions_app_ts ON transactions (app_id, ts)')
+
+
+# --- v4: plans and daily usage rollup -----------------------------------
+
+DAY_MS = 86400000
+
+def _schema_v4(c):
+    """Account plans and the per-app, per-plan, per-day usage rollup"""
+    _ensure_column(c, "accounts", "plan", "TEXT NOT NULL DEFAULT 'free'")
+    # app_id 0 collects ledger rows that belong to no app (deposits)
+    c.execute('''CREATE TABLE IF NOT EXISTS usage_daily
+                 (day INTEGER NOT NULL, app_id INTEGER NOT NULL, plan TEXT NOT NULL,
+                  spent INTEGER NOT NULL DEFAULT 0, deposited INTEGER NOT NULL DEFAULT 0,
+                  transactions INTEGER NOT NULL DEFAULT 0,
+                  PRIMARY KEY (day, app_id, plan)) WITHOUT ROWID''')
+
+
+_USAGE_UPSERT = '''ON CONFLICT (day, app_id, plan) DO UPDATE SET
+                       spent = spent + excluded.spent,
+                       deposited = deposited + excluded.deposited,
+                       transactions = transactions + excluded.transactions'''
+
+# Bumps one rollup row: (day, app_id, plan, spent, deposited)
+SQL_ADD_USAGE = f'''INSERT INTO usage_daily (day, app_id, plan, spent, deposited, transactions)
+                     VALUES (?, ?, ?, ?, ?, 1) {_USAGE_UPSERT}'''
+# Same for several ledger rows at once: (day, app_id, plan, spent, deposited, transactions)
+SQL_ADD_USAGE_ROWS = f'''INSERT INTO usage_daily (day, app_id, plan, spent, deposited, transactions)
+                          VALUES (?, ?, ?, ?, ?, ?) {_USAGE_UPSERT}'''
+
+
+def backfill_usage(c, after_id, last_id):
+    """Fold ledger rows after_id < id <= last_id into usage_daily.
+
+    History is attributed to each account's current plan, since the
+    ledger does not record the plan at the time of the spend.
+    """
+    c.execute(f'''INSERT INTO usage_daily (day, app_id, plan, spent, deposited, transactions)
+                   SELECT t.ts / {DAY_MS}, COALESCE(t.app_id, 0), COALESCE(a.plan, 'free'),
+                          SUM(MAX(-t.amount, 0)), SUM(MAX(t.amount, 0)), COUNT(*)
+                   FROM transactions t LEFT JOIN accounts a ON a.email = t.email
+                   WHERE t.id > ? AND t.id <= ?
+                   GROUP BY 1, 2, 3
+                   {_USAGE_UPSERT}''', (after_id, last_id))
+
+
+def merge_usage(c, schema):
+    """Add the usage_daily rows of an attached bank database into this one.
+
+    App ids are matched by name, since runtime-registered apps can have
+    different ids in different files.
+    """
+    c.execute(f'''INSERT INTO usage_daily (day, app_id, plan, spent, deposited, transactions)
+                   SELECT u.day, COALESCE(a.id, 0), u.plan, u.spent, u.deposited, u.transactions
+                   FROM {schema}.usage_daily u
+                   LEFT JOIN {schema}.apps sa ON sa.id = u.app_id
+                   LEFT JOIN apps a ON a.name = sa.name
+                   WHERE true
+                   {_USAGE_UPSERT}''')
+
+
+# --- v5: account versions -----------------------------------------------
+
+def _schema_v5(c):
+    """accounts.version, bumped by every write (orders balance cache updates)"""
+    _ensure_column(c, "accounts", "version", "INTEGER NOT NULL DEFAULT 0")
+
+
+# --- v6: ledger as source of truth --------------------------------------
+
+def _schema_v6(c):
+    """Append-only ledger, balance snapshots and a key/value table for job state"""
+    c.execute('''CREATE TABLE IF NOT EXISTS bank_meta
+                 (key TEXT PRIMARY KEY, value) WITHOUT ROWID''')
+    # tokens = sum of the account's ledger rows with id <= tx_id
+    c.execute('''CREATE TABLE IF NOT EXISTS balance_snapshots
+                 (email TEXT PRIMARY KEY, tx_id INTEGER NOT NULL, tokens INTEGER NOT NULL)
+                 WITHOUT ROWID''')
+    for action in ("UPDATE", "DELETE"):
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS transactions_no_{action.lower()}
+                      BEFORE {action} ON transactions
+                      BEGIN SELECT RAISE(ABORT, 'transactions is append-only'); END''')
+
+
+# --- v7: reconciliation -------------------------------------------------
+
+def _schema_v7(c):
+    """Accounts whose balance disagrees with the ledger"""
+    c.execute('''CREATE TABLE IF NOT EXISTS recon_mismatches
+                 (email TEXT PRIMARY KEY, balance INTEGER NOT NULL, expected INTEGER NOT NULL,
+                  checked_tx_id INTEGER NOT NULL, detected_at INTEGER NOT NULL) WITHOUT ROWID''')
+
+
+# --- v8: team accounts --------------------------------------------------
+
+def _schema_v8(c):
+    """Team accounts whose balance is split over `stripes` sub-accounts"""
+    c.execute('''CREATE TABLE IF NOT EXISTS teams
+                 (team TEXT PRIMARY KEY, stripes INTEGER NOT NULL, plan TEXT NOT NULL,
+                  created_at INTEGER NOT NULL) WITHOUT ROWID''')
+
+
+# --- v9: idempotency keys -----------------------------------------------
+
+def _schema_v9(c):
+    """Stored responses of keyed requests; response is NULL while one is in progress"""
+    c.execute('''CREATE TABLE IF NOT EXISTS idempotency_keys
+                 (key TEXT PRIMARY KEY, request_hash TEXT NOT NULL, response TEXT,
+                  expires_at INTEGER NOT NULL) WITHOUT ROWID''')
+    c.execute('CREATE INDEX IF NOT EXISTS idempotency_expiry ON idempotency_keys (expires_at)')
+
+
+# --- v10: plan renewals -------------------------------------------------
+
+def _schema_v10(c):
+    """accounts.renews_at (epoch ms of the next plan grant; NULL = not on a plan schedule)"""
+    _ensure_column(c, "accounts", "renews_at", "INTEGER")
+    c.execute('''CREATE INDEX IF NOT EXISTS accounts_renews_at ON accounts (renews_at)
+                 WHERE renews_at IS NOT NULL''')
+
+
+# --- v11: renewal days and team grants ------------------------------------
+
+def _schema_v11(c):
+    """accounts.renewal_day (the day of the month renewals fall on, set by
+    the first one) and accounts.stripes (on team stripes: how many stripes
+    share the team's plan grant; NULL on every other account)"""
+    _ensure_column(c, "accounts", "renewal_day", "INTEGER")
+    _ensure_column(c, "accounts", "stripes", "INTEGER")
+
+
+# --- v12: team rebalance transfers ---------------------------------------
+
+def _schema_v12(c):
+    """Team rebalance moves debited on this shard and not yet known to be
+    credited on the target stripe's shard (replayed at startup)"""
+    c.execute('''CREATE TABLE IF NOT EXISTS stripe_transfers
+                 (id TEXT PRIMARY KEY, target TEXT NOT NULL, tokens INTEGER NOT NULL,
+                  created_at INTEGER NOT NULL) WITHOUT ROWID''')
+
+
+# --- v13: hold expiry in ms ----------------------------------------------
+
+def _schema_v13(c):
+    """holds.expires_at in epoch ms, like every other timestamp (was REAL seconds).
+
+    Holds live minutes at most, so the table is simply rebuilt.
+    """
+    c.execute('''CREATE TABLE holds_v13
+                 (id TEXT PRIMARY KEY, email TEXT, app_id TEXT, tokens INTEGER,
+                  description TEXT, expires_at INTEGER NOT NULL)''')
+    c.execute('''INSERT INTO holds_v13 (id, email, app_id, tokens, description, expires_at)
+                 SELECT id, email, app_id, tokens, description, CAST(expires_at * 1000 AS INTEGER)
+                 FROM holds''')
+    c.execute('DROP TABLE holds')
+    c.execute('ALTER TABLE holds_v13 RENAME TO holds')
+    c.execute('CREATE INDEX holds_expiry ON holds (expires_at)')
+
+
+MIGRATIONS = [_schema_v1, _schema_v2, _schema_v3, _schema_v4, _schema_v5, _schema_v6,
+              _schema_v7, _schema_v8, _schema_v9, _schema_v10, _schema_v11, _schema_v12,
+              _schema_v13]
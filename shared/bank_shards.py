@@ -0,0 +1,136 @@
+# shared/bank_shards.py
+"""Hash-partitioned bank storage.
+
+With BANK_SHARDS=N (default 1) accounts are spread over N database
+files by a stable hash of the email. Each file has its own connection
+pool and its own group-commit writer, so writes to different shards no
+longer queue behind one SQLite write lock. N=1 is plain bank.db.
+
+Everything about one account (balance, holds, ledger rows, snapshots)
+lives on that account's shard; usage_daily is a plain rollup, so /usage
+sums it over all shards. Changing N is an offline job:
+`bank_admin.py reshard --to N`.
+"""
+import os
+import time
+import zlib
+
+from shared.bank_db import DB_PATH, PRAGMA_PROFILE, ConnectionPool
+from shared.bank_schema import merge_usage
+from shared.bank_writer import LedgerWriter
+
+SHARD_COUNT = int(os.getenv("BANK_SHARDS", "1"))
+
+
+def shard_path(base, index, count):
+    """Database file of shard `index` out of `count` (bank.db when unsharded)"""
+    if count == 1:
+        return base
+    root, ext = os.path.splitext(base)
+    return f"{root}.{index}-of-{count}{ext or '.db'}"
+
+
+def shard_index(email, count):
+    """Shard an email belongs to; crc32 is stable across processes, unlike hash().
+
+    Stripe keys "<key>#<k>" go to the k-th shard after <key>'s, so the
+    stripes of a team account land on different shards.
+    """
+    if count == 1:
+        return 0
+    base, sep, stripe = email.rpartition("#")
+    if sep and stripe.isdigit():
+        return (zlib.crc32(base.encode()) + int(stripe)) % count
+    return zlib.crc32(email.encode()) % count
+
+
+def key_shard(key, count):
+    """Shard an idempotency key is stored on, None for keys every shard keeps.
+
+    Client keys name their account ("spend:<email>:<key>", see
+    shared.bank_storage.client_key); payment:<id> keys do not, so a
+    reshard copies those to every shard.
+    """
+    kind, _, rest = key.partition(":")
+    if kind in ("spend", "hold"):
+        return shard_index(rest.partition(":")[0], count)
+    return None
+
+
+class ShardRouter:
+    """Per-shard connection pools and writers, looked up by email"""
+
+    def __init__(self, base=DB_PATH, count=SHARD_COUNT, profile=PRAGMA_PROFILE, pools=None):
+        self.count = count
+        self.pools = pools or [ConnectionPool(shard_path(base, i, count), profile)
+                               for i in range(count)]
+        self.writers = [LedgerWriter(p) for p in self.pools]
+
+    def index(self, email):
+        return shard_index(email, self.count)
+
+    def pool(self, email):
+        return self.pools[self.index(email)]
+
+    def writer(self, email):
+        return self.writers[self.index(email)]
+
+    def stop(self):
+        for writer in self.writers:
+            writer.stop()
+
+
+def copy_into_shard(db, source_path, index, count, usage=False):
+    """Copy the accounts of one bank file that hash to shard `index` of `count` into db.
+
+    db must already be migrated. Balances, team registrations, holds,
+    unfinished team transfers and ledger rows move as they are; ledger rows get new ids on the target (in source order),
+    so snapshots and the reconciliation checkpoint start over and the
+    bank's jobs rebuild them. With usage=True the source's usage_daily
+    rollup is merged in as well (do that for exactly one target shard).
+    Unexpired idempotency keys are copied too (see key_shard), so a
+    repeated payment or request is still recognised afterwards.
+    Returns (accounts, ledger rows) copied.
+    """
+    conn = db.connection()
+    conn.create_function("bank_shard", 1, lambda email: shard_index(email, count),
+                         deterministic=True)
+    conn.create_function("bank_key_shard", 1, lambda key: key_shard(key, count), deterministic=True)
+    # ATTACH is not allowed inside a transaction
+    conn.execute("ATTACH DATABASE ? AS src", (source_path,))
+    try:
+        with db.transaction("IMMEDIATE") as c:
+            c.execute('INSERT OR IGNORE INTO apps (name) SELECT name FROM src.apps ORDER BY id')
+            accounts = c.execute('''INSERT INTO accounts (email, tokens, held, plan, version, renews_at,
+                                                          renewal_day, stripes)
+                                    SELECT email, tokens, held, plan, version, renews_at,
+                                           renewal_day, stripes
+                                    FROM src.accounts
+                                    WHERE bank_shard(email) = ?''', (index,)).rowcount
+            # A team's row lives on the shard its name hashes to, like an account
+            c.execute('''INSERT INTO teams (team, stripes, plan, created_at)
+                         SELECT team, stripes, plan, created_at FROM src.teams
+                         WHERE bank_shard(team) = ?''', (index,))
+            # Unfinished rebalance transfers follow their target stripe
+            c.execute('''INSERT INTO stripe_transfers (id, target, tokens, created_at)
+                         SELECT id, target, tokens, created_at FROM src.stripe_transfers
+                         WHERE bank_shard(target) = ?''', (index,))
+            c.execute('''INSERT INTO holds (id, email, app_id, tokens, description, expires_at)
+                         SELECT id, email, app_id, tokens, description, expires_at FROM src.holds
+                         WHERE bank_shard(email) = ?''', (index,))
+            rows = c.execute('''INSERT INTO transactions (email, amount, app_id, description, ts)
+                                SELECT t.email, t.amount, a.id, t.description, t.ts
+                                FROM src.transactions t
+                                LEFT JOIN src.apps sa ON sa.id = t.app_id
+                                LEFT JOIN apps a ON a.name = sa.name
+                                WHERE bank_shard(t.email) = ?
+                                ORDER BY t.id''', (index,)).rowcount
+            c.execute('''INSERT OR IGNORE INTO idempotency_keys (key, request_hash, response, expires_at)
+                         SELECT key, request_hash, response, expires_at FROM src.idempotency_keys
+                         WHERE expires_at > ? AND COALESCE(bank_key_shard(key), ?) = ?''',
+                      (int(time.time() * 1000), index, index))
+            if usage:
+                merge_usage(c, "src")
+    finally:
+        conn.execute("DETACH DATABASE src")
+    return accounts, rows
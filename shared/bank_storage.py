@@ -0,0 +1,269 @@
+# shared/bank_storage.py
+"""Storage engines behind the bank's account, ledger and hold routes.
+
+central_bank talks to a BankStorage for deposits, spends, holds and
+balance reads. SqliteStorage (in central_bank) is the real ledger;
+MemoryStorage keeps everything in dicts, to benchmark the HTTP and
+business layers without disk, or to run checks fast. Both follow the
+same rules, down to the HTTPException each failure raises; see
+`bank_bench.py conformance`. Batches, teams, plans and renewals,
+history and reports are SQLite only: with the memory engine their
+routes answer 501 (central_bank's /health lists them), their periodic
+jobs are not scheduled and no database file is opened.
+
+Mutations return the same dicts as central_bank's apply_* functions:
+the response, plus "_accounts" (email, tokens, held, version) for the
+balance cache.
+"""
+import hashlib
+import itertools
+import json
+import os
+import secrets
+import threading
+import time
+
+from fastapi import HTTPException
+
+# "sqlite" or "memory"
+STORAGE_ENGINE = os.getenv("BANK_STORAGE", "sqlite")
+# Locks in MemoryStorage; accounts hash onto them
+MEMORY_STRIPES = int(os.getenv("BANK_MEMORY_STRIPES", "64"))
+
+
+def request_fingerprint(name, request):
+    """Hash of an operation and its request, stored with its idempotency key"""
+    return hashlib.sha256(json.dumps([name, vars(request)], sort_keys=True).encode()).hexdigest()
+
+
+def client_key(name, email, key):
+    """Where a client's Idempotency-Key is stored: scoped to the operation
+    and account, so it can never collide with another account's keys or
+    with the bank's own payment:<id> keys. None stays None."""
+    return f"{name}:{email}:{key}" if key else None
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+def _response(result):
+    return {k: v for k, v in result.items() if not k.startswith("_")}
+
+
+def _replayed(response):
+    return {**response, "_accounts": [], "_replayed": True}
+
+
+class BankStorage:
+    """Accounts, ledger and holds; `key` arguments are Idempotency-Key values"""
+
+    def account(self, email):
+        """(tokens, held, version), (0, 0, 0) for an unknown account"""
+        raise NotImplementedError
+
+    def plan(self, email):
+        """An account's plan (pricing.ACCOUNT_TYPES), "free" when it has none"""
+        raise NotImplementedError
+
+    def deposit(self, deposit):
+        """Credit a Deposit once per payment_id"""
+        raise NotImplementedError
+
+    def spend(self, spend, key=None):
+        raise NotImplementedError
+
+    def reserve(self, hold, key=None):
+        raise NotImplementedError
+
+    def capture(self, hold_id, capture):
+        raise NotImplementedError
+
+    def release(self, hold_id):
+        raise NotImplementedError
+
+    def expire_holds(self):
+        """Release every hold past its expiry"""
+        raise NotImplementedError
+
+    def ledger(self, email, limit=50):
+        """Newest-first (amount, app_id, description, ts) rows of an account"""
+        raise NotImplementedError
+
+    def verify(self):
+        """Invariant violations, empty when healthy; run it while the bank is quiet"""
+        raise NotImplementedError
+
+
+class MemoryStorage(BankStorage):
+    """Dict-backed engine; one lock per stripe of accounts.
+
+    An operation holds the lock of its account's stripe, so writes to
+    different stripes never wait on each other. Idempotency keys never
+    expire; nothing here outlives the process anyway.
+    """
+
+    def __init__(self, stripes=MEMORY_STRIPES):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self._accounts = {}  # email -> [tokens, held, version]
+        self._ledger = {}  # email -> [(id, amount, app_id, description, ts)], oldest first
+        self._holds = {}  # hold id -> (email, app_id, tokens, description, expires_at ms)
+        self._keys = {}  # key -> (fingerprint, response)
+        self._ids = itertools.count(1)
+
+    def _lock(self, email):
+        return self._locks[hash(email) % len(self._locks)]
+
+    def _state(self, email):
+        tokens, held, version = self._accounts[email]
+        return email, tokens, held, version
+
+    def _record(self, email, amount, app_id, description):
+        self._ledger.setdefault(email, []).append(
+            (next(self._ids), amount, app_id, description, _now_ms()))
+
+    def _once(self, email, key, name, apply, request):
+        with self._lock(email):
+            if key is None:
+                return apply(request)
+            fingerprint = request_fingerprint(name, request)
+            stored = self._keys.get(key)
+            if stored is not None:
+                if stored[0] != fingerprint:
+                    raise HTTPException(status_code=422,
+                                        detail="Idempotency key was already used for a different request")
+                return _replayed(stored[1])
+            result = apply(request)
+            self._keys[key] = (fingerprint, _response(result))
+            return result
+
+    def account(self, email):
+        with self._lock(email):
+            return tuple(self._accounts.get(email, (0, 0, 0)))
+
+    def plan(self, email):
+        # Plans are SQLite only; every account here is on the free plan
+        return "free"
+
+    def deposit(self, deposit):
+        return self._once(deposit.email, f"payment:{deposit.payment_id}", "deposit",
+                          self._credit, deposit)
+
+    def _credit(self, deposit):
+        account = self._accounts.setdefault(deposit.email, [0, 0, 0])
+        account[0] += deposit.tokens
+        account[2] += 1
+        self._record(deposit.email, deposit.tokens, None, f"Purchase via {deposit.payment_id}")
+        return {"status": "deposited", "new_balance": account[0],
+                "_accounts": [self._state(deposit.email)]}
+
+    def spend(self, spend, key=None):
+        return self._once(spend.email, client_key("spend", spend.email, key), "spend",
+                          self._debit, spend)
+
+    def _debit(self, spend):
+        account = self._accounts.get(spend.email)
+        if account is None or account[0] - account[1] < spend.tokens:
+            raise HTTPException(status_code=402, detail="Insufficient tokens")
+        account[0] -= spend.tokens
+        account[2] += 1
+        self._record(spend.email, -spend.tokens, spend.app_id, spend.description)
+        return {"status": "spent", "remaining": account[0],
+                "_accounts": [self._state(spend.email)]}
+
+    def reserve(self, hold, key=None):
+        return self._once(hold.email, client_key("hold", hold.email, key), "hold",
+                          self._reserve, hold)
+
+    def _reserve(self, hold):
+        account = self._accounts.get(hold.email)
+        if account is None or account[0] - account[1] < hold.tokens:
+            available = account[0] - account[1] if account else 0
+            raise HTTPException(status_code=402,
+                                detail={"error": "Insufficient tokens", "available": available})
+        account[1] += hold.tokens
+        account[2] += 1
+        hold_id = secrets.token_hex(8)
+        expires_at = _now_ms() + hold.ttl_seconds * 1000
+        self._holds[hold_id] = (hold.email, hold.app_id, hold.tokens, hold.description, expires_at)
+        return {"status": "held", "hold_id": hold_id, "tokens": hold.tokens,
+                "available": account[0] - account[1], "expires_at": expires_at / 1000,
+                "_accounts": [self._state(hold.email)]}
+
+    def _settle(self, hold_id, settle):
+        """Run settle(hold) under the hold's account lock, then drop the hold"""
+        hold = self._holds.get(hold_id)
+        if hold is None:
+            raise HTTPException(status_code=404, detail="Hold not found")
+        with self._lock(hold[0]):
+            # Settled by someone else while we waited for the lock
+            if self._holds.get(hold_id) is not hold:
+                raise HTTPException(status_code=404, detail="Hold not found")
+            if hold[4] <= _now_ms():
+                raise HTTPException(status_code=410, detail="Hold expired")
+            result = settle(hold)
+            del self._holds[hold_id]
+            return result
+
+    def capture(self, hold_id, capture):
+        def settle(hold):
+            email, app_id, held, description, _ = hold
+            tokens = held if capture.tokens is None else capture.tokens
+            if not 0 <= tokens <= held:
+                raise HTTPException(status_code=400, detail=f"Can capture at most {held} tokens")
+            account = self._accounts[email]
+            account[0] -= tokens
+            account[1] -= held
+            account[2] += 1
+            self._record(email, -tokens, app_id, capture.description or description)
+            return {"status": "captured", "tokens": tokens, "remaining": account[0],
+                    "_accounts": [self._state(email)]}
+        return self._settle(hold_id, settle)
+
+    def release(self, hold_id):
+        def settle(hold):
+            email, held = hold[0], hold[2]
+            account = self._accounts[email]
+            account[1] -= held
+            account[2] += 1
+            return {"status": "released", "tokens": held, "_accounts": [self._state(email)]}
+        return self._settle(hold_id, settle)
+
+    def expire_holds(self):
+        now = _now_ms()
+        released = {}
+        for hold_id, hold in list(self._holds.items()):
+            if hold[4] > now:
+                continue
+            email, held = hold[0], hold[2]
+            with self._lock(email):
+                if self._holds.get(hold_id) is not hold:
+                    continue
+                del self._holds[hold_id]
+                account = self._accounts[email]
+                account[1] -= held
+                account[2] += 1
+                released[email] = self._state(email)
+        return {"status": "expired", "accounts": len(released), "_accounts": list(released.values())}
+
+    def ledger(self, email, limit=50):
+        with self._lock(email):
+            rows = self._ledger.get(email, [])[-limit:]
+        return [row[1:] for row in reversed(rows)]
+
+    def verify(self):
+        holds = {}
+        for email, _, tokens, _, _ in list(self._holds.values()):
+            holds[email] = holds.get(email, 0) + tokens
+        problems = []
+        for email in list(self._accounts):
+            with self._lock(email):
+                tokens, held, _ = self._accounts[email]
+                total = sum(row[1] for row in self._ledger.get(email, []))
+            if tokens < 0:
+                problems.append(f"negative balance {email}: {tokens}")
+            if tokens != total:
+                problems.append(f"ledger drift {email}: balance {tokens}, ledger {total}")
+            if held != holds.get(email, 0):
+                problems.append(f"hold drift {email}: held {held}, holds {holds.get(email, 0)}")
+        return problems
@@ -0,0 +1,119 @@
+# shared/bank_writer.py
+"""Group-commit writer for ledger mutations.
+
+One thread owns all writes to a database. Callers hand it a function
+that takes the connection; concurrent calls are applied back to back in
+a single BEGIN IMMEDIATE ... COMMIT, each inside its own SAVEPOINT so a
+failing call (e.g. insufficient tokens) only undoes itself. Every
+caller gets its own result or exception once the shared COMMIT lands.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# Most mutations committed in one transaction
+MAX_BATCH = int(os.getenv("BANK_WRITER_MAX_BATCH", "256"))
+# How long the writer keeps collecting once mutations are arriving concurrently
+MAX_DELAY_MS = float(os.getenv("BANK_WRITER_MAX_DELAY_MS", "2"))
+
+_STOP = object()
+
+
+class LedgerWriter:
+    """Single writer thread that group-commits queued mutations"""
+
+    def __init__(self, pool, max_batch=MAX_BATCH, max_delay_ms=MAX_DELAY_MS):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.mutations = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="ledger-writer", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """Finish queued work and stop the writer thread"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join()
+
+    def submit(self, fn, *args):
+        """Queue fn(conn, *args) and return a Future for its result"""
+        if self._thread is None:
+            self.start()
+        future = Future()
+        self._queue.put((future, fn, args))
+        return future
+
+    def run(self, fn, *args):
+        """Queue fn(conn, *args) and wait until it is committed"""
+        return self.submit(fn, *args).result()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                # A lone mutation commits straight away; only linger for
+                # more once other callers are already queued behind it
+                remaining = deadline - time.monotonic()
+                if len(batch) == 1 or remaining <= 0:
+                    item = self._queue.get_nowait()
+                else:
+                    item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self._queue.put(_STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def _loop(self):
+        while True:
+            first = self._queue.get()
+            if first is _STOP:
+                return
+            self._commit(self._collect(first))
+
+    def _commit(self, batch):
+        conn = self.pool.connection()
+        outcomes = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for future, fn, args in batch:
+                conn.execute("SAVEPOINT mutation")
+                try:
+                    outcomes.append((future, fn(conn, *args), None))
+                except Exception as e:
+                    if not conn.in_transaction:
+                        raise  # SQLite aborted the whole transaction
+                    conn.execute("ROLLBACK TO mutation")
+                    outcomes.append((future, None, e))
+                conn.execute("RELEASE mutation")
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for future, fn, args in batch:
+                future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.mutations += len(batch)
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
@@ -3,11 +3,21 @@ from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import RedirectResponse
 import httpx
 import os
+from pricing import PRICING
+from shared.auth import verify_magic_link
+from shared.bank_client import AsyncBankClient, BankError, InsufficientTokens
 
 app = FastAPI()
-CENTRAL_BANK = "http://localhost:8000"  # Your token bank
 REAL_APP = "http://localhost:5001"      # Your actual thumbnail app
 
+# The central bank (BANK_URL, http://localhost:8001 by default)
+bank = AsyncBankClient()
+
+# Only running an analysis costs tokens; pages, assets and other calls
+# pass through. The real app's analysis route is assumed to be
+# POST /analyze; point THUMBNAIL_ANALYZE_PATH at it if it differs.
+ANALYZE_PATH = os.getenv("THUMBNAIL_ANALYZE_PATH", "analyze").strip("/")
+
 @app.api_route("/{path:path}", methods=["GET", "POST"])
 async def proxy(request: Request, path: str):
     # 1. Get user's token from cookie/session
@@ -15,30 +25,38 @@ async def proxy(request: Request, path: str):
     if not user_token:
         return RedirectResponse("https://dashboard.yourplatform.com/login")
     
-    # 2. Ask central bank: "Can this user spend 4 tokens?"
-    try:
-        check = httpx.post(f"{CENTRAL_BANK}/can_spend", json={
-            "token": user_token,
-            "app": "thumbnail_wizard",
-            "cost": 4
-        })
-        
-        if check.status_code != 200:
-            # Not enough tokens
-            return RedirectResponse("https://dashboard.yourplatform.com/buy-tokens")
+    email = verify_magic_link(user_token, mark_used=False)
+    if not email:
+        return RedirectResponse("https://dashboard.yourplatform.com/login")
     
-    except:
-        # Bank is down
-        return {"error": "Bank unavailable"}, 503
+    # 2. For an analysis, have the central bank set the 4 tokens aside;
+    # they are only taken if the real app succeeds
+    hold_id = None
+    if request.method == "POST" and path.strip("/") == ANALYZE_PATH:
+        try:
+            hold = await bank.hold(email, "thumbnail_wizard", PRICING["thumbnail_wizard"]["analyze"],
+                                   f"Thumbnail: {path[:50]}")
+        except InsufficientTokens:
+            return RedirectResponse("https://dashboard.yourplatform.com/buy-tokens")
+        except BankError as e:
+            # Bank is down or refused the call
+            raise HTTPException(status_code=503, detail=f"Bank unavailable ({e})")
+        hold_id = hold.hold_id
     
     # 3. Forward to real app
-    async with httpx.AsyncClient() as client:
-        response = await client.request(
-            method=request.method,
-            url=f"{REAL_APP}/{path}",
-            headers=dict(request.headers),
-            content=await request.body()
-        )
+    succeeded = False
+    try:
+        async with httpx.AsyncClient() as client:
+            response = await client.request(
+                method=request.method,
+                url=f"{REAL_APP}/{path}",
+                headers=dict(request.headers),
+                content=await request.body()
+            )
+        succeeded = response.status_code < 400
+    finally:
+        if hold_id:
+            await bank.settle(hold_id, capture=succeeded)
     
     return response.content
 